@@ -38,11 +38,19 @@ it is likely enough not to do this, as the "user" will be root.
 
 from __future__ import with_statement
 import fcntl
+import collections
 import ctypes
 import array
+import errno
+import io
+import math
 import select
+import sys
+import time
 
-from kbus.messages import MessageId, Message
+from kbus.messages import MessageId, Message, MessageView, \
+        split_replier_bind_event_data, _name_matches, _name_specificity, \
+        _BoundedDict
 
 # Kernel definitions for ioctl commands
 # Following closely from #include <asm[-generic]/ioctl.h>
@@ -96,6 +104,390 @@ class SendResultStruct(ctypes.Structure):
                 ('msg_id',  MessageId)]
 
 
+# How many bind (and, separately, find replier) arguments a Ksock remembers
+_MAX_REMEMBERED_ARGS = 128
+
+class BufferPool(object):
+    """A pool of bytearrays, to be reused for reading messages into.
+
+    Buffers are handed out in sizes that are a power of two (and at least
+    'min_size' bytes), so that a buffer released after one message can be
+    reused for any later message of a similar size:
+
+        >>> pool = BufferPool()
+        >>> buf = pool.acquire(100)
+        >>> len(buf)
+        256
+        >>> pool.release(buf)
+        >>> pool.acquire(200) is buf
+        True
+        >>> len(pool.acquire(300))
+        512
+
+    At most 'max_per_size' buffers of each size are kept for reuse - any
+    more than that are just dropped when they are released.
+
+        >>> sorted(pool.info().items())
+        [('allocated', 2), ('free', 0), ('reused', 1)]
+    """
+
+    def __init__(self, max_per_size=8, min_size=256):
+        self.max_per_size = max_per_size
+        self.min_size = min_size
+        self._free = {}
+        self.allocated = 0
+        self.reused = 0
+
+    def _size_for(self, length):
+        size = self.min_size
+        while size < length:
+            size <<= 1
+        return size
+
+    def acquire(self, length):
+        """Return a bytearray at least 'length' bytes long.
+        """
+        size = self._size_for(length)
+        free = self._free.get(size)
+        if free:
+            self.reused += 1
+            return free.pop()
+        self.allocated += 1
+        return bytearray(size)
+
+    def release(self, buffer):
+        """Give 'buffer' back to the pool, for reuse.
+
+        The caller must not use the buffer (or anything that refers to it)
+        after it has been released.
+        """
+        free = self._free.setdefault(len(buffer), [])
+        if len(free) < self.max_per_size:
+            free.append(buffer)
+
+    def info(self):
+        """Return a dictionary describing the pool's state.
+
+        'allocated' is how many buffers it has had to create, 'reused' how
+        many times it has handed out a previously released buffer, and 'free'
+        how many buffers it currently holds.
+        """
+        return {'allocated': self.allocated,
+                'reused': self.reused,
+                'free': sum(len(x) for x in self._free.values())}
+
+class SpinPolicy(object):
+    """How long Ksock.spin_for_msg should busy-wait before it blocks.
+
+    Waking up from select (or poll) after a message arrives takes time. If
+    messages are arriving quickly, it can be quicker to keep asking KBUS
+    whether there is one (using 'next_msg') for a short while, before
+    falling back to blocking - at the cost of using the CPU while doing so.
+
+    - spin_time is how long (in seconds) to spin for. If 'adaptive' is
+      true, this is just the starting value.
+    - if adaptive is true, then the spin time is adjusted according to how
+      far apart messages have recently been arriving: spinning for a bit
+      longer than the typical gap when messages are close together, and
+      not spinning at all when they are far apart.
+    - min_spin and max_spin bound the adaptive spin time.
+    - wakeup_cost is an estimate of how long (in seconds) a wakeup from
+      select takes, used to estimate the latency saved by spinning.
+
+    'report' says how things have gone so far:
+
+        >>> policy = SpinPolicy(spin_time=50e-6)
+        >>> policy.spin_time
+        5e-05
+        >>> sorted(policy.report().keys())
+        ['blocked', 'latency_saved', 'spin_time', 'spin_time_total', 'spin_time_wasted', 'spun']
+
+    For instance, messages arriving every 10 microseconds lead to spinning
+    for a little longer than that:
+
+        >>> for ii in range(20):
+        ...     policy.arrived(ii * 10e-6)
+        >>> policy.spin_time < 50e-6
+        True
+
+    whilst messages a second apart mean there is no point in spinning:
+
+        >>> for ii in range(20):
+        ...     policy.arrived(ii * 1.0)
+        >>> policy.spin_time
+        0.0
+    """
+
+    # How much each new inter-arrival time contributes to our average
+    SMOOTHING = 0.2
+    # How much longer than the average gap we spin for
+    HEADROOM = 2.0
+
+    def __init__(self, spin_time=50e-6, adaptive=True, min_spin=0.0,
+                 max_spin=1e-3, wakeup_cost=30e-6):
+        self.spin_time = spin_time
+        self.adaptive = adaptive
+        self.min_spin = min_spin
+        self.max_spin = max_spin
+        self.wakeup_cost = wakeup_cost
+
+        self._last_arrival = None
+        self._mean_gap = None
+
+        self.spun = 0                   # messages found by spinning
+        self.blocked = 0                # times we had to block instead
+        self.spin_time_total = 0.0      # time spent spinning
+        self.spin_time_wasted = 0.0     # ...of which did not find a message
+
+    def __repr__(self):
+        return '<SpinPolicy spin %.1fus%s>'%(self.spin_time * 1e6,
+                ', adaptive' if self.adaptive else '')
+
+    def arrived(self, when):
+        """Note that a message arrived at time 'when' (in seconds).
+        """
+        if self._last_arrival is not None:
+            gap = max(0.0, when - self._last_arrival)
+            if self._mean_gap is None:
+                self._mean_gap = gap
+            else:
+                self._mean_gap += self.SMOOTHING * (gap - self._mean_gap)
+            if self.adaptive:
+                self._adapt()
+        self._last_arrival = when
+
+    def _adapt(self):
+        wanted = self._mean_gap * self.HEADROOM
+        if wanted > self.max_spin:
+            # Messages are too far apart for spinning to be worth it
+            self.spin_time = self.min_spin
+        else:
+            self.spin_time = max(self.min_spin, wanted)
+
+    def spun_for(self, elapsed, found):
+        """Note that we spun for 'elapsed' seconds, and whether that 'found' a message.
+        """
+        self.spin_time_total += elapsed
+        if found:
+            self.spun += 1
+        else:
+            self.spin_time_wasted += elapsed
+            self.blocked += 1
+
+    def report(self):
+        """Return a dictionary describing how spinning has gone.
+
+        'spun' is how many messages were found by spinning, and 'blocked'
+        how many times we had to block instead. 'spin_time_total' is the
+        time (and thus CPU) spent spinning, and 'spin_time_wasted' how much
+        of that was spent before blocking anyway. 'latency_saved' is an
+        estimate of the time saved, being 'spun' times our 'wakeup_cost'.
+        'spin_time' is the current spin time.
+        """
+        return {'spun': self.spun,
+                'blocked': self.blocked,
+                'spin_time': self.spin_time,
+                'spin_time_total': self.spin_time_total,
+                'spin_time_wasted': self.spin_time_wasted,
+                'latency_saved': self.spun * self.wakeup_cost}
+
+class QueueTuner(object):
+    """Adjusts a Ksock's 'max_messages' to suit the messages it receives.
+
+    If a Ksock's message queue is too short, senders are refused (with
+    EBUSY) or have messages dropped when a burst of messages arrives. If it
+    is too long, it can hide that we are not keeping up, and uses more kernel
+    memory than necessary.
+
+    A QueueTuner keeps an eye on how full the queue gets, and how quickly
+    messages are read from it. At the end of each 'interval' seconds, it
+    looks at the highest number of messages it saw queued in that time:
+
+    - if that is 'grow_at' (a fraction) of 'max_messages' or more, it
+      doubles 'max_messages'.
+    - if it has been less than 'shrink_at' of 'max_messages' for
+      'shrink_after' intervals in a row, it halves 'max_messages' - but
+      always leaves room for 'burst_time' seconds' worth of messages at
+      the rate they have been read.
+
+    'max_messages' is always kept between 'min_messages' and 'max_messages'
+    (the arguments).
+
+    Normally, a QueueTuner is started with Ksock.tune_max_messages, and then
+    samples the queue (with 'num_messages') each time 'sample_every'
+    messages have been read. 'sample' may also be called directly (for
+    instance, from a timer), so that an idle Ksock can shrink its queue.
+
+    Each change is remembered in 'decisions', as a tuple of (time, old
+    maximum, new maximum, reason). If 'log' is given, it is also called with
+    a string describing the change.
+
+    'decide' is what makes the decisions:
+
+        >>> tuner = QueueTuner(None, min_messages=10, max_messages=400)
+        >>> tuner.decide(100, 90, 500.0)
+        (200, 'high water 90 of 100')
+        >>> tuner.decide(400, 390, 500.0)
+        (None, 'high water 390 of 400, already at maximum')
+        >>> tuner.decide(100, 50, 500.0)
+        (None, None)
+
+    and it only shrinks the queue after 'shrink_after' quiet intervals:
+
+        >>> for ii in range(tuner.shrink_after):
+        ...     print tuner.decide(100, 5, 200.0)
+        (None, None)
+        (None, None)
+        (None, None)
+        (None, None)
+        (50, 'high water 5 of 100 for 5 intervals')
+
+    but not below enough room for 'burst_time' seconds of messages (here,
+    0.1 seconds at 400 messages per second):
+
+        >>> for ii in range(tuner.shrink_after):
+        ...     result = tuner.decide(50, 5, 400.0)
+        >>> result
+        (40, 'high water 5 of 50 for 5 intervals')
+    """
+
+    # How much we change max_messages by
+    GROW_FACTOR = 2.0
+    SHRINK_FACTOR = 0.5
+    # How many decisions we remember
+    MAX_DECISIONS = 100
+
+    def __init__(self, ksock, min_messages=10, max_messages=1000,
+                 interval=1.0, sample_every=16, grow_at=0.75, shrink_at=0.25,
+                 shrink_after=5, burst_time=0.1, log=None):
+        if min_messages < 1 or min_messages > max_messages:
+            raise ValueError('QueueTuner needs 1 <= min_messages (%d)'
+                             ' <= max_messages (%d)'%(min_messages, max_messages))
+        self.ksock = ksock
+        self.min_messages = min_messages
+        self.max_messages = max_messages
+        self.interval = interval
+        self.sample_every = sample_every
+        self.grow_at = grow_at
+        self.shrink_at = shrink_at
+        self.shrink_after = shrink_after
+        self.burst_time = burst_time
+        self.log = log
+
+        self.decisions = collections.deque(maxlen=self.MAX_DECISIONS)
+        self.high_water = 0             # in the current interval
+        self.drain_rate = 0.0           # messages read per second, last interval
+        self._reads = 0                 # in the current interval
+        self._unsampled = 0             # reads since we last sampled
+        self._quiet_intervals = 0
+        self._interval_start = time.time()
+
+    def __repr__(self):
+        return '<QueueTuner %d..%d, every %gs>'%(self.min_messages,
+                self.max_messages, self.interval)
+
+    def message_read(self):
+        """Note that a message has been read, and maybe sample the queue.
+        """
+        self._reads += 1
+        self._unsampled += 1
+        if self._unsampled >= self.sample_every:
+            self.sample()
+
+    def sample(self, now=None):
+        """Look at how many messages are queued, and maybe adjust the maximum.
+
+        Returns the new maximum if it was changed, otherwise None.
+        """
+        self._unsampled = 0
+        depth = self.ksock.num_messages()
+        if depth > self.high_water:
+            self.high_water = depth
+        if now is None:
+            now = time.time()
+        elapsed = now - self._interval_start
+        if elapsed < self.interval:
+            return None
+
+        current = self.ksock.max_messages()
+        if elapsed > 0:
+            self.drain_rate = self._reads / elapsed
+        new_max, reason = self.decide(current, self.high_water,
+                                      self.drain_rate)
+        self.high_water = depth
+        self._reads = 0
+        self._interval_start = now
+        if reason is not None and self.log is not None:
+            if new_max is None:
+                self.log('QueueTuner: keeping max_messages %d: %s'%(
+                         current, reason))
+            else:
+                self.log('QueueTuner: max_messages %d -> %d: %s'%(
+                         current, new_max, reason))
+        if new_max is None:
+            return None
+        self.decisions.append((now, current, new_max, reason))
+        return self.ksock.set_max_messages(new_max)
+
+    def decide(self, current, high_water, drain_rate):
+        """Decide what 'max_messages' should be.
+
+        'current' is the current maximum, 'high_water' the most messages
+        seen queued in the last interval, and 'drain_rate' how many messages
+        per second were read in that interval.
+
+        Returns (new_maximum, reason). 'new_maximum' is None if the maximum
+        should not be changed, in which case 'reason' is None if there was
+        nothing worth mentioning.
+        """
+        if high_water >= self.grow_at * current:
+            self._quiet_intervals = 0
+            if current >= self.max_messages:
+                return (None, 'high water %d of %d, already at maximum'%(
+                        high_water, current))
+            new_max = min(self.max_messages,
+                          max(current + 1, int(current * self.GROW_FACTOR)))
+            return (new_max, 'high water %d of %d'%(high_water, current))
+
+        if high_water >= self.shrink_at * current:
+            self._quiet_intervals = 0
+            return (None, None)
+
+        self._quiet_intervals += 1
+        if self._quiet_intervals < self.shrink_after:
+            return (None, None)
+        self._quiet_intervals = 0
+        floor = max(self.min_messages,
+                    int(math.ceil(drain_rate * self.burst_time)))
+        new_max = max(floor, int(current * self.SHRINK_FACTOR))
+        if new_max >= current:
+            return (None, None)
+        return (new_max, 'high water %d of %d for %d intervals'%(high_water,
+                current, self.shrink_after))
+
+class PooledMessageView(MessageView):
+    """A MessageView onto a buffer that belongs to a BufferPool.
+
+    When the message is finished with, call 'release()' to give the buffer
+    back to the pool. After that, the view cannot be used.
+    """
+
+    __slots__ = ('_pool', '_pool_buffer')
+
+    def __init__(self, buffer, pool):
+        super(PooledMessageView, self).__init__(buffer)
+        self._pool = pool
+        self._pool_buffer = buffer
+
+    def release(self):
+        """Give our buffer back to its pool.
+        """
+        if self._pool_buffer is not None:
+            self._buf = self._hdr = None
+            self._pool.release(self._pool_buffer)
+            self._pool = self._pool_buffer = None
+
+
 class Ksock(object):
     """A wrapper around a KBUS device, for purposes of message sending.
 
@@ -105,6 +497,11 @@ class Ksock(object):
     'mode' should be 'r' or 'rw' -- i.e., whether to open the device for read or
     write (opening for write also allows reading, of course).
 
+    By default, the device is opened as a raw (unbuffered) file, so that each
+    message is written with exactly one 'write' system call, and read with
+    exactly one 'read'. If 'buffered' is true, it is instead opened as a
+    normal (buffered) Python file, as it used to be.
+
     I'm not really very keen on the name Ksock, but it's better than the
     original "File", which I think was actively misleading.
     """
@@ -128,7 +525,7 @@ class Ksock(object):
     IOC_NEWDEVICE   = _IOR(IOC_MAGIC,  16, ctypes.sizeof(ctypes.c_char_p))
     IOC_REPORTREPLIERBINDS = _IOWR(IOC_MAGIC, 17, ctypes.sizeof(ctypes.c_char_p))
 
-    def __init__(self, which=0, mode='rw'):
+    def __init__(self, which=0, mode='rw', buffered=False):
         if mode not in ('r', 'rw'):
             raise ValueError("Ksock mode should be 'r' or 'rw', not '%s'"%mode)
         self.which = which
@@ -138,9 +535,50 @@ class Ksock(object):
         else:
             mode = 'r+'
             self.mode = 'read/write'
-        # Although Unix doesn't mind whether a file is opened with a 'b'
-        # for binary, it is possible that some version of Python may
-        self.fd = open(self.name, mode+'b')
+        if buffered:
+            # Although Unix doesn't mind whether a file is opened with a 'b'
+            # for binary, it is possible that some version of Python may
+            self.fd = open(self.name, mode+'b')
+        else:
+            # A raw file has no buffer to copy our data through, and its
+            # 'flush' does nothing
+            self.fd = io.FileIO(self.name, mode)
+        # A buffer to read messages into, reused (and grown) as necessary
+        self._scratch = bytearray(1024)
+        # Messages read while waiting for replies in 'call_many', which are
+        # held to be returned by later reads
+        self._held = collections.deque()
+        self._spin_policy = None
+        self._tuner = None
+        # Our bindings, as { (name, is_replier) : count }, since a Listener
+        # may bind to the same name more than once
+        self._bindings = {}
+        self._init_ioctl_args()
+
+    def _init_ioctl_args(self):
+        """Set up our reusable ioctl arguments.
+
+        The commonest ioctls each get their own argument array, so that we
+        don't need to create a new one on each call (and so that calls of
+        different ioctls cannot disturb each other's results). Bind and
+        replier arguments are remembered by message name.
+
+        We also remember our (integer) file descriptor, as otherwise each
+        call of fcntl.ioctl has to ask our file object for it.
+        """
+        self._fileno = self.fd.fileno()
+        self._ksockid_arg = array.array('I', [0])
+        self._nextmsg_arg = array.array('I', [0])
+        self._lenleft_arg = array.array('I', [0])
+        self._send_arg = array.array('I', [0, 0])
+        self._lastsent_arg = array.array('I', [0, 0])
+        self._maxmsgs_arg = array.array('I', [0])
+        self._nummsgs_arg = array.array('I', [0])
+        self._unrepliedto_arg = array.array('I', [0])
+        self._bind_args = _BoundedDict(_MAX_REMEMBERED_ARGS)
+        self._replier_args = _BoundedDict(_MAX_REMEMBERED_ARGS)
+        # For binding lots of names at once, without remembering them all
+        self._bulk_bind_arg = BindStruct(0, 0, None)
 
     def __str__(self):
         if self.fd:
@@ -158,7 +596,10 @@ class Ksock(object):
     def close(self):
         ret = self.fd.close()
         self.fd = None
+        self._fileno = -1
         self.mode = None
+        # KBUS forgets our bindings when we close
+        self._bindings = {}
         return ret
 
     def bind(self, name, replier=False):
@@ -167,16 +608,136 @@ class Ksock(object):
         If 'replier', then we are binding as the only fd that can reply to this
         message name.
         """
-        arg = BindStruct(replier, len(name), name)
-        fcntl.ioctl(self.fd, Ksock.IOC_BIND, arg)
+        fcntl.ioctl(self._fileno, Ksock.IOC_BIND, self._bind_arg(name, replier))
+        self._remember_binding((name, bool(replier)))
 
     def unbind(self, name, replier=False):
         """Unbind the given name from the file descriptor.
 
         The arguments need to match the binding that we want to unbind.
         """
-        arg = BindStruct(replier, len(name), name)
-        fcntl.ioctl(self.fd, Ksock.IOC_UNBIND, arg)
+        fcntl.ioctl(self._fileno, Ksock.IOC_UNBIND,
+                    self._bind_arg(name, replier))
+        self._forget_binding((name, bool(replier)))
+
+    def _remember_binding(self, key):
+        self._bindings[key] = self._bindings.get(key, 0) + 1
+
+    def _forget_binding(self, key):
+        count = self._bindings.get(key, 0)
+        if count > 1:
+            self._bindings[key] = count - 1
+        elif count:
+            del self._bindings[key]
+
+    def _bind_many(self, ioctl, names, replier, undo):
+        """Do 'ioctl' (bind or unbind) for each name in 'names'.
+
+        If it fails, does 'undo' for each name already done, and re-raises
+        the exception. Otherwise, returns the list of names done.
+        """
+        arg = self._bulk_bind_arg
+        arg.is_replier = replier
+        fileno = self._fileno
+        done = []
+        try:
+            for name in names:
+                arg.len = len(name)
+                arg.name = name
+                fcntl.ioctl(fileno, ioctl, arg)
+                done.append(name)
+        except:
+            exc_info = sys.exc_info()
+            for name in reversed(done):
+                arg.len = len(name)
+                arg.name = name
+                try:
+                    fcntl.ioctl(fileno, undo, arg)
+                except IOError:
+                    pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return done
+
+    def bind_many(self, names, replier=False):
+        """Bind each of the given names to the file descriptor.
+
+        Names that we are already bound to (in the same way) are skipped,
+        as are repeats within 'names', so that this may be used to make
+        sure that we are bound to all of them.
+
+        If binding any name fails, those names already bound by this call
+        are unbound again, and the exception is re-raised - so either all
+        of the names are bound, or none of them are.
+
+        Returns a list of the names that were bound.
+        """
+        replier = bool(replier)
+        bindings = self._bindings
+        wanted = []
+        seen = set()
+        for name in names:
+            if name not in seen and (name, replier) not in bindings:
+                seen.add(name)
+                wanted.append(name)
+        done = self._bind_many(Ksock.IOC_BIND, wanted, replier,
+                               Ksock.IOC_UNBIND)
+        for name in done:
+            bindings[(name, replier)] = 1
+        return done
+
+    def unbind_many(self, names, replier=False):
+        """Unbind each of the given names from the file descriptor.
+
+        Names that we are not bound to (in the same way) are skipped, as are
+        repeats within 'names'. If a name was bound more than once, only one
+        of those bindings is removed.
+
+        If unbinding any name fails, those names already unbound by this
+        call are bound again, and the exception is re-raised.
+
+        Returns a list of the names that were unbound.
+        """
+        replier = bool(replier)
+        bindings = self._bindings
+        wanted = []
+        seen = set()
+        for name in names:
+            if name not in seen and (name, replier) in bindings:
+                seen.add(name)
+                wanted.append(name)
+        done = self._bind_many(Ksock.IOC_UNBIND, wanted, replier,
+                               Ksock.IOC_BIND)
+        for name in done:
+            self._forget_binding((name, replier))
+        return done
+
+    def bindings(self):
+        """Return a list of our bindings, as tuples of (name, is_replier).
+
+        This is worked out from the bindings we have made (with 'bind',
+        'bind_many' and so on), rather than by asking KBUS. A name that is
+        bound more than once appears more than once. The list is sorted.
+        """
+        result = []
+        for key, count in self._bindings.items():
+            result.extend([key] * count)
+        result.sort()
+        return result
+
+    def is_bound(self, name, replier=False):
+        """Are we bound to 'name' (as a Replier if 'replier' is true)?
+        """
+        return (name, bool(replier)) in self._bindings
+
+    def _bind_arg(self, name, replier):
+        """Return a BindStruct for binding (or unbinding) 'name'.
+        """
+        key = (name, bool(replier))
+        try:
+            return self._bind_args[key]
+        except KeyError:
+            return self._bind_args.remember(key,
+                                            BindStruct(replier, len(name), name))
 
     def ksock_id(self):
         """Return the internal 'Ksock id' for this file descriptor.
@@ -185,8 +746,8 @@ class Ksock(object):
         # arrays of data using, well, arrays. This one is a bit minimalist.
         # (Our devout hope, here and elsewhere, is that "I" means a 32-bit
         # unsigned value on 32-bit *and* 64-bit platforms.)
-        id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_KSOCKID, id, True)
+        id = self._ksockid_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_KSOCKID, id, True)
         return id[0]
 
     def next_msg(self):
@@ -194,8 +755,10 @@ class Ksock(object):
 
         Returns the length of said message, or 0 if there is no next message.
         """
-        id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_NEXTMSG, id, True)
+        id = self._nextmsg_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_NEXTMSG, id, True)
+        if id[0] and self._tuner is not None:
+            self._tuner.message_read()
         return id[0]
 
     def len_left(self):
@@ -204,8 +767,8 @@ class Ksock(object):
         Returns 0 if there is no current message (i.e., 'next_msg()' has not
         been called), or if there are no bytes left.
         """
-        id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_LENLEFT, id, True)
+        id = self._lenleft_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_LENLEFT, id, True)
         return id[0]
 
     def send(self):
@@ -218,8 +781,8 @@ class Ksock(object):
 
         Raises IOError with errno ENOMSG if there was no message to send.
         """
-        arg = array.array('I', [0, 0])
-        fcntl.ioctl(self.fd, Ksock.IOC_SEND, arg);
+        arg = self._send_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_SEND, arg);
         return MessageId(arg[0], arg[1])
 
     def discard(self):
@@ -230,15 +793,15 @@ class Ksock(object):
         written (for instance, because 'send' has already been called).
         be sent.
         """
-        fcntl.ioctl(self.fd, Ksock.IOC_DISCARD, 0);
+        fcntl.ioctl(self._fileno, Ksock.IOC_DISCARD, 0);
 
     def last_msg_id(self):
         """Return the id of the last message written on this file descriptor.
 
         Returns 0 before any messages have been sent.
         """
-        id = array.array('I', [0, 0])
-        fcntl.ioctl(self.fd, Ksock.IOC_LASTSENT, id, True)
+        id = self._lastsent_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_LASTSENT, id, True)
         return MessageId(id[0], id[1])
 
     def find_replier(self, name):
@@ -246,8 +809,12 @@ class Ksock(object):
 
         Returns None if there was no replier, otherwise the replier's id.
         """
-        arg = ReplierStruct(0, len(name), name)
-        retval = fcntl.ioctl(self.fd, Ksock.IOC_REPLIER, arg);
+        try:
+            arg = self._replier_args[name]
+        except KeyError:
+            arg = self._replier_args.remember(name,
+                                              ReplierStruct(0, len(name), name))
+        retval = fcntl.ioctl(self._fileno, Ksock.IOC_REPLIER, arg);
         if retval:
             return arg.return_id
         else:
@@ -256,8 +823,9 @@ class Ksock(object):
     def max_messages(self):
         """Return the number of messages that can be queued on this Ksock.
         """
-        id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_MAXMSGS, id, True)
+        id = self._maxmsgs_arg
+        id[0] = 0
+        fcntl.ioctl(self._fileno, Ksock.IOC_MAXMSGS, id, True)
         return id[0]
 
     def set_max_messages(self, count):
@@ -273,16 +841,53 @@ class Ksock(object):
         Ksock.
         """
         id = array.array('I', [count])
-        fcntl.ioctl(self.fd, Ksock.IOC_MAXMSGS, id, True)
+        fcntl.ioctl(self._fileno, Ksock.IOC_MAXMSGS, id, True)
         return id[0]
 
+    def tune_max_messages(self, **kwargs):
+        """Start adjusting 'max_messages' automatically.
+
+        The keyword arguments are as for QueueTuner, which see.
+
+        Returns the QueueTuner, which is also available as 'queue_tuner'.
+        """
+        self._tuner = QueueTuner(self, **kwargs)
+        return self._tuner
+
+    def stop_tuning_max_messages(self):
+        """Stop adjusting 'max_messages' automatically.
+
+        'max_messages' is left as it is.
+        """
+        self._tuner = None
+
+    @property
+    def queue_tuner(self):
+        """The QueueTuner adjusting our 'max_messages', or None.
+        """
+        return self._tuner
+
     def num_messages(self):
         """Return the number of messages that are queued on this Ksock.
+
+        This is the number of messages KBUS has queued for us. It does not
+        include any messages held back by 'call' or 'call_many' - see
+        'num_held'.
         """
-        id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_NUMMSGS, id, True)
+        id = self._nummsgs_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_NUMMSGS, id, True)
         return id[0]
 
+    def num_held(self):
+        """Return the number of messages held back by 'call' or 'call_many'.
+
+        These are returned by 'read_next_msg' (and friends) before anything
+        still queued in KBUS. KBUS itself knows nothing about them, so
+        select (or a KsockPoller) will not report the Ksock as readable
+        because of them - anyone using select should check 'num_held' first.
+        """
+        return len(self._held)
+
     def num_unreplied_to(self):
         """Return the number of replies we still have outstanding.
 
@@ -290,8 +895,8 @@ class Ksock(object):
         WANT_YOU_TO_REPLY flag set, but for which we have not yet sent a
         Reply.
         """
-        id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_UNREPLIEDTO, id, True)
+        id = self._unrepliedto_arg
+        fcntl.ioctl(self._fileno, Ksock.IOC_UNREPLIEDTO, id, True)
         return id[0]
 
     def want_messages_once(self, only_once=False, just_ask=False):
@@ -326,7 +931,7 @@ class Ksock(object):
         else:
             val = 0
         id = array.array('I', [val])
-        fcntl.ioctl(self.fd, Ksock.IOC_MSGONLYONCE, id, True)
+        fcntl.ioctl(self._fileno, Ksock.IOC_MSGONLYONCE, id, True)
         return id[0]
 
     def kernel_module_verbose(self, verbose=True, just_ask=False):
@@ -357,7 +962,7 @@ class Ksock(object):
         else:
             val = 0
         id = array.array('I', [val])
-        fcntl.ioctl(self.fd, Ksock.IOC_VERBOSE, id, True)
+        fcntl.ioctl(self._fileno, Ksock.IOC_VERBOSE, id, True)
         return id[0]
 
     def new_device(self):
@@ -369,7 +974,7 @@ class Ksock(object):
         Returns the new device number (<n>).
         """
         id = array.array('I', [0])
-        fcntl.ioctl(self.fd, Ksock.IOC_NEWDEVICE, id, True)
+        fcntl.ioctl(self._fileno, Ksock.IOC_NEWDEVICE, id, True)
         return id[0]
 
     def report_replier_binds(self, report_events=True, just_ask=False):
@@ -412,16 +1017,23 @@ class Ksock(object):
         else:
             val = 0
         id = array.array('I', [val])
-        fcntl.ioctl(self.fd, Ksock.IOC_REPORTREPLIERBINDS, id, True)
+        fcntl.ioctl(self._fileno, Ksock.IOC_REPORTREPLIERBINDS, id, True)
         return id[0]
 
     def write_msg(self, message):
         """Write a Message. Doesn't send it.
         """
-        # Message data is held in an array.array, and arrays know
-        # how to write themselves out
-        self.fd.write(message.msg)
-        # But we are responsible for flushing
+        msg = message.msg
+        if msg.is_pointy:
+            # A "pointy" message is just its header, and KBUS follows the
+            # pointers therein to find the name and data
+            self.fd.write(msg)
+        else:
+            # An "entire" message knows how to give us just its bytes (and
+            # not, for instance, any padding after its final end guard,
+            # which KBUS would not accept)
+            self.fd.write(msg.as_buffer())
+        # But we are responsible for flushing (if we're buffered)
         self.fd.flush()
 
     def send_msg(self, message):
@@ -433,6 +1045,17 @@ class Ksock(object):
         self.write_msg(message)
         return self.send()
 
+    def send_template(self, template, data=None):
+        """Send a message built from a MessageTemplate and some data.
+
+        This is equivalent to calling 'send_msg' on 'template.render(data)',
+        but writes the template's bytes directly, without building a Message.
+
+        Returns the MessageId of the sent message, as 'send' does.
+        """
+        self.write_data(template.to_bytes(data))
+        return self.send()
+
     def write_data(self, data):
         """Write out (and flush) some data.
 
@@ -470,12 +1093,269 @@ class Ksock(object):
 
         Returns None if there was nothing to be read.
         """
+        if self._held:
+            return self._held.popleft()
         data = self.fd.read(self.next_msg())
         if data:
             return Message.from_bytes(data)
         else:
             return None
 
+    def read_next_view(self):
+        """Read the next Message, as a MessageView.
+
+        Like 'read_next_msg', but the bytes read are not copied into a
+        Message - instead a MessageView onto them is returned, which decodes
+        fields only as they are asked for. This is cheaper if most of the
+        messages read are only looked at briefly (for instance, to check their
+        name) and then discarded.
+
+        Returns None if there was nothing to be read.
+        """
+        if self._held:
+            return MessageView(self._held.popleft().to_bytes())
+        data = self.fd.read(self.next_msg())
+        if data:
+            return MessageView(data)
+        else:
+            return None
+
+    def recv_into(self, buffer):
+        """Read the next Message into 'buffer'.
+
+        'buffer' must be a writable buffer (for instance, a bytearray) at
+        least as long as the message. The message bytes are read straight
+        into it, without making any intermediate copies.
+
+        Returns the length of the message, or 0 if there was nothing to be
+        read.
+
+        If 'buffer' is too short, raises ValueError - in that case the
+        message is still the "current" message, and may be read with
+        'read_data' (see 'len_left').
+
+        If fewer bytes than the message length can be read (which should
+        not happen), raises IOError, since the message has been lost.
+        """
+        if self._held:
+            data = self._held[0].to_bytes()
+            if len(buffer) < len(data):
+                raise ValueError('Buffer of length %d is too short for message'
+                                 ' of length %d'%(len(buffer), len(data)))
+            self._held.popleft()
+            buffer[:len(data)] = data
+            return len(data)
+        length = self.next_msg()
+        if length == 0:
+            return 0
+        if len(buffer) < length:
+            raise ValueError('Buffer of length %d is too short for message'
+                             ' of length %d'%(len(buffer), length))
+        self._readinto_exactly(buffer, length)
+        return length
+
+    def _readinto_exactly(self, buffer, length):
+        """Read the current message, of 'length' bytes, into 'buffer'.
+
+        Raises IOError if we don't get all of it. By then 'next_msg' has
+        taken the message off the queue, so we can't just pretend there
+        was nothing there.
+        """
+        count = self.fd.readinto(memoryview(buffer)[:length])
+        if count != length:
+            raise IOError(errno.EIO, 'Read %s bytes of message of length %d'%(
+                                     count, length))
+
+    def read_next_pooled_view(self, pool):
+        """Read the next Message into a buffer from a BufferPool.
+
+        Returns a PooledMessageView onto the buffer, or None if there was
+        nothing to be read. Call the view's 'release()' method when it is
+        finished with, so that the buffer can be reused.
+
+        As for 'recv_into', raises IOError if only part of the message
+        could be read.
+
+        In a steady state, reading messages in this way allocates nothing
+        but the (small) view itself:
+
+            pool = BufferPool()
+            while True:
+                view = ksock.read_next_pooled_view(pool)
+                if view is None:
+                    break
+                ... do things with view ...
+                view.release()
+        """
+        if self._held:
+            data = self._held.popleft().to_bytes()
+            buffer = pool.acquire(len(data))
+            buffer[:len(data)] = data
+            return PooledMessageView(buffer, pool)
+        length = self.next_msg()
+        if length == 0:
+            return None
+        buffer = pool.acquire(length)
+        try:
+            self._readinto_exactly(buffer, length)
+        except:
+            pool.release(buffer)
+            raise
+        return PooledMessageView(buffer, pool)
+
+    def call(self, request, timeout=None):
+        """Send a Request, and wait for its Reply.
+
+        Returns the Reply (or, if something went wrong, the Status message
+        from KBUS saying so), or None if 'timeout' (a floating point number
+        of seconds) expires first. If there is no timeout, waits forever.
+
+        Any other messages read while waiting are held, to be returned by
+        later calls of 'read_next_msg' (and friends) in the usual order.
+
+        See 'call_many' for more details.
+        """
+        return self.call_many([request], timeout)[0]
+
+    def call_many(self, requests, timeout=None):
+        """Send several Requests, and wait for all of their Replies.
+
+        Each Request is sent (in order), and then replies are read until
+        there is one for each Request, or until 'timeout' (a floating point
+        number of seconds) expires. If there is no timeout, waits forever.
+
+        Returns a list of the Replies (or Status messages, as KBUS sends
+        if a Replier goes away, for instance), in the same order as the
+        Requests, with None for any Request that did not get a reply in
+        time. Replies are recognised by their 'in_reply_to' field, which is
+        looked up in a dictionary of the Requests outstanding, so many
+        Requests can be waited for at once.
+
+        Any other messages read while waiting (including replies to earlier
+        Requests) are held by this Ksock, and returned by later calls of
+        'read_next_msg', 'recv_batch' and the like, before anything that
+        has not yet been read. They are counted by 'num_held', not by
+        'num_messages'. Beware that select (or a KsockPoller) will not know
+        about them, so read them before waiting for new messages.
+
+        Raises ValueError if any of the messages is not a Request. If
+        sending a Request fails, the exception is raised at once (and any
+        replies to Requests already sent will be read in the normal way).
+        """
+        for request in requests:
+            if not request.is_request():
+                raise ValueError('Cannot call() with a message that is not'
+                                 ' a Request: %s'%request)
+
+        pending = {}
+        for index, request in enumerate(requests):
+            pending[self.send_msg(request).frozen()] = index
+
+        replies = [None] * len(requests)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while pending:
+            data = self.fd.read(self.next_msg())
+            if not data:
+                if timeout is None:
+                    select.select([self], [], [])
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                select.select([self], [], [], remaining)
+                continue
+
+            msg = Message.from_bytes(data)
+            in_reply_to = msg.in_reply_to
+            if in_reply_to is not None:
+                index = pending.pop(in_reply_to.frozen(), None)
+                if index is not None:
+                    replies[index] = msg
+                    continue
+            self._held.append(msg)
+        return replies
+
+    def recv_batch(self, max_count=None, max_bytes=None):
+        """Read all (or some) of the Messages that are waiting to be read.
+
+        Uses 'num_held' and 'num_messages' to find out how many messages are
+        pending, and reads them all, without blocking, returning them as a list (which
+        will be empty if there was nothing to read).
+
+        If 'max_count' is given, at most that many messages are read.
+
+        If 'max_bytes' is given, no more messages are started once the total
+        length of those read reaches it. Note that the message that takes
+        the total over 'max_bytes' is still read (once KBUS has been asked
+        for a message, it must be read or lost), so the total may exceed
+        'max_bytes' by up to one message.
+
+        Each message is read into a buffer that is reused from one message
+        to the next, and then copied (once) into its Message.
+
+        As for 'recv_into', raises IOError if only part of a message could
+        be read.
+        """
+        count = self.num_held() + self.num_messages()
+        if max_count is not None and max_count < count:
+            count = max_count
+        messages = []
+        total = 0
+        while self._held and count:
+            msg = self._held.popleft()
+            messages.append(msg)
+            count -= 1
+            total += msg.total_length()
+            if max_bytes is not None and total >= max_bytes:
+                return messages
+        for ii in xrange(count):
+            length = self.next_msg()
+            if length == 0:
+                break
+            if len(self._scratch) < length:
+                self._scratch = bytearray(length)
+            self._readinto_exactly(self._scratch, length)
+            data = memoryview(self._scratch)[:length]
+            messages.append(Message.from_bytes(data))
+            total += length
+            if max_bytes is not None and total >= max_bytes:
+                break
+        return messages
+
+    def messages(self, timeout=None, max_count=None):
+        """A generator yielding Messages as they arrive.
+
+        Whenever there are messages waiting, they are read in batches (using
+        'recv_batch', with 'max_count' as given), and yielded one by one.
+        Only when there is nothing left to read does it wait (using select).
+
+        If 'timeout' is given, it is a floating point number of seconds, and
+        the generator finishes if no message arrives within that time.
+        Otherwise it waits forever.
+
+        For instance::
+
+            for msg in ksock.messages(timeout=1.0):
+                print msg
+
+        Raises ValueError (straight away) if 'max_count' is less than 1.
+        """
+        if max_count is not None and max_count < 1:
+            raise ValueError('max_count must be at least 1, not %d'%max_count)
+        return self._messages(timeout, max_count)
+
+    def _messages(self, timeout, max_count):
+        while True:
+            batch = self.recv_batch(max_count)
+            if batch:
+                for msg in batch:
+                    yield msg
+            else:
+                (r, w, x) = select.select([self], [], [], timeout)
+                if not r:
+                    return
+
     def wait_for_msg(self, timeout=None):
         """Wait for the next Message.
 
@@ -486,15 +1366,71 @@ class Ksock(object):
         after which to timeout the select, otherwise this method will
         wait forever.
 
+        If a message is already held (see 'num_held'), it is returned at
+        once, without waiting.
+
         Returns the new Message, or None if the timeout expired.
         """
-        if timeout:
-            (r, w, x) = select.select([self], [], [], timeout)
-        else:
-            (r, w, x) = select.select([self], [], [], timeout)
+        if not self.num_held():
+            select.select([self], [], [], timeout)
 
         return self.read_next_msg()
 
+    def spin_for_msg(self, timeout=None, policy=None):
+        """Wait for the next Message, busy-waiting for a while first.
+
+        Like 'wait_for_msg', but before blocking in select, keeps asking
+        KBUS if there is a message, for as long as 'policy' (a SpinPolicy)
+        says. This uses CPU, but can get a message sooner when they are
+        arriving close together. If 'policy' is not given, the Ksock's own
+        'spin_policy' is used (which is an adaptive SpinPolicy, created the
+        first time it is needed).
+
+        If timeout is given, it is a floating point number of seconds,
+        after which to stop waiting (including any time spent spinning),
+        otherwise this method will wait forever.
+
+        Returns the new Message, or None if the timeout expired.
+        """
+        if self._held:
+            return self._held.popleft()
+
+        if policy is None:
+            policy = self.spin_policy
+
+        start = now = time.time()
+        spin_until = start + policy.spin_time
+        if timeout is not None and timeout < policy.spin_time:
+            spin_until = start + timeout
+        length = self.next_msg()
+        while not length and now < spin_until:
+            now = time.time()
+            length = self.next_msg()
+        if length:
+            policy.spun_for(now - start, True)
+            policy.arrived(now)
+            return Message.from_bytes(self.fd.read(length))
+
+        policy.spun_for(now - start, False)
+        if timeout is None:
+            select.select([self], [], [])
+        else:
+            remaining = timeout - (now - start)
+            if remaining > 0:
+                select.select([self], [], [], remaining)
+        msg = self.read_next_msg()
+        if msg is not None:
+            policy.arrived(time.time())
+        return msg
+
+    @property
+    def spin_policy(self):
+        """The SpinPolicy used by 'spin_for_msg' when it is not given one.
+        """
+        if self._spin_policy is None:
+            self._spin_policy = SpinPolicy()
+        return self._spin_policy
+
     def read_data(self, count):
         """Read the next 'count' bytes, and return them.
 
@@ -549,6 +1485,822 @@ class Ksock(object):
         """
         return self.fd.fileno()
 
+class KsockPoller(object):
+    """Wait for messages on many Ksocks (and other files) at once, using epoll.
+
+    Unlike select.select, epoll does not need to be told all of the file
+    descriptors of interest each time it is called, and is not limited in
+    how many it can watch. So:
+
+        poller = KsockPoller()
+        for ksock in ksocks:
+            poller.register(ksock)
+        poller.register(a_socket)
+        while True:
+            for thing, pending in poller.poll():
+                ...
+
+    'poll' returns a list of (thing, pending) tuples, one for each registered
+    Ksock that has messages waiting to be read, with 'pending' the number of
+    such messages, and one for each other registered object that is ready to
+    be read, with 'pending' None.
+
+    As with select, only messages queued in KBUS can make a Ksock ready. A
+    Ksock with messages held by 'call' or 'call_many' (see 'num_held') is
+    not reported because of them, so read those before polling.
+
+    If 'edge_triggered' is true, then epoll only reports a Ksock (or other
+    object) when something new arrives for it. The caller must then read all
+    of its pending messages (or data) before polling again, as it will not be
+    reported again for the messages that are already there. Otherwise (the
+    default) it is reported by every poll until it has nothing left to read.
+
+    A KsockPoller can be used in a "with" statement, and is closed at the
+    end of it.
+    """
+
+    def __init__(self, edge_triggered=False):
+        self.edge_triggered = edge_triggered
+        self._events = select.EPOLLIN
+        if edge_triggered:
+            self._events |= select.EPOLLET
+        self._epoll = select.epoll()
+        self._registered = {}
+
+    def __repr__(self):
+        return '<KsockPoller watching %d, %s-triggered>'%(len(self._registered),
+                'edge' if self.edge_triggered else 'level')
+
+    def register(self, thing):
+        """Start watching 'thing', which is a Ksock or has a 'fileno' method.
+        """
+        fileno = thing.fileno()
+        self._epoll.register(fileno, self._events)
+        self._registered[fileno] = (thing, isinstance(thing, Ksock))
+
+    def unregister(self, thing):
+        """Stop watching 'thing'.
+        """
+        fileno = thing.fileno()
+        self._epoll.unregister(fileno)
+        del self._registered[fileno]
+
+    def poll(self, timeout=None):
+        """Wait until one or more of the things we're watching is ready.
+
+        If timeout is given, it is a floating point number of seconds,
+        after which to stop waiting, otherwise this method will wait forever.
+
+        Returns a list of (thing, pending) tuples, as described in the class
+        documentation. The list is empty if the timeout expired.
+        """
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fileno, event in self._epoll.poll(timeout):
+            thing, is_ksock = self._registered[fileno]
+            if is_ksock:
+                pending = thing.num_messages()
+                if pending:
+                    ready.append((thing, pending))
+            else:
+                ready.append((thing, None))
+        return ready
+
+    def fileno(self):
+        """Return the epoll file descriptor.
+
+        This allows a KsockPoller itself to be waited on, for instance by
+        select.select, or by another KsockPoller.
+        """
+        return self._epoll.fileno()
+
+    def close(self):
+        self._epoll.close()
+        self._registered = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.close()
+        return False
+
+def _future_factory(loop):
+    """Return a function that makes a new future for 'loop'.
+    """
+    try:
+        return loop.create_future
+    except AttributeError:
+        pass
+    # Older loops (for instance, those of older versions of trollius) don't
+    # have 'create_future', so we must make the futures ourselves
+    try:
+        import trollius as asyncio
+    except ImportError:
+        import asyncio
+    return lambda: asyncio.Future(loop=loop)
+
+class AsyncKsock(object):
+    """A wrapper around a Ksock, for use with an asyncio event loop.
+
+    'ksock' is the Ksock to wrap, and 'loop' the event loop. The loop must
+    provide 'add_reader', 'remove_reader', 'add_writer' and 'remove_writer',
+    as an asyncio (or trollius) loop does. Futures are made with the loop's
+    'create_future', if it has one, and otherwise as asyncio.Future (in
+    which case trollius or asyncio must be importable).
+
+    'recv', 'recv_batch' and 'send' return futures. In a trollius coroutine,
+    for instance::
+
+        @trollius.coroutine
+        def listen(ksock, loop):
+            aksock = AsyncKsock(ksock, loop)
+            while True:
+                msg = yield From(aksock.recv())
+                if msg.is_request() and msg.wants_us_to_reply():
+                    yield From(aksock.send(reply_to(msg)))
+
+    or, without coroutines, with a callback::
+
+        def got_message(future):
+            print future.result()
+            aksock.recv().add_done_callback(got_message)
+
+        aksock.recv().add_done_callback(got_message)
+
+    The Ksock's file descriptor is only registered with the loop (with
+    'add_reader') while something is waiting for a message, so messages are
+    not read unless asked for.
+
+    Note that, as usual, the wrapped Ksock should not also be read from (or
+    sent on) directly while it is being used via an AsyncKsock.
+    """
+
+    def __init__(self, ksock, loop):
+        self.ksock = ksock
+        self.loop = loop
+        self._create_future = _future_factory(loop)
+        self._fileno = ksock.fileno()
+        # Futures waiting for messages, with how each wants them:
+        # None for a single message, or (max_count, max_bytes) for a batch
+        self._receivers = collections.deque()
+        self._reading = False
+        # Messages waiting to be sent, and the futures for their ids
+        self._senders = collections.deque()
+        self._writing = False
+
+    def __repr__(self):
+        return '<AsyncKsock on %r>'%self.ksock
+
+    def recv(self):
+        """Return a future for the next Message.
+        """
+        return self._add_receiver(None)
+
+    def recv_batch(self, max_count=None, max_bytes=None):
+        """Return a future for a list of all the Messages pending.
+
+        The future is not resolved until there is at least one message,
+        and then it is given all the pending messages (within the limits
+        given, as for Ksock.recv_batch).
+        """
+        return self._add_receiver((max_count, max_bytes))
+
+    def _add_receiver(self, how):
+        future = self._create_future()
+        self._receivers.append((future, how))
+        # Maybe there's something there already
+        self._on_readable()
+        if self._receivers and not self._reading:
+            self.loop.add_reader(self._fileno, self._on_readable)
+            self._reading = True
+        return future
+
+    def _on_readable(self):
+        """Give out messages to whoever is waiting for them.
+        """
+        receivers = self._receivers
+        while receivers:
+            future, how = receivers[0]
+            if future.done():           # presumably, cancelled
+                receivers.popleft()
+                continue
+            try:
+                if how is None:
+                    result = self.ksock.read_next_msg()
+                else:
+                    result = self.ksock.recv_batch(*how)
+            except (IOError, OSError), e:
+                receivers.popleft()
+                future.set_exception(e)
+                continue
+            if not result:
+                break
+            receivers.popleft()
+            future.set_result(result)
+
+        if not receivers and self._reading:
+            self.loop.remove_reader(self._fileno)
+            self._reading = False
+
+    def send(self, message):
+        """Return a future for the MessageId of 'message', once it is sent.
+
+        If the message is marked ALL_OR_WAIT, and cannot be sent yet because
+        a recipient's queue is full, then the Ksock's file descriptor is
+        registered with the loop (with 'add_writer'), and the future is
+        resolved when KBUS has managed to send it.
+
+        Messages are sent in the order that 'send' is called. Note that
+        cancelling the future does not stop its message being sent.
+        """
+        future = self._create_future()
+        self._senders.append((message, future))
+        if not self._writing:
+            self._send_pending()
+        return future
+
+    def _send_pending(self):
+        """Send messages until we run out, or have to wait.
+        """
+        senders = self._senders
+        while senders:
+            message, future = senders[0]
+            try:
+                msg_id = self.ksock.send_msg(message)
+            except IOError, e:
+                if e.errno == errno.EAGAIN:
+                    # KBUS is still trying to send it, and will tell us
+                    # (by our being writable) when it has done so
+                    if not self._writing:
+                        self.loop.add_writer(self._fileno, self._on_writable)
+                        self._writing = True
+                    return
+                senders.popleft()
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            senders.popleft()
+            if not future.done():
+                future.set_result(msg_id)
+
+        if self._writing:
+            self.loop.remove_writer(self._fileno)
+            self._writing = False
+
+    def _on_writable(self):
+        """KBUS has finished sending our first message.
+        """
+        message, future = self._senders.popleft()
+        if not future.done():
+            future.set_result(self.ksock.last_msg_id())
+        self._send_pending()
+
+    def close(self):
+        """Stop using the event loop, and cancel anything waiting.
+
+        Does not close the Ksock itself.
+        """
+        if self._reading:
+            self.loop.remove_reader(self._fileno)
+            self._reading = False
+        if self._writing:
+            self.loop.remove_writer(self._fileno)
+            self._writing = False
+            # And stop KBUS trying to send our message
+            self.ksock.discard()
+        for future, how in self._receivers:
+            future.cancel()
+        for message, future in self._senders:
+            future.cancel()
+        self._receivers.clear()
+        self._senders.clear()
+
+class SendQueueFull(Exception):
+    """A SendQueue is full, and the policy for the message's name is 'error'.
+    """
+    pass
+
+class SendQueue(object):
+    """A queue of messages waiting to be sent on a Ksock.
+
+    KBUS can refuse to send a message because a recipient's queue is full.
+    If the message is marked ALL_OR_WAIT, 'send' fails with EAGAIN, and KBUS
+    carries on trying to send it (and the Ksock becomes writable when it has
+    done so). Otherwise (for instance, when a Replier's queue is full), it
+    fails with EBUSY, and the message has not been sent at all. Either way,
+    the sender must not just carry on sending.
+
+    A SendQueue sends messages straight away if it can, and otherwise
+    queues them, to be sent (in order) by a later call of 'flush'.
+
+    - 'ksock' is the Ksock to send on.
+    - 'max_depth' is the maximum number of messages that may be waiting, and
+      'max_bytes' (if given) the maximum total length of those messages.
+    - 'policies' is a dictionary of { <message_name> : <policy> }, saying
+      what to do when a message cannot be queued because the queue is full.
+      The names may be wildcards, and the most specific match is used. Any
+      name that does not match uses 'default_policy'. The policies are:
+
+      * 'error' - raise SendQueueFull
+      * 'drop_new' - throw away the message being sent
+      * 'drop_old' - throw away the oldest queued message with the same name,
+        or, if there isn't one, the message being sent
+
+    - 'retry_interval' is how long (in seconds) to wait before trying again
+      after KBUS says EBUSY. There is no way to be told when a recipient's
+      queue has room, so 'wait' just tries again after this long.
+
+    Messages that are thrown away are counted, by name, in 'dropped'.
+
+    A SendQueue may be used with 'select' or a KsockPoller - whilst
+    'waiting_for_writable' is true, 'flush' should be called when the Ksock
+    becomes writable, and whilst 'retry_at' is not None, it should be called
+    at (or after) that time.
+
+    For instance::
+
+        queue = SendQueue(ksock, max_depth=100,
+                          policies={'$.Sensor.*':'drop_old'})
+        queue.send(Announcement('$.Sensor.Temperature', '20'))
+        ...
+        queue.wait()        # to send anything still queued
+
+    Note that the Ksock should not also be sent on directly while it is
+    being used via a SendQueue.
+    """
+
+    POLICIES = ('error', 'drop_new', 'drop_old')
+
+    # How many message names we remember the policy for
+    MAX_CACHED_NAMES = 1024
+
+    def __init__(self, ksock, max_depth=1000, max_bytes=None, policies=None,
+                 default_policy='error', retry_interval=0.001):
+        if max_depth < 1:
+            raise ValueError('A SendQueue must allow at least one message,'
+                             ' not %d'%max_depth)
+        self.ksock = ksock
+        self.max_depth = max_depth
+        self.max_bytes = max_bytes
+        self.policies = {}
+        for name, policy in (policies or {}).items():
+            self.policies[name] = self._check_policy(policy)
+        self.default_policy = self._check_policy(default_policy)
+        self.retry_interval = retry_interval
+
+        # Most specific names first, as for ReplierServer
+        self._patterns = sorted(self.policies, key=_name_specificity)
+        self._policy_cache = _BoundedDict(self.MAX_CACHED_NAMES)
+
+        # The message that KBUS is still trying to send (after EAGAIN),
+        # and those we have not tried to send yet, each with its length
+        self._in_flight = None
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._retry_at = None
+        self.dropped = {}
+
+    def _check_policy(self, policy):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown SendQueue policy %r, not one of %s'%(
+                             policy, ', '.join(self.POLICIES)))
+        return policy
+
+    def __repr__(self):
+        return '<SendQueue on %r, depth %d of %d>'%(self.ksock,
+                self.depth, self.max_depth)
+
+    def __len__(self):
+        return self.depth
+
+    @property
+    def depth(self):
+        """How many messages are waiting to be sent.
+
+        This includes any message that KBUS is still trying to send.
+        """
+        return len(self._queue) + (self._in_flight is not None)
+
+    @property
+    def queued_bytes(self):
+        """The total length of the messages waiting to be sent.
+        """
+        return self._queued_bytes
+
+    @property
+    def waiting_for_writable(self):
+        """Is KBUS still trying to send a message for us?
+
+        If so, it will make our Ksock writable when it has done so.
+        """
+        return self._in_flight is not None
+
+    @property
+    def retry_at(self):
+        """When we should next try to send, after being told EBUSY.
+
+        Returns None if we are not waiting to do so.
+        """
+        return self._retry_at
+
+    def fileno(self):
+        """Return our Ksock's file descriptor, for use with 'select'.
+        """
+        return self.ksock.fileno()
+
+    def policy_for(self, name):
+        """Return the policy for message name 'name'.
+        """
+        try:
+            return self._policy_cache[name]
+        except KeyError:
+            pass
+        policy = self.default_policy
+        for pattern in self._patterns:
+            if _name_matches(pattern, name):
+                policy = self.policies[pattern]
+                break
+        return self._policy_cache.remember(name, policy)
+
+    def send(self, message):
+        """Send 'message', or queue it to be sent later.
+
+        Returns the MessageId of the message if it was sent straight away,
+        or None if it was queued (or, depending on the policy for its name,
+        thrown away because the queue was full).
+
+        If nothing is queued, the message is sent at once. Otherwise, we first
+        try to send what is already queued, so that messages are always sent
+        in order.
+
+        Raises SendQueueFull if the queue is full and the policy for the
+        message's name is 'error'. Other errors from KBUS are raised as
+        IOError, as usual.
+        """
+        if self._in_flight is not None or self._queue:
+            self.flush()
+        if self._in_flight is None and not self._queue:
+            result = self._try_send(message, message.total_length())
+            if result is not False:
+                return result
+        self._enqueue(message, message.total_length())
+        return None
+
+    def _try_send(self, message, length):
+        """Try to send 'message'.
+
+        Returns its MessageId if it was sent, None if KBUS is still trying to
+        send it, and False if it was not sent (and should be retried later).
+        """
+        try:
+            msg_id = self.ksock.send_msg(message)
+        except IOError, e:
+            if e.errno == errno.EAGAIN:
+                self._in_flight = (message, length)
+                self._queued_bytes += length
+                return None
+            elif e.errno == errno.EBUSY:
+                self._retry_at = time.time() + self.retry_interval
+                return False
+            raise
+        self._retry_at = None
+        return msg_id
+
+    def _enqueue(self, message, length):
+        while self._is_full(length):
+            policy = self.policy_for(message.name)
+            if policy == 'error':
+                raise SendQueueFull('SendQueue is full (%d messages, %d bytes),'
+                                    ' cannot queue %s'%(self.depth,
+                                    self._queued_bytes, message.name))
+            elif policy == 'drop_old' and self._drop_oldest(message.name):
+                continue
+            self._count_dropped(message.name)
+            return
+        self._queue.append((message, length))
+        self._queued_bytes += length
+
+    def _is_full(self, length):
+        if self.depth >= self.max_depth:
+            return True
+        return (self.max_bytes is not None and
+                self._queued_bytes + length > self.max_bytes)
+
+    def _drop_oldest(self, name):
+        """Throw away the oldest queued message called 'name'.
+
+        Returns False if there was no such message.
+        """
+        for index, (message, length) in enumerate(self._queue):
+            if message.name == name:
+                del self._queue[index]
+                self._queued_bytes -= length
+                self._count_dropped(name)
+                return True
+        return False
+
+    def _count_dropped(self, name):
+        self.dropped[name] = self.dropped.get(name, 0) + 1
+
+    def _in_flight_sent(self):
+        """Has KBUS finished sending our in-flight message?
+        """
+        r, w, x = select.select([], [self.ksock], [], 0)
+        return bool(w)
+
+    def flush(self):
+        """Send as many queued messages as we can, without waiting.
+
+        Returns a list of the MessageIds of the messages sent. A message
+        that KBUS had been trying to send (after EAGAIN) is included once
+        KBUS has sent it.
+
+        After KBUS has said EBUSY, queued messages are not tried again until
+        'retry_at', so calling this sooner does nothing more than check on
+        any message that KBUS is still trying to send.
+
+        If sending a queued message fails with anything other than EAGAIN or
+        EBUSY, that message is removed from the queue, and the IOError raised.
+        """
+        sent = []
+        if self._in_flight is not None:
+            if not self._in_flight_sent():
+                return sent
+            message, length = self._in_flight
+            self._in_flight = None
+            self._queued_bytes -= length
+            sent.append(self.ksock.last_msg_id())
+
+        queue = self._queue
+        retry_at = self._retry_at
+        if queue and retry_at is not None and time.time() < retry_at:
+            return sent
+        while queue:
+            message, length = queue.popleft()
+            self._queued_bytes -= length
+            result = self._try_send(message, length)
+            if result is False:
+                queue.appendleft((message, length))
+                self._queued_bytes += length
+                break
+            elif result is None:
+                break
+            sent.append(result)
+        return sent
+
+    def wait(self, timeout=None):
+        """Wait until everything queued has been sent.
+
+        Returns True if the queue is empty, False if 'timeout' (in seconds)
+        expired first.
+        """
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            self.flush()
+            if not self.depth:
+                return True
+            now = time.time()
+            if timeout is None:
+                delay = None
+            else:
+                delay = end - now
+                if delay <= 0:
+                    return False
+            if self._in_flight is not None:
+                select.select([], [self.ksock], [], delay)
+            else:
+                pause = max(0.0, (self._retry_at or now) - now)
+                if delay is not None:
+                    pause = min(pause, delay)
+                time.sleep(pause)
+
+    def discard(self):
+        """Throw away everything queued, without sending it.
+
+        If KBUS is still trying to send a message for us, stops it doing so.
+
+        Returns the number of messages thrown away (which are not counted
+        in 'dropped').
+        """
+        count = self.depth
+        if self._in_flight is not None:
+            self.ksock.discard()
+            self._in_flight = None
+        self._queue.clear()
+        self._queued_bytes = 0
+        self._retry_at = None
+        return count
+
+def _read_replier_bindings(which):
+    """Read the Replier bindings for device 'which' from /proc/kbus/bindings.
+
+    Returns a list of (name, ksock_id) tuples, most recent binding first
+    (which is the order KBUS itself keeps them in).
+    """
+    f = open('/proc/kbus/bindings')
+    try:
+        lines = f.readlines()
+    finally:
+        f.close()
+    device = '%d:'%which
+    repliers = []
+    for line in lines:
+        if line[0] == '#':
+            continue
+        dev, id, pid, rep, name = line.split()
+        if dev == device and rep == 'R':
+            repliers.append((name, int(id)))
+    return repliers
+
+class ReplierDirectory(object):
+    """Remembers who is bound as Replier to which message names.
+
+    Asking KBUS who the Replier for a name is (with Ksock.find_replier)
+    costs an ioctl each time. A ReplierDirectory reads the Replier bindings
+    once (from /proc/kbus/bindings), and then keeps them up to date from the
+    $.KBUS.ReplierBindEvent messages that KBUS sends when a Replier binds or
+    unbinds, so that looking up a name is just a dictionary lookup.
+
+    - 'ksock' is the Ksock that will receive the ReplierBindEvent messages.
+    - if 'setup' is true, then we bind 'ksock' to $.KBUS.ReplierBindEvent
+      (unless it is already bound to it), and ask KBUS to report Replier
+      binds. A LimpetKsock, for instance, does this for itself.
+    - if 'seed' is true, we read the current bindings straight away.
+
+    Whoever reads messages from 'ksock' must pass each one to
+    'handle_message' (which ignores anything that is not a
+    ReplierBindEvent). Note that when KBUS is reporting Replier binds,
+    it will not let a Replier bind (or unbind) if it cannot queue the
+    event, so 'ksock' must be read regularly.
+
+    'find_replier' follows the same rules as KBUS itself when it decides
+    who should receive a Request, and so takes account of wildcards: an
+    exact name beats a '%' wildcard, which beats a '*' wildcard, and
+    between two wildcards of the same sort, the most recent binding wins.
+
+        >>> repliers = ReplierDirectory(None, setup=False, seed=False)
+        >>> repliers.handle_event(True, 10, '$.Fred.*')
+        >>> repliers.handle_event(True, 11, '$.Fred.%')
+        >>> repliers.handle_event(True, 12, '$.Fred.Jim')
+        >>> repliers.find_replier('$.Fred.Jim'), repliers.find_replier('$.Fred.Bob')
+        (12, 11)
+        >>> print repliers.find_replier('$.Fred.Bob.William')
+        10
+        >>> repliers.handle_event(False, 11, '$.Fred.%')
+        >>> print repliers.find_replier('$.Fred.Bob')
+        10
+        >>> print repliers.find_replier('$.Jim')
+        None
+
+    Ksock.find_replier (that is, KBUS's own Replier lookup) only matches a
+    binding to exactly the name asked about. Ask for 'exact' to do the same:
+
+        >>> print repliers.find_replier('$.Fred.Bob', exact=True)
+        None
+        >>> repliers.find_replier('$.Fred.*', exact=True)
+        10
+
+    The directory is 'stale' until it has been seeded, or after
+    'invalidate' has been called (for instance, if messages may have been
+    lost), until it is next refreshed:
+
+        >>> repliers.stale
+        True
+    """
+
+    EVENT_NAME = '$.KBUS.ReplierBindEvent'
+
+    # How many wildcard lookups we remember
+    MAX_CACHED_NAMES = 1024
+
+    def __init__(self, ksock, setup=True, seed=True):
+        self.ksock = ksock
+        # Repliers bound to exact names, as { name : ksock_id }
+        self._exact = {}
+        # And to wildcards, as { pattern : (ksock_id, sequence) }, where the
+        # sequence number says how recent the binding is
+        self._wild = {}
+        self._sequence = 0
+        # Lookups of names that matched a wildcard (or nothing), remembered
+        # until the wildcard bindings change
+        self._found = _BoundedDict(self.MAX_CACHED_NAMES)
+        self._stale = True
+        self.updated_at = None
+
+        if setup:
+            if not ksock.is_bound(self.EVENT_NAME):
+                ksock.bind(self.EVENT_NAME)
+            ksock.report_replier_binds(True)
+        if seed:
+            self.refresh()
+
+    def __repr__(self):
+        return '<ReplierDirectory for %r, %d repliers%s>'%(self.ksock,
+                len(self._exact) + len(self._wild),
+                ', stale' if self._stale else '')
+
+    def __len__(self):
+        return len(self._exact) + len(self._wild)
+
+    def refresh(self):
+        """Forget what we know, and read the current bindings from KBUS.
+        """
+        bindings = _read_replier_bindings(self.ksock.which)
+        self._exact.clear()
+        self._wild.clear()
+        self._found.clear()
+        # KBUS lists the most recent binding first
+        for name, ksock_id in reversed(bindings):
+            self._remember(name, ksock_id)
+        self._stale = False
+        self.updated_at = time.time()
+
+    def invalidate(self):
+        """Mark our information as out of date, until the next 'refresh'.
+        """
+        self._stale = True
+
+    @property
+    def stale(self):
+        """True if we have not been seeded, or have been invalidated since.
+        """
+        return self._stale
+
+    @property
+    def age(self):
+        """How long (in seconds) since we last learnt anything, or None.
+        """
+        if self.updated_at is None:
+            return None
+        return time.time() - self.updated_at
+
+    def _remember(self, name, ksock_id):
+        if name.endswith('.*') or name.endswith('.%'):
+            self._sequence += 1
+            self._wild[name] = (ksock_id, self._sequence)
+            self._found.clear()
+        else:
+            self._exact[name] = ksock_id
+
+    def handle_event(self, is_bind, binder_id, name):
+        """Note that 'binder_id' has bound (or unbound) as Replier for 'name'.
+        """
+        if is_bind:
+            self._remember(name, binder_id)
+        elif name.endswith('.*') or name.endswith('.%'):
+            if self._wild.get(name, (None,))[0] == binder_id:
+                del self._wild[name]
+                self._found.clear()
+        elif self._exact.get(name) == binder_id:
+            del self._exact[name]
+        self.updated_at = time.time()
+
+    def handle_message(self, msg):
+        """Update from 'msg', if it is a ReplierBindEvent.
+
+        Returns True if it was, False if it was some other message.
+        """
+        if msg.name != self.EVENT_NAME:
+            return False
+        self.handle_event(*split_replier_bind_event_data(msg.data))
+        return True
+
+    def find_replier(self, name, exact=False):
+        """Return the id of the Replier for message name 'name', or None.
+
+        If 'exact' is true, only a binding to 'name' itself is looked for,
+        ignoring any wildcards that match it.
+        """
+        try:
+            return self._exact[name]
+        except KeyError:
+            pass
+        if exact:
+            return self._wild.get(name, (None,))[0]
+        try:
+            return self._found[name]
+        except KeyError:
+            pass
+        best = None
+        best_key = None
+        for pattern, (ksock_id, sequence) in self._wild.items():
+            if _name_matches(pattern, name):
+                key = (_name_specificity(pattern)[0], -sequence)
+                if best_key is None or key < best_key:
+                    best, best_key = ksock_id, key
+        return self._found.remember(name, best)
+
+    def repliers(self):
+        """Return a dictionary of { <name> : <replier_id> } for all bindings.
+        """
+        result = dict(self._exact)
+        for pattern, (ksock_id, sequence) in self._wild.items():
+            result[pattern] = ksock_id
+        return result
+
 def read_bindings(names):
     """Read the bindings from /proc/kbus/bindings, and return a list
 
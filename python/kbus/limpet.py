@@ -30,7 +30,7 @@ either on the same machine or over a network.
 #
 # ***** END LICENSE BLOCK *****
 
-import ctypes
+import collections
 import errno
 import os
 import select
@@ -38,14 +38,12 @@ import socket
 import struct
 import sys
 
-from socket import ntohl, htonl
-
-from kbus import Ksock, Message, Reply, MessageId, OrigFrom
-from kbus.messages import _MessageHeaderStruct, _ReplierBindEventHeader, \
-        message_from_parts, _struct_from_bytes, _struct_to_bytes, \
+from kbus import Ksock, Message, Reply, MessageId, OrigFrom, ReplierDirectory
+from kbus.messages import _MessageHeaderStruct, message_from_parts, \
         split_replier_bind_event_data, \
         calc_padded_name_len, calc_padded_data_len, calc_entire_message_len, \
-        MSG_HEADER_LEN
+        _encode_entire_message, _clone_message, MSG_HEADER_LEN, \
+        _MSG_HEADER_STRUCT, _HDR_END_GUARD, _REPLIER_BIND_EVENT_HEADER
 
 class GiveUp(Exception):
     pass
@@ -74,7 +72,13 @@ class BadMessage(Exception):
     pass
 
 _SERIALISED_MESSAGE_HEADER_LEN = 16
-_SerialisedMessageHeaderType = ctypes.c_uint32 * _SERIALISED_MESSAGE_HEADER_LEN
+
+# A message header as we send it over the network: the header fields, in
+# network order, without the name and data pointers
+_NETWORK_HEADER_STRUCT = struct.Struct('!%dL'%_SERIALISED_MESSAGE_HEADER_LEN)
+
+# And a ReplierBindEvent's data header, likewise
+_NETWORK_REPLIER_BIND_EVENT_HEADER = struct.Struct('!3L')
 
 class LimpetKsock(Ksock):
     """A Limpet proxies KBUS messages to/from another Limpet.
@@ -168,6 +172,10 @@ class LimpetKsock(Ksock):
 
             # And ask KBUS to *send* such messages
             super(LimpetKsock, self).report_replier_binds(True)
+
+            # Which lets us keep track of who is bound as Replier, without
+            # having to ask KBUS each time we want to know
+            self.repliers = ReplierDirectory(self, setup=False)
         except:
             self.close()
             raise
@@ -296,8 +304,9 @@ class LimpetKsock(Ksock):
         if message is None:
             return None
 
-        print '>>> message %s'%message
-        print '>>> termina %s'%self.termination_message
+        if self.verbosity > 1:
+            print '%u ---------------------- Message from KBUS'%self.network_id
+            print '%u %s'%(self.network_id,message)
 
         if message.name == self.termination_message:
             raise GiveUp('Received termination message %s to %s'%(
@@ -399,6 +408,7 @@ class LimpetKsock(Ksock):
             # If this is the result of *us* binding as a replier (by proxy),
             # then we do *not* want to send it to the other Limpet!
             is_bind, binder_id, name = split_replier_bind_event_data(msg.data)
+            self.repliers.handle_event(is_bind, binder_id, name)
             if binder_id == self._ksock_id:
                 if self.verbosity > 1:
                     print '%s Which is us -- ignore'%(spaces_hdr)
@@ -407,9 +417,8 @@ class LimpetKsock(Ksock):
         if msg.is_request() and msg.wants_us_to_reply():
             # Remember the details of this Request for when we get a Reply
             # (Note that the message id itself is not suitable as a key,
-            # as it is not immutable, and does not have a __hash__ method)
-            key = (msg._id.network_id, msg._id.serial_num)
-            self.our_requests[key] = (msg.from_, msg.to)
+            # as it is not immutable, so we use a frozen copy)
+            self.our_requests[msg._id.frozen()] = (msg.from_, msg.to)
 
         if msg._id.network_id == self.other_network_id:
             # This is a message that originated with our pair Limpet (so it's
@@ -437,7 +446,7 @@ class LimpetKsock(Ksock):
             msg._in_reply_to.network_id = 0
 
         # Look up the original Request and amend appropriately
-        key = (msg._in_reply_to.network_id, msg._in_reply_to.serial_num)
+        key = msg._in_reply_to.frozen()
         try:
             from_, to = self.our_requests[key]
             del self.our_requests[key]          # we shouldn't see it again
@@ -446,10 +455,11 @@ class LimpetKsock(Ksock):
             # since we still need to send it on anyway.
 
             # The simplest thing to do is just to create a new Reply
-            # with the correct details
-            msg = Reply(msg.name, data=msg.data,
-                        in_reply_to=MessageId(key[0],key[1]),
-                        to=from_, orig_from=msg.orig_from)
+            # with the correct details - copying the message and amending
+            # its header is cheaper than building it again from scratch
+            msg = _clone_message(msg, Reply, in_reply_to=key,
+                                 to=from_, from_=0, final_to=(0,0),
+                                 flags=0, id=(0,0))
         except KeyError:
             # We already dealt with this Reply once, so this should not
             # happen (remember, we asked for only one copy of each message)
@@ -484,8 +494,19 @@ class LimpetKsock(Ksock):
         else:
             is_local = False
 
-        # Find out who KBUS thinks is replying to this message name
-        replier_id = self.find_replier(msg.name)
+        # Find out who KBUS thinks is replying to this message name. As
+        # with KBUS's own find_replier, only a binding to the name itself
+        # counts - not a wildcard that happens to match it
+        if self.repliers.stale:
+            # We may have missed some ReplierBindEvents, so don't trust it
+            if self.verbosity > 1:
+                print '%s *** Replier directory is stale - asking KBUS'%hdr
+            replier_id = None
+        else:
+            replier_id = self.repliers.find_replier(msg.name, exact=True)
+        if replier_id is None:
+            # We may not have read the ReplierBindEvent yet, so ask KBUS
+            replier_id = self.find_replier(msg.name)
         if replier_id is None:
             # Oh dear - there is no replier
             if self.verbosity > 1:
@@ -589,11 +610,13 @@ class LimpetKsock(Ksock):
                     print '%s BIND "%s'%(spaces_hdr,name)
                 super(LimpetKsock, self).bind(name, True)
                 self.replier_for[name] = binder_id
+                self.repliers.handle_event(True, self._ksock_id, name)
             else:
                 if self.verbosity > 1:
                     print '%s UNBIND "%s'%(spaces_hdr,name)
                 super(LimpetKsock, self).unbind(name, True)
                 del self.replier_for[name]
+                self.repliers.handle_event(False, self._ksock_id, name)
             return None
 
         if msg.is_reply():                   # a Reply (or Status)
@@ -634,7 +657,8 @@ class LimpetKsock(Ksock):
         # can do anything useful...
         #
         # XXX TODO
-        print '%u send_msg: %s -- continuing'%(self.network_id, exc)
+        if self.verbosity:
+            print '%u send_msg: %s -- continuing'%(self.network_id, exc)
         return None
 
 
@@ -643,73 +667,376 @@ def serialise_message_header(msg):
 
     Does not touch the message data in any way.
 
-    Returns the serialised array. Note that this omits the name pointer and
-    data pointer fields.
+    Returns the serialised header, as a string of 16 integers in network
+    order. Note that this omits the name pointer and data pointer fields
+    (there's no point in sending them - since we must be sending an "entire"
+    message, they must be NULL, and anyway they're pointers...)
+
+        >>> hdr = serialise_message_header(Message('$.Fred', 'data', to=3))
+        >>> len(hdr)
+        64
+        >>> name_len, data_len, array = unserialise_message_header(hdr)
+        >>> name_len, data_len, array[5]
+        (6, 4, 3)
     """
-    array = _SerialisedMessageHeaderType()
-    array[0]  = msg.msg.start_guard
-    array[1]  = msg.msg.id.network_id
-    array[2]  = msg.msg.id.serial_num
-    array[3]  = msg.msg.in_reply_to.network_id
-    array[4]  = msg.msg.in_reply_to.serial_num
-    array[5]  = msg.msg.to
-    array[6]  = msg.msg.from_
-    array[7]  = msg.msg.orig_from.network_id
-    array[8]  = msg.msg.orig_from.local_id
-    array[9]  = msg.msg.final_to.network_id
-    array[10] = msg.msg.final_to.local_id
-    array[11] = msg.msg.extra                # to save adding it in the future
-    array[12] = msg.msg.flags
-    array[13] = msg.msg.name_len
-    array[14] = msg.msg.data_len
-    # There's no point in sending the name and data pointers - since we must
-    # be sending an "entire" message, they must be NULL, and anyway they're
-    # pointers...
-    array[15] = msg.msg.end_guard
-
-    for ii, item in enumerate(array):
-        array[ii] = htonl(item)
-
-    return array
-
-def unserialise_message_header(data):
+    # An "entire" message in a bytearray keeps its header at the start of
+    # that, and otherwise the message (or its header) is a ctypes structure.
+    # Either way, we can unpack the header fields straight from its memory
+    msg = msg.msg
+    fields = _MSG_HEADER_STRUCT.unpack_from(getattr(msg, 'buf', msg))
+    return _NETWORK_HEADER_STRUCT.pack(*(fields[:15] + fields[_HDR_END_GUARD:]))
+
+def unserialise_message_header(data, offset=0):
     """Unserialise a message header from integers read from the network.
 
-    This should be an array equivalent to that returned by
-    serialise_message_header() (in particular, omitting the name and data
-    pointer fields).
+    This should be equivalent to that returned by serialise_message_header()
+    (in particular, omitting the name and data pointer fields). It is read
+    from 'data' (a string or other buffer), starting at 'offset'.
 
-    Returns (name_len, data_len, array)
+    Returns (name_len, data_len, array), where 'array' is a tuple of the 16
+    integers.
     """
-    array = _struct_from_bytes(_SerialisedMessageHeaderType, data)
-    for ii, item in enumerate(array):
-        array[ii] = ntohl(array[ii])
+    array = _NETWORK_HEADER_STRUCT.unpack_from(data, offset)
     return array[13], array[14], array
 
+_END_GUARD_BYTES = struct.pack('!L', Message.END_GUARD)
+
+# The socket families for which a stream socket is a TCP socket
+_TCP_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+def serialise_message(msg):
+    """Serialise an entire message for writing to the network.
+
+    That is, its header (as from serialise_message_header()), its name and
+    data (each padded as KBUS would), and a final end guard, all in one
+    string, so that it can be written with a single call.
+
+    The integers in the data of a ReplierBindEvent are converted to network
+    order.
+
+    This gives the same bytes as writing each part separately:
+
+        >>> msg = Message('$.Fred', 'abcde', to=3)
+        >>> parts = [serialise_message_header(msg),
+        ...          '$.Fred', '\\0\\0',
+        ...          'abcde', '\\0\\0\\0',
+        ...          struct.pack('!L', Message.END_GUARD)]
+        >>> serialise_message(msg) == ''.join(parts)
+        True
+
+    and a message with no data has no data part at all:
+
+        >>> msg = Message('$.Jim')
+        >>> serialise_message(msg) == (serialise_message_header(msg) +
+        ...         '$.Jim\\0\\0\\0' + struct.pack('!L', Message.END_GUARD))
+        True
+    """
+    if msg.name == '$.KBUS.ReplierBindEvent':
+        data = convert_ReplierBindEvent_data_to_network(msg.data)
+        msg = Message.from_message(msg, data=data)
+
+    name = msg.name
+    parts = [serialise_message_header(msg), name,
+             '\0'*(calc_padded_name_len(msg.msg.name_len) - len(name))]
+    if msg.msg.data_len:
+        data = msg.data
+        parts.append(data)
+        parts.append('\0'*(calc_padded_data_len(msg.msg.data_len) - len(data)))
+    parts.append(_END_GUARD_BYTES)
+    return ''.join(parts)
+
+def configure_socket(sock, nodelay=True, sndbuf=None):
+    """Set the options we care about on the socket to another Limpet.
+
+    - if nodelay is true, and this is a TCP socket, turn off Nagle's
+      algorithm (TCP_NODELAY), so that each message is sent as soon as it is
+      written, rather than waiting to see if there is more to send with it.
+      If it is None, the option is left as it is.
+    - if sndbuf is not None, it is the size of the socket's send buffer
+      (SO_SNDBUF) to ask for.
+
+    For instance, a Unix domain socket just gets its send buffer set:
+
+        >>> ours, theirs = socket.socketpair()
+        >>> configure_socket(ours, nodelay=True, sndbuf=65536)
+        >>> ours.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536
+        True
+        >>> ours.close(); theirs.close()
+
+    whilst a TCP socket also has Nagle's algorithm turned off:
+
+        >>> listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        >>> listener.bind(('127.0.0.1', 0))
+        >>> listener.listen(1)
+        >>> ours = socket.create_connection(listener.getsockname())
+        >>> configure_socket(ours)
+        >>> ours.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) != 0
+        True
+        >>> configure_socket(ours, nodelay=False)
+        >>> ours.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        0
+        >>> ours.close(); listener.close()
+    """
+    if nodelay is not None and sock.type == socket.SOCK_STREAM and \
+            sock.family in _TCP_FAMILIES:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                        1 if nodelay else 0)
+    if sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
 def convert_ReplierBindEvent_data_from_network(data, data_len):
     """Given the data for a ReplierBindEvent, convert it from network order.
 
     Returns a new version of the data, converted.
     """
-    hdr = _struct_from_bytes(_ReplierBindEventHeader, data[:data_len])
-    hdr.is_bind  = ntohl(hdr.is_bind)
-    hdr.binder   = ntohl(hdr.binder)
-    hdr.name_len = ntohl(hdr.name_len)
-    rest = data[ctypes.sizeof(_ReplierBindEventHeader):data_len]
-    return _struct_to_bytes(hdr)+rest
+    size = _REPLIER_BIND_EVENT_HEADER.size
+    return _REPLIER_BIND_EVENT_HEADER.pack(
+            *_NETWORK_REPLIER_BIND_EVENT_HEADER.unpack_from(data)) + \
+            data[size:data_len]
 
 def convert_ReplierBindEvent_data_to_network(data):
     """Given the data for a ReplierBindEvent, convert it to network order.
 
     Returns a new version of the data, converted.
+
+        >>> data = _REPLIER_BIND_EVENT_HEADER.pack(1, 27, 6) + '$.Fred\\0\\0'
+        >>> network = convert_ReplierBindEvent_data_to_network(data)
+        >>> network[:12] == struct.pack('!3L', 1, 27, 6)
+        True
+        >>> convert_ReplierBindEvent_data_from_network(network, len(network)) == data
+        True
+    """
+    size = _REPLIER_BIND_EVENT_HEADER.size
+    return _NETWORK_REPLIER_BIND_EVENT_HEADER.pack(
+            *_REPLIER_BIND_EVENT_HEADER.unpack_from(data)) + data[size:]
+
+def _message_from_network(array, name, data):
+    """Build a Message from the parts of a frame read from the other Limpet.
+
+    'array' is the unserialised header, and 'name' and 'data' are exactly
+    the name and data (without padding), 'data' being None if there isn't
+    any.
+    """
+    # We know enough to sort out the network order of the integers in
+    # the Replier Bind Event's data
+    if name == '$.KBUS.ReplierBindEvent':
+        data = convert_ReplierBindEvent_data_from_network(data, len(data))
+
+    # Rather than building the message up field by field, pack it
+    # straight into the form KBUS itself would give us
+    return Message.from_bytes(_encode_entire_message(
+                                (array[1], array[2]), (array[3], array[4]),
+                                array[5], array[6],
+                                (array[7], array[8]), (array[9], array[10]),
+                                array[12], name, data))
+
+class LimpetFrameReader(object):
+    """Reads messages from the other Limpet, a buffer at a time.
+
+    Rather than reading each field of each message with its own call of
+    'recv', we read as much as the socket has for us into a buffer (with
+    'recv_into'), and then take as many complete messages out of that as
+    there are. What is left of a partial message stays in the buffer until
+    the rest of it arrives.
+
+    - sock is the socket to the other Limpet.
+    - buffer_size is the initial size of our buffer. It is grown if a
+      single message will not fit into it.
+
+    For instance, given a socket with two messages and the start of a third
+    waiting, a single read gets us the first two:
+
+        >>> import socket
+        >>> ours, theirs = socket.socketpair()
+        >>> third = serialise_message(Message('$.Bob', 'three'))
+        >>> theirs.sendall(serialise_message(Message('$.Fred', 'one')) +
+        ...                serialise_message(Message('$.Jim', 'two')) +
+        ...                third[:10])
+        >>> reader = LimpetFrameReader(ours)
+        >>> [(msg.name, msg.data) for msg in reader.read_available()]
+        [('$.Fred', 'one'), ('$.Jim', 'two')]
+
+    and the third when the rest of it arrives:
+
+        >>> theirs.sendall(third[10:])
+        >>> [(msg.name, msg.data) for msg in reader.read_available()]
+        [('$.Bob', 'three')]
+        >>> theirs.close()
+        >>> reader.read_available()
+        Traceback (most recent call last):
+        ...
+        OtherLimpetGoneAway
+        >>> ours.close()
+
+    When we run out of room, a partial message is moved back to the start of
+    the buffer, even if that overlaps where it was:
+
+        >>> ours, theirs = socket.socketpair()
+        >>> reader = LimpetFrameReader(ours, buffer_size=16384)
+        >>> big = serialise_message(Message('$.Big', 'x'*6000 + 'y'*7000))
+        >>> theirs.sendall(serialise_message(Message('$.Small', 's'*1900)) +
+        ...                big[:12000])
+        >>> [msg.name for msg in reader.read_available()]
+        ['$.Small']
+        >>> theirs.sendall(big[12000:])
+        >>> [msg.data == 'x'*6000 + 'y'*7000 for msg in reader.read_available()]
+        [True]
+        >>> len(reader._buf)
+        16384
+        >>> ours.close(); theirs.close()
     """
-    hdr = _struct_from_bytes(_ReplierBindEventHeader, data)
-    hdr.is_bind  = htonl(hdr.is_bind)
-    hdr.binder   = htonl(hdr.binder)
-    hdr.name_len = htonl(hdr.name_len)
-    rest = data[ctypes.sizeof(_ReplierBindEventHeader):]
-    return _struct_to_bytes(hdr)+rest
 
+    # Don't bother reading unless we can read at least this much
+    MIN_READ = 4096
+
+    def __init__(self, sock, buffer_size=65536):
+        self.sock = sock
+        self._buf = bytearray(max(buffer_size, self.MIN_READ))
+        self._view = memoryview(self._buf)
+        # The unparsed data is self._buf[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # How long the message at self._start is, if we know
+        self._frame_len = None
+        self._header = None
+        # Messages we have parsed, but not yet returned
+        self._parsed = collections.deque()
+
+    def __repr__(self):
+        return '<LimpetFrameReader on %s, %d bytes unparsed>'%(self.sock,
+                self._end - self._start)
+
+    @property
+    def pending(self):
+        """How many messages we have read, but not yet returned.
+
+        These will be returned by the next 'read_available' or
+        'read_message' without reading from the socket - so check this
+        before waiting for the socket to be readable.
+        """
+        return len(self._parsed)
+
+    def _make_room(self):
+        """Make sure there is room to read more data into our buffer.
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+        size = len(self._buf)
+        wanted = max(self.MIN_READ, self._frame_len or 0)
+        if size - self._end >= self.MIN_READ and \
+                size - self._start >= wanted:
+            return
+        # Move what we've got to the start of the buffer, growing it if
+        # we need more room for the message we're part way through
+        unparsed = self._end - self._start
+        while size - unparsed < self.MIN_READ or size < wanted:
+            size *= 2
+        if size != len(self._buf):
+            new = bytearray(size)
+            new[:unparsed] = self._view[self._start:self._end]
+            self._buf = new
+            self._view = memoryview(new)
+        else:
+            # The old and new places may overlap, so copy it out first
+            self._buf[:unparsed] = self._view[self._start:self._end].tobytes()
+        self._start = 0
+        self._end = unparsed
+
+    def fill(self):
+        """Read whatever the socket has for us (blocking if it has nothing).
+
+        Returns the number of bytes read.
+
+        Raises OtherLimpetGoneAway if the other end has closed the socket.
+        """
+        self._make_room()
+        count = self.sock.recv_into(self._view[self._end:])
+        if count == 0:
+            raise OtherLimpetGoneAway()
+        self._end += count
+        return count
+
+    def _parse(self):
+        """Parse the complete messages in our buffer.
+        """
+        messages = self._parsed
+        buf = self._buf
+        header_len = _SERIALISED_MESSAGE_HEADER_LEN*4
+        while True:
+            start = self._start
+            available = self._end - start
+            if self._frame_len is None:
+                if available < header_len:
+                    break
+                name_len, data_len, array = unserialise_message_header(buf,
+                                                                       start)
+                if array[0] != Message.START_GUARD:
+                    raise GiveUp('Message data start guard is %08x,'
+                                 ' not %08x'%(array[0],Message.START_GUARD))
+                if array[-1] != Message.END_GUARD:
+                    raise GiveUp('Message data end guard is %08x,'
+                                 ' not %08x'%(array[-1],Message.END_GUARD))
+                frame_len = header_len + calc_padded_name_len(name_len) + 4
+                if data_len:
+                    frame_len += calc_padded_data_len(data_len)
+                self._header = (name_len, data_len, array)
+                self._frame_len = frame_len
+            if available < self._frame_len:
+                break
+
+            name_len, data_len, array = self._header
+            end = start + self._frame_len
+            end_guard = struct.unpack_from('!L', buf, end - 4)[0]
+            if end_guard != Message.END_GUARD:
+                raise GiveUp('Final message data end guard is %08x,'
+                             ' not %08x'%(end_guard,Message.END_GUARD))
+            name_start = start + header_len
+            name = str(buf[name_start:name_start+name_len])
+            if data_len:
+                data_start = name_start + calc_padded_name_len(name_len)
+                data = str(buf[data_start:data_start+data_len])
+            else:
+                data = None
+            messages.append(_message_from_network(array, name, data))
+            self._start = end
+            self._frame_len = self._header = None
+
+    def read_available(self, max_count=None):
+        """Return a list of the complete messages we have.
+
+        If we have none waiting, this does a single call of 'recv_into'
+        (which will block if the socket has nothing for us), and so may
+        return an empty list if we still have only part of a message.
+
+        If 'max_count' is given, at most that many messages are returned,
+        and any others are kept for the next call (see 'pending').
+
+        Raises OtherLimpetGoneAway if the other end has closed the socket.
+        """
+        parsed = self._parsed
+        if not parsed:
+            self.fill()
+            self._parse()
+        if max_count is None or max_count >= len(parsed):
+            messages = list(parsed)
+            parsed.clear()
+        else:
+            popleft = parsed.popleft
+            messages = [popleft() for ii in xrange(max_count)]
+        return messages
+
+    def read_message(self):
+        """Read a single message, blocking until it has all arrived.
+
+        Any further messages already read are kept for the next call (of this
+        or 'read_available').
+
+        Raises OtherLimpetGoneAway if the other end has closed the socket.
+        """
+        while not self._parsed:
+            self.fill()
+            self._parse()
+        return self._parsed.popleft()
 
 class LimpetExample(object):
     """A Limpet proxies KBUS messages to/from another Limpet.
@@ -736,7 +1063,7 @@ class LimpetExample(object):
     """
 
     def __init__(self, which, sock, network_id, message_name='$.*', verbosity=1,
-                 termination_message=None):
+                 termination_message=None, nodelay=True, sndbuf=None):
         """A Limpet has two "ends":
 
         1. 'which' specifies which KBUS device it should communicate
@@ -759,12 +1086,15 @@ class LimpetExample(object):
           information about each message as it is processed.
         - if termination_message is non-None, then when we read this message,
           the reading method will raise GiveUp.
+        - nodelay and sndbuf are the TCP_NODELAY and SO_SNDBUF settings for
+          the socket, as for configure_socket().
         """
         if network_id < 1:
             raise ValueError('Limpet network id must be > 0, not %d'%network_id)
 
         self.sock = sock
         self.verbosity = verbosity
+        configure_socket(sock, nodelay, sndbuf)
 
         # We don't know the network id of our Limpet pair yet
         self.other_network_id = None
@@ -793,6 +1123,9 @@ class LimpetExample(object):
         if self.verbosity > 1:
             print 'Other Limpet has network id',other_network_id
 
+        # From now on, we read whole messages (as many as we can at once)
+        self.reader = LimpetFrameReader(sock)
+
         self.wrapper = LimpetKsock(which, network_id, other_network_id,
                                    message_name, verbosity, termination_message)
         self.ksock_id = self.wrapper.ksock_id()
@@ -847,125 +1180,109 @@ class LimpetExample(object):
 
         Returns the corresponding Message instance.
         """
-
-        # First, read the message header
-        header = self.sock.recv(_SERIALISED_MESSAGE_HEADER_LEN*4,
-                                socket.MSG_WAITALL)
-        if header == '':
-            raise OtherLimpetGoneAway()
-
-        name_len, data_len, array = unserialise_message_header(header)
-
-        if array[0] != Message.START_GUARD:
-            raise GiveUp('Message data start guard is %08x,'
-                         ' not %08x'%(array[0],Message.START_GUARD))
-
-        if array[-1] != Message.END_GUARD:
-            raise GiveUp('Message data end guard is %08x,'
-                         ' not %08x'%(array[-1],Message.END_GUARD))
-
-        name = self.sock.recv(calc_padded_name_len(name_len),
-                              socket.MSG_WAITALL)
-        if name == '':
-            raise OtherLimpetGoneAway()
-
-        if data_len:
-            data = self.sock.recv(calc_padded_data_len(data_len),
-                                  socket.MSG_WAITALL)
-            if data == '':
-                raise OtherLimpetGoneAway()
-        else:
-            data = None
-
-        end = self.sock.recv(4, socket.MSG_WAITALL)
-        #value = struct.unpack('!L', end)   # unsigned long, network order
-        #end = ntohl(value[0])
-        end = struct.unpack('!L', end)[0]   # unsigned long, network order
-        if end != Message.END_GUARD:
-            raise GiveUp('Final message data end guard is %08x,'
-                         ' not %08x'%(end,Message.END_GUARD))
-
-        # We know enough to sort out the network order of the integers in
-        # the Replier Bind Event's data
-        if name[:name_len] == '$.KBUS.ReplierBindEvent':
-            data = convert_ReplierBindEvent_data_from_network(data, data_len)
-        
-        return Message(name[:name_len],
-                       data=data[:data_len] if data else None,
-                       id=MessageId(array[1],array[2]),
-                       in_reply_to=MessageId(array[3],array[4]),
-                       to=array[5], from_=array[6],
-                       orig_from=OrigFrom(array[7],array[8]),
-                       final_to=OrigFrom(array[9],array[10]),
-                       flags=array[12])
+        return self.reader.read_message()
 
     def write_message_to_other_limpet(self, msg):
         """Write a Message to the other Limpet.
-        """
-        # We know enough to sort out the network order of the integers in
-        # the Replier Bind Event's data
-        if msg.name == '$.KBUS.ReplierBindEvent':
-            data = convert_ReplierBindEvent_data_to_network(msg.data)
-            msg = Message.from_message(msg, data=data)
-
-        header = serialise_message_header(msg)
-        self.sock.sendall(header)
 
-        self.sock.sendall(msg.name)
-        padded_name_len = calc_padded_name_len(msg.msg.name_len)
-        if len(msg.name) != padded_name_len:
-            self.sock.sendall('\0'*(padded_name_len - len(msg.name)))
+        The whole message is written with a single call, so that (especially
+        with TCP_NODELAY) it does not get split into several packets.
+        """
+        self.sock.sendall(serialise_message(msg))
 
-        if msg.msg.data_len:
-            self.sock.sendall(msg.data)
-            padded_data_len = calc_padded_data_len(msg.msg.data_len)
-            if len(msg.data) != padded_data_len:
-                self.sock.sendall('\0'*(padded_data_len - len(msg.data)))
+    def _messages_from_kbus(self, budget):
+        """Forward up to 'budget' of the messages waiting on KBUS.
 
-        ##end_guard = struct.pack('!L', header[-1])
-        end_guard = struct.pack('!L', Message.END_GUARD)
-        self.sock.sendall(end_guard)       # end guard again
+        The messages are sent to the other Limpet with a single 'sendall'.
 
-    def run_forever(self):
+        Returns True if there were more messages waiting than that.
+        """
+        wrapper = self.wrapper
+        # Any held messages are read first, and KBUS doesn't count them
+        waiting = wrapper.num_held() + wrapper.num_messages()
+        frames = []
+        try:
+            for ii in xrange(min(waiting, budget)):
+                msg = wrapper.read_next_msg()
+                if msg is not None:
+                    frames.append(serialise_message(msg))
+        except:
+            # Even if we're giving up (for instance, on reading the
+            # termination message), pass on what we've already read - but
+            # it's the original exception that matters
+            exc_info = sys.exc_info()
+            if frames:
+                try:
+                    self.sock.sendall(''.join(frames))
+                except socket.error:
+                    pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if frames:
+            self.sock.sendall(''.join(frames))
+        return waiting > budget
+
+    def _messages_from_other_limpet(self, budget):
+        """Send up to 'budget' messages from the other Limpet to KBUS.
+
+        Returns False if we should stop running.
+        """
+        wrapper = self.wrapper
+        for msg in self.reader.read_available(budget):
+            if self.verbosity > 1:
+                print '%u ---------------------- Message from other Limpet'% \
+                        wrapper.network_id
+                print '%u %s'%(wrapper.network_id,msg)
+            try:
+                msg_id = wrapper.send_msg(msg)
+                if self.verbosity > 1:
+                    print '%u msg_id %s'%(wrapper.network_id,msg_id)
+            except NoMessage as exc:
+                # It turned out to be a message we should ignore - do so
+                if self.verbosity > 1:
+                    print '%u IGNORED %s'%(wrapper.network_id,msg)
+            except ErrorMessage as exc:
+                self.write_message_to_other_limpet(exc.error)
+            except IOError as exc:
+                error = wrapper.could_not_send_to_kbus_msg(msg, exc)
+                if error is not None:
+                    self.write_message_to_other_limpet(error)
+                    return False
+        return True
+
+    def run_forever(self, kbus_budget=64, socket_budget=64):
         """Or until we're interrupted, or read the termination message from KBUS.
 
+        Each time we wake up, we forward up to 'kbus_budget' messages from
+        KBUS, and up to 'socket_budget' messages from the other Limpet, so
+        that a burst in one direction cannot hold up the other. If either
+        direction still has messages left over, we just check (without
+        waiting) for anything new before carrying on with them.
+
         If an exception is raised, then the Limpet is closed as the method
         is exited.
         """
+        wrapper = self.wrapper
+        reader = self.reader
+        more_from_kbus = False
         try:
             while 1:
-                # Wait for a message written to us, with no timeout
-                # (at least for the moment)
-                (r, w, x) = select.select( [self.wrapper, self.sock], [], [])
+                if more_from_kbus or reader.pending:
+                    timeout = 0
+                else:
+                    # Wait for a message written to us, with no timeout
+                    # (at least for the moment)
+                    timeout = None
+                (r, w, x) = select.select( [wrapper, self.sock], [], [], timeout)
 
                 if self.verbosity > 1:
                     print
 
-                if self.wrapper in r:
-                    print '%u ---------------------- Message from KBUS'% \
-                            self.wrapper.network_id
-                    msg = self.wrapper.read_next_msg()
-                    if msg is not None:
-                        self.write_message_to_other_limpet(msg)
-
-                if self.sock in r:
-                    print '%u ---------------------- Message from other Limpet'% \
-                            self.wrapper.network_id
-                    msg = self.read_message_from_other_limpet()
-                    print '%u %s'%(self.wrapper.network_id,msg)
-                    try:
-                        msg_id = self.wrapper.send_msg(msg)
-                        print '%u msg_id %s'%(self.wrapper.network_id,msg_id)
-                    except NoMessage as exc:
-                        # It turned out to be a message we should ignore - do so
-                        print '%u IGNORED %s'%(self.wrapper.network_id,msg)
-                    except ErrorMessage as exc:
-                        self.write_message_to_other_limpet(exc.error)
-                    except IOError as exc:
-                        error = self.wrapper.could_not_send_to_kbus_msg(msg, exc)
-                        if error is not None:
-                            self.write_message_to_other_limpet(error)
-                            return
+                if more_from_kbus or wrapper in r:
+                    more_from_kbus = self._messages_from_kbus(kbus_budget)
+
+                if reader.pending or self.sock in r:
+                    if not self._messages_from_other_limpet(socket_budget):
+                        return
         finally:
             self.close()
 
@@ -1038,7 +1355,8 @@ def remove_socket_file(name):
         raise GiveUp('Unable to delete socket file "%s": %s'%(name, err))
 
 def run_a_limpet(is_server, address, family, kbus_device, network_id,
-                 message_name='$.*', termination_message=None, verbosity=1):
+                 message_name='$.*', termination_message=None, verbosity=1,
+                 nodelay=True, sndbuf=None):
     """Run a Limpet.
 
     A Limpet has two "ends":
@@ -1073,6 +1391,8 @@ def run_a_limpet(is_server, address, family, kbus_device, network_id,
     - if verbosity is 0, we don't output any "useful" messages, if it is
       1 we just announce ourselves, if it is 2 (or higher) we output
       information about each message as it is processed.
+    - nodelay and sndbuf are the TCP_NODELAY and SO_SNDBUF settings for
+      the socket, as for configure_socket().
     """
     if family not in (socket.AF_UNIX, socket.AF_INET):
         raise ValueError('Socket family is %d, must be AF_UNIX (%s) or'
@@ -1091,7 +1411,7 @@ def run_a_limpet(is_server, address, family, kbus_device, network_id,
     try:
         # The proposed new mechanism
         with LimpetExample(kbus_device, sock, network_id, message_name, verbosity,
-                     termination_message) as l:
+                     termination_message, nodelay, sndbuf) as l:
             if verbosity:
                 print l
                 if termination_message:
@@ -37,8 +37,10 @@ it is likely enough not to do this, as the "user" will be root.
 # ***** END LICENSE BLOCK *****
 
 from __future__ import with_statement
+import collections
 import ctypes
 import array
+import operator
 import string
 import struct
 
@@ -119,6 +121,13 @@ class MessageId(ctypes.Structure):
         else:
             return MessageId(self.network_id, self.serial_num+other)
 
+    def frozen(self):
+        """Return an immutable (and hashable) copy of this message id.
+
+        See FrozenMessageId.
+        """
+        return FrozenMessageId(self.network_id, self.serial_num)
+
 class OrigFrom(ctypes.Structure):
     """A wrapper around a message's "struct kbus_orig_from" field.
 
@@ -161,6 +170,107 @@ class OrigFrom(ctypes.Structure):
         else:
             return 1
 
+    def frozen(self):
+        """Return an immutable (and hashable) copy of this value.
+
+        See FrozenOrigFrom.
+        """
+        return FrozenOrigFrom(self.network_id, self.local_id)
+
+class FrozenMessageId(tuple):
+    """An immutable, and thus hashable, message id.
+
+    MessageId is a ctypes structure, so that it can be used inside a message
+    header, which means it can be changed, and cannot sensibly be hashed.
+    A FrozenMessageId is a (compact) tuple of the network id and serial
+    number, and so can be used as a dictionary key or set member:
+
+        >>> a = MessageId(1, 2).frozen()
+        >>> a
+        FrozenMessageId(1, 2)
+        >>> a.network_id == 1 and a.serial_num == 2
+        True
+        >>> requests = {a:'something'}
+        >>> requests[FrozenMessageId(1, 2)]
+        'something'
+        >>> a.network_id = 3
+        Traceback (most recent call last):
+        ...
+        AttributeError: can't set attribute
+
+    and it can be turned back into a MessageId:
+
+        >>> a.thaw()
+        MessageId(1, 2)
+        >>> MessageId(*a)
+        MessageId(1, 2)
+
+    Comparisons work in the same manner as for MessageId:
+
+        >>> a < FrozenMessageId(2, 2) and a < FrozenMessageId(1, 3)
+        True
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, network_id, serial_num):
+        return tuple.__new__(cls, (network_id, serial_num))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    network_id = property(operator.itemgetter(0))
+    serial_num = property(operator.itemgetter(1))
+
+    def __repr__(self):
+        return 'FrozenMessageId(%u, %u)'%self
+
+    def __str__(self):
+        return '[%u:%u]'%self
+
+    def thaw(self):
+        """Return a MessageId with the same value.
+        """
+        return MessageId(self[0], self[1])
+
+class FrozenOrigFrom(tuple):
+    """An immutable, and thus hashable, "struct kbus_orig_from" value.
+
+    This is to OrigFrom as FrozenMessageId is to MessageId:
+
+        >>> a = OrigFrom(1, 2).frozen()
+        >>> a
+        FrozenOrigFrom(1, 2)
+        >>> a.network_id == 1 and a.local_id == 2
+        True
+        >>> a in set([FrozenOrigFrom(1, 2)])
+        True
+        >>> a.thaw()
+        OrigFrom(1, 2)
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, network_id, local_id):
+        return tuple.__new__(cls, (network_id, local_id))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    network_id = property(operator.itemgetter(0))
+    local_id   = property(operator.itemgetter(1))
+
+    def __repr__(self):
+        return 'FrozenOrigFrom(%u, %u)'%self
+
+    def __str__(self):
+        return '(%u,%u)'%self
+
+    def thaw(self):
+        """Return an OrigFrom with the same value.
+        """
+        return OrigFrom(self[0], self[1])
+
 def _same_message_struct(this, that):
     """Returns true if the two message structures are the same.
 
@@ -170,11 +280,11 @@ def _same_message_struct(this, that):
     name and (any) data concatenated after the header).
     """
     if not isinstance(this, _MessageHeaderStruct) and \
-       not isinstance(this, _EntireMessageStructBaseclass):
+       not isinstance(this, _EntireMessageBase):
         return False
 
     if not isinstance(that, _MessageHeaderStruct) and \
-       not isinstance(that, _EntireMessageStructBaseclass):
+       not isinstance(that, _EntireMessageBase):
         return False
 
     if (this.id != that.id or
@@ -214,11 +324,11 @@ def _equivalent_message_struct(this, that):
     after the header).
     """
     if not isinstance(this, _MessageHeaderStruct) and \
-       not isinstance(this, _EntireMessageStructBaseclass):
+       not isinstance(this, _EntireMessageBase):
         return False
 
     if not isinstance(that, _MessageHeaderStruct) and \
-       not isinstance(that, _EntireMessageStructBaseclass):
+       not isinstance(that, _EntireMessageBase):
         return False
 
     if (this.to != that.to or
@@ -235,12 +345,10 @@ def _equivalent_message_struct(this, that):
 
 def c_data_as_string(data, data_len):
     """Return the message data as a string.
+
+    'data' may be a ctypes array or pointer, or a string.
     """
-    # Somewhat inefficiently, convert it to a (byte) string
-    w = []
-    for ii in range(data_len):
-        w.append(chr(data[ii]))
-    return ''.join(w)
+    return ctypes.string_at(data, data_len)
 
 def hexdata(data):
     r"""Return a representation of a 'string' in printable form.
@@ -417,6 +525,121 @@ def calc_entire_message_len(name_len, data_len):
     return MSG_HEADER_LEN + calc_padded_name_len(name_len) + \
                             calc_padded_data_len(data_len) + 4
 
+# The message header, as a precompiled struct. Native byte order and
+# alignment put the name and data pointers ('P') where the C compiler (and
+# thus ctypes) puts them, and the final '0P' pads the end of the header out
+# to pointer alignment, as C does. So this is the same shape as
+# _MessageHeaderStruct on both 32- and 64-bit platforms.
+_MSG_HEADER_STRUCT = struct.Struct('@15I2PI0P')
+
+# The indices of the fields in a tuple unpacked by _MSG_HEADER_STRUCT
+# (the message id fields take two entries each)
+_HDR_START_GUARD = 0
+_HDR_ID          = 1
+_HDR_IN_REPLY_TO = 3
+_HDR_TO          = 5
+_HDR_FROM        = 6
+_HDR_ORIG_FROM   = 7
+_HDR_FINAL_TO    = 9
+_HDR_EXTRA       = 11
+_HDR_FLAGS       = 12
+_HDR_NAME_LEN    = 13
+_HDR_DATA_LEN    = 14
+_HDR_END_GUARD   = 17
+
+# An "entire" message is the header, followed by the name and data, each
+# padded with zero bytes, and then a final end guard. The 's' format does the
+# padding for us. Python's struct module keeps (a bounded number of) compiled
+# formats cached, so we don't need to do so ourselves.
+_ENTIRE_MSG_FORMAT = '@15I2PI0P%ds%dsI'
+
+_UINT32 = struct.Struct('=I')
+
+def _encode_entire_message(id, in_reply_to, to, from_, orig_from, final_to,
+                           flags, name, data, extra=0):
+    """Return the bytes of an "entire" message, built from its parts.
+
+    - 'id', 'in_reply_to', 'orig_from' and 'final_to' are (network_id, x)
+      tuples
+    - 'to' and 'from_' are 0 or a Ksock id
+    - 'name' is a string
+    - 'data' is a string or None
+
+    The header, name, padding and end guards are all packed in one step, and
+    the result is exactly calc_entire_message_len() bytes long (unlike
+    _struct_to_bytes() of an "entire" message structure, which may have
+    padding at the end).
+
+        >>> _MSG_HEADER_STRUCT.size == MSG_HEADER_LEN
+        True
+        >>> b = _encode_entire_message((0,0), (0,0), 0, 0, (0,0), (0,0), 0, '$.Fred', '1234')
+        >>> len(b) == calc_entire_message_len(6, 4)
+        True
+        >>> b == Message('$.Fred', '1234').to_bytes()
+        True
+    """
+    return struct.pack(*_entire_message_packing(id, in_reply_to, to, from_,
+                                                orig_from, final_to, flags,
+                                                name, data, extra))
+
+def _encode_entire_message_into(buffer, offset, id, in_reply_to, to, from_,
+                                orig_from, final_to, flags, name, data,
+                                extra=0):
+    """Pack an "entire" message, built from its parts, into 'buffer'.
+
+    'buffer' is a writable buffer (for instance, a bytearray), which must have
+    room for the message (as calculated by calc_entire_message_len()) starting
+    at 'offset'. The other arguments are as for _encode_entire_message().
+    """
+    packing = _entire_message_packing(id, in_reply_to, to, from_, orig_from,
+                                      final_to, flags, name, data, extra)
+    struct.pack_into(packing[0], buffer, offset, *packing[1:])
+
+def _entire_message_packing(id, in_reply_to, to, from_, orig_from, final_to,
+                            flags, name, data, extra):
+    """Return the struct format and values for packing an "entire" message.
+    """
+    if data is None:
+        data = ''
+    name_len = len(name)
+    data_len = len(data)
+    return (_ENTIRE_MSG_FORMAT%(calc_padded_name_len(name_len),
+                                calc_padded_data_len(data_len)),
+            Message.START_GUARD,
+            id[0], id[1], in_reply_to[0], in_reply_to[1],
+            to, from_,
+            orig_from[0], orig_from[1], final_to[0], final_to[1],
+            extra, flags, name_len, data_len,
+            0, 0,                       # no name or data pointers
+            Message.END_GUARD,
+            name, data, Message.END_GUARD)
+
+def _decode_message_header(data, offset=0):
+    """Unpack the header of the message starting at 'offset' in 'data'.
+
+    'data' may be anything supporting the buffer interface.
+
+    Returns a tuple of the header values, in order -- see the _HDR_xxx
+    values for the indices of particular fields.
+    """
+    return _MSG_HEADER_STRUCT.unpack_from(data, offset)
+
+def _padded_name(name):
+    """Return 'name' with its terminating 0 byte and padding.
+    """
+    name_len = len(name)
+    return name + '\0'*(calc_padded_name_len(name_len) - name_len)
+
+def _padded_data_array(data, padded_data_len):
+    """Return a ctypes array of 'padded_data_len' bytes, containing 'data'.
+
+    The array starts out zero filled, so the padding is already in place,
+    and 'data' is then copied into it in one go.
+    """
+    array = (ctypes.c_uint8 * padded_data_len)()
+    ctypes.memmove(array, data, len(data))
+    return array
+
 def message_from_parts(id, in_reply_to, to, from_, orig_from, final_to, flags, name, data):
     """Return a new Message header structure, with name and data attached.
 
@@ -439,30 +662,12 @@ def message_from_parts(id, in_reply_to, to, from_, orig_from, final_to, flags, n
     else:
         data_len = 0
 
-    # C wants us to have a terminating 0 byte
-    name += '\0'
-    # And we want to pad the result out to a multiple of 4 bytes
-    # ...this is about the nastiest way possible of doing it...
-    while len(name)%4:
-        name += '\0'
-
-    padded_name_len = len(name)
+    # C wants us to have a terminating 0 byte, and we want to pad the
+    # result out to a multiple of 4 bytes
+    name_ptr = ctypes.c_char_p(_padded_name(name))
 
-    # We want to pad the data out in the same manner
-    # (but without the terminating 0 byte)
     if data:
-        while len(data)%4:
-            data += '\0'
-        padded_data_len = len(data)
-    else:
-        padded_data_len = 0
-
-    name_ptr = ctypes.c_char_p(name)
-    if data:
-        # This seems a bit clumsy and wasteful, but I can't see
-        # how else to do it
-        DataArray = ctypes.c_uint8 * padded_data_len
-        data_ptr = DataArray( *[ord(x) for x in data] )
+        data_ptr = _padded_data_array(data, calc_padded_data_len(data_len))
     else:
         data_ptr = None
 
@@ -492,44 +697,20 @@ def _pointy_message_from_bytes(msg_data):
     if h.data_len == 0:
         h.data = None
     else:
-        data = msg_data[data_offset:data_offset+h.data_len]
-
         DataArray = ctypes.c_uint8 * h.data_len
-        h.data = DataArray( *[ord(x) for x in data] )
+        h.data = DataArray.from_buffer_copy(msg_data, data_offset)
 
     final_end_guard = msg_data[data_offset+padded_data_len:]
     return h
 
-class _EntireMessageStructBaseclass(ctypes.Structure):
-    """The baseclass for our "entire" message structure.
+class _EntireMessageBase(object):
+    """The baseclass for our "entire" message representations.
 
-    Defined separately just to reduce the amount of code executed in the
-    functions that *build* the classes.
-
-    It is required that the fields defined be 'header', 'rest_name',
-    'rest_data' and 'rest_end_guard' -- but since I'm assuming this will only
-    be (directly) used internally to kbus.py, I'm happy with that.
-
-        (Specifically, see the ``_specific_entire_message_struct`` function)
+    Subclasses must provide a 'header' (which is a _MessageHeaderStruct), and
+    the 'name' and 'data' properties, which retrieve the name and data from
+    wherever they are kept after the header.
     """
 
-    def __repr__(self):
-        """For debugging, not construction of an instance of ourselves.
-        """
-        if self.name_len:
-            name_repr = repr(hexdata(self.rest_name[:self.name_len]))
-        else:
-            name_repr = 'None'
-        if self.data_len:
-            data_repr = repr(hexdata(c_data_as_string(self.rest_data,self.data_len)))
-        else:
-            data_repr = None
-        return "%s %s %s [%08x>"%(
-                self.header,
-                name_repr,
-                data_repr,
-                self.rest_end_guard)
-
     # If we didn't have the problem of trying to look for the
     # message name and data in the "rest" of the structure, we
     # could use the "anonymous" capability to make the "header"
@@ -611,6 +792,45 @@ class _EntireMessageStructBaseclass(ctypes.Structure):
     def end_guard(self):
         return self.header.end_guard
 
+    def __eq__(self, other):
+        return _same_message_struct(self, other)
+
+    def __ne__(self, other):
+        return not _same_message_struct(self, other)
+
+    def equivalent(self, other):
+        return _equivalent_message_struct(self, other)
+
+class _EntireMessageStructBaseclass(_EntireMessageBase, ctypes.Structure):
+    """The baseclass for our "entire" message structure.
+
+    Defined separately just to reduce the amount of code executed in the
+    functions that *build* the classes.
+
+    It is required that the fields defined be 'header', 'rest_name',
+    'rest_data' and 'rest_end_guard' -- but since I'm assuming this will only
+    be (directly) used internally to kbus.py, I'm happy with that.
+
+        (Specifically, see the ``_specific_entire_message_struct`` function)
+    """
+
+    def __repr__(self):
+        """For debugging, not construction of an instance of ourselves.
+        """
+        if self.name_len:
+            name_repr = repr(hexdata(self.rest_name[:self.name_len]))
+        else:
+            name_repr = 'None'
+        if self.data_len:
+            data_repr = repr(hexdata(c_data_as_string(self.rest_data,self.data_len)))
+        else:
+            data_repr = None
+        return "%s %s %s [%08x>"%(
+                self.header,
+                name_repr,
+                data_repr,
+                self.rest_end_guard)
+
     @property
     def name(self):
         name_len = self.header.name_len
@@ -620,39 +840,210 @@ class _EntireMessageStructBaseclass(ctypes.Structure):
     def data(self):
         data_len = self.header.data_len
         if data_len:
-            return self.rest_data[:data_len]
+            return ctypes.string_at(self.rest_data, data_len)
         else:
             return None
 
-    def __eq__(self, other):
-        return _same_message_struct(self, other)
+    def as_buffer(self):
+        """Return our message bytes, as something that can be written out.
 
-    def __ne__(self, other):
-        return not _same_message_struct(self, other)
+        This omits any padding after the final end guard.
+        """
+        return buffer(self, 0, calc_entire_message_len(self.name_len,
+                                                       self.data_len))
 
-    def equivalent(self, other):
-        return _equivalent_message_struct(self, other)
+class _FlatMessageStruct(_EntireMessageBase):
+    """An "entire" message, held in a bytearray.
+
+    Unlike the ctypes "entire" message structures, this does not need a
+    new class for each different size of message. The 'header' is a
+    _MessageHeaderStruct that shares its memory with the start of the
+    bytearray, so changing the header changes the bytes as well, and
+    the bytearray is always exactly the bytes of the message.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.header = _MessageHeaderStruct.from_buffer(buf)
+
+    def __repr__(self):
+        """For debugging, not construction of an instance of ourselves.
+        """
+        if self.name_len:
+            name_repr = repr(hexdata(self.name))
+        else:
+            name_repr = 'None'
+        if self.data_len:
+            data_repr = repr(hexdata(self.data))
+        else:
+            data_repr = None
+        return "%s %s %s [%08x>"%(
+                self.header,
+                name_repr,
+                data_repr,
+                self.rest_end_guard)
+
+    def _string_at(self, offset, length):
+        return ctypes.string_at(ctypes.addressof(self.header) + offset, length)
+
+    @property
+    def name(self):
+        return self._string_at(MSG_HEADER_LEN, self.header.name_len)
+
+    @property
+    def data(self):
+        data_len = self.header.data_len
+        if data_len:
+            offset = MSG_HEADER_LEN + calc_padded_name_len(self.header.name_len)
+            return self._string_at(offset, data_len)
+        else:
+            return None
+
+    @property
+    def rest_end_guard(self):
+        return _UINT32.unpack_from(self.buf, len(self.buf) - 4)[0]
+
+    def as_buffer(self):
+        """Return our message bytes, as something that can be written out.
+        """
+        return self.buf
+
+class _BoundedDict(dict):
+    """A dictionary, used as a cache, that holds at most 'max_size' items.
+
+    When it is full, 'remember' forgets everything before adding its new
+    item. That is crude, but costs nothing on lookup, which is what we care
+    about in a cache of things (ioctl arguments, say, or what a message name
+    matches) that are cheap enough to make again.
+
+        >>> cache = _BoundedDict(2)
+        >>> cache.remember('one', 1)
+        1
+        >>> cache.remember('two', 2)
+        2
+        >>> cache['one']
+        1
+        >>> cache.remember('three', 3)
+        3
+        >>> cache
+        {'three': 3}
+    """
+
+    def __init__(self, max_size):
+        super(_BoundedDict, self).__init__()
+        self.max_size = max_size
+
+    def remember(self, key, value):
+        """Remember 'value' for 'key', and return it.
+        """
+        if len(self) >= self.max_size:
+            self.clear()
+        self[key] = value
+        return value
+
+class _StructClassCache(object):
+    """A bounded cache of classes, discarding the least recently used.
+
+    Keeps count of the hits, misses and evictions, so that we can tell how
+    well it is doing.
+
+        >>> cache = _StructClassCache(2)
+        >>> cache.add(1, 'one')
+        >>> cache.add(2, 'two')
+        >>> cache.get(1)
+        'one'
+        >>> cache.add(3, 'three')
+        >>> print cache.get(2)
+        None
+        >>> sorted(cache.info().items())
+        [('evictions', 1), ('hits', 1), ('max_size', 2), ('misses', 1), ('size', 2)]
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.classes = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.classes)
+
+    def get(self, key):
+        """Return the class for 'key', or None if we don't have it.
+        """
+        try:
+            cls = self.classes.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Remember it as the most recently used
+        self.classes[key] = cls
+        self.hits += 1
+        return cls
+
+    def add(self, key, cls):
+        """Remember 'cls' for 'key', discarding old classes if necessary.
+        """
+        self.classes[key] = cls
+        self._discard_extra()
+
+    def resize(self, max_size):
+        """Change how many classes we may hold, discarding any extra.
+        """
+        self.max_size = max_size
+        self._discard_extra()
+
+    def _discard_extra(self):
+        while len(self.classes) > self.max_size:
+            self.classes.popitem(last=False)
+            self.evictions += 1
+
+    def info(self):
+        """Return a dictionary of our statistics.
+        """
+        return {'size':len(self.classes), 'max_size':self.max_size,
+                'hits':self.hits, 'misses':self.misses,
+                'evictions':self.evictions}
+
+# We don't want to create a new class for *every* message, given there will
+# be a lot of messages that are very similar, but neither do we want to keep
+# a class for every size of message we have ever seen (each class costs a
+# fair amount of memory), so keep the most recently used
+_specific_entire_message_struct_cache = _StructClassCache(64)
 
-# Is this premature optimisation?
-# I don't think Python would cache the different classes for me,
-# and it seems wasteful to create a new class for *every* message,
-# given there will be a lot of messages that are very similar...
-_specific_entire_message_struct_dict = {}
+def entire_message_struct_cache_info():
+    """Return statistics on the cache of "entire" message structure classes.
+
+    Returns a dictionary with keys 'size', 'max_size', 'hits', 'misses' and
+    'evictions'.
+    """
+    return _specific_entire_message_struct_cache.info()
+
+def set_entire_message_struct_cache_size(max_size):
+    """Set how many "entire" message structure classes may be cached.
+
+    If there are more than that already, the least recently used are
+    discarded.
+    """
+    if max_size < 1:
+        raise ValueError('Cache size must be at least 1, not %d'%max_size)
+    _specific_entire_message_struct_cache.resize(max_size)
 
 def _specific_entire_message_struct(padded_name_len, padded_data_len):
-    """Return a specific subclass of _MessageHeaderStruct
+    """Return a specific subclass of _EntireMessageStructBaseclass
     """
     key = (padded_name_len, padded_data_len)
-    if key in _specific_entire_message_struct_dict:
-        return _specific_entire_message_struct_dict[key]
-    else:
+    local_class = _specific_entire_message_struct_cache.get(key)
+    if local_class is None:
         class localEntireMessageStruct(_EntireMessageStructBaseclass):
             _fields_ = [('header',     _MessageHeaderStruct),
                         ('rest_name',  ctypes.c_char  * padded_name_len),
                         ('rest_data',  ctypes.c_uint8 * padded_data_len),
                         ('rest_end_guard',  ctypes.c_uint32)]
-        _specific_entire_message_struct_dict[key] = localEntireMessageStruct
-        return localEntireMessageStruct
+        local_class = localEntireMessageStruct
+        _specific_entire_message_struct_cache.add(key, local_class)
+    return local_class
 
 def _entire_message_from_parts(id, in_reply_to, to, from_, orig_from, final_to,
                                flags, name, data):
@@ -690,20 +1081,14 @@ def _entire_message_from_parts(id, in_reply_to, to, from_, orig_from, final_to,
 
     data_len = len(data)
 
-    # C wants us to have a terminating 0 byte
-    name += '\0'
-    # And we want to pad the result out to a multiple of 4 bytes
-    # ...this is about the nastiest way possible of doing it...
-    while len(name)%4:
-        name += '\0'
-
+    # C wants us to have a terminating 0 byte, and we want to pad the
+    # result out to a multiple of 4 bytes
+    name = _padded_name(name)
     padded_name_len = len(name)
 
     # We want to pad the data out in the same manner
     # (but without the terminating 0 byte)
-    while len(data)%4:
-        data += '\0'
-    padded_data_len = len(data)
+    padded_data_len = calc_padded_data_len(data_len)
 
     header = _MessageHeaderStruct(Message.START_GUARD,
                                   id, in_reply_to,
@@ -711,8 +1096,7 @@ def _entire_message_from_parts(id, in_reply_to, to, from_, orig_from, final_to,
                                   name_len, data_len,
                                   None, None, Message.END_GUARD)
 
-    DataArray = ctypes.c_uint8 * padded_data_len
-    data_array = DataArray( *[ord(x) for x in data] )
+    data_array = _padded_data_array(data, padded_data_len)
 
     # We rather rely on 'data' "disappearing" (being of zero length)
     # if 'data_len' is zero, and it appears that that just works.
@@ -722,54 +1106,104 @@ def _entire_message_from_parts(id, in_reply_to, to, from_, orig_from, final_to,
 
     return local_class(header, name, data_array, Message.END_GUARD)
 
-def _entire_message_from_bytes(data):
-    """Return a message structure based on 'data'.
-
-    'data' is a string-like object (as, for instance, returned by 'read')
+def _check_entire_message_bytes(data):
+    """Check that 'data' plausibly contains an "entire" message.
 
-    Note that the result may be slightly longer than you expect - for instance,
-    on a 64-bit machine, there will be 4 bytes of padding after the final
-    end guard.
+    Returns the (unpacked) message header.
     """
     # We do *not* want to pass something awful to our C-structure factory!
     if len(data) < MSG_HEADER_LEN:
         raise ValueError('Cannot form entire message from string'
                          ' "%s" of length %d'%(hexdata(data),len(data)))
-    if struct.unpack('=L',data[:4])[0] != Message.START_GUARD:
+    if _UINT32.unpack_from(data)[0] != Message.START_GUARD:
         raise ValueError('Cannot form entire message from string "%s..%s"'
                          ' which does not start with message start'
                          ' guard'%(hexdata(data[:8]),hexdata(data[-8:])))
-    ## ===================================
-    debug = False
-    if debug:
-        print
-        print '_entire_message_from_bytes(%d:%s)'%(len(data),hexify(data))
-    ## ===================================
-    h = _struct_from_bytes(_MessageHeaderStruct, data)
-    ## ===================================
-    if debug:
-        print '_MessageHeaderStruct: %s'%h
-    ## ===================================
+    return _decode_message_header(data)
+
+def _entire_message_from_bytes(data):
+    """Return a message structure based on 'data'.
+
+    'data' is a string-like object (as, for instance, returned by 'read')
+
+    The result is a _FlatMessageStruct, holding a copy of exactly the bytes
+    of the message.
+    """
+    hdr = _check_entire_message_bytes(data)
+    length = calc_entire_message_len(hdr[_HDR_NAME_LEN], hdr[_HDR_DATA_LEN])
+    buf = bytearray(data)
+    if len(buf) > length:
+        del buf[length:]
+    elif len(buf) < length:
+        # Be as forgiving as the ctypes structures are about short data
+        buf.extend('\0'*(length - len(buf)))
+    return _FlatMessageStruct(buf)
+
+def _entire_message_struct_from_bytes(data):
+    """Return a ctypes "entire" message structure based on 'data'.
+
+    'data' is a string-like object (as, for instance, returned by 'read')
+
+    Note that this needs a class specific to the (padded) lengths of the
+    message name and data - see _specific_entire_message_struct().
+
+    Note that the result may be slightly longer than you expect - for instance,
+    on a 64-bit machine, there will be 4 bytes of padding after the final
+    end guard.
+    """
+    hdr = _check_entire_message_bytes(data)
+    name_len = hdr[_HDR_NAME_LEN]
+    data_len = hdr[_HDR_DATA_LEN]
 
     # Don't forget that the string will be terminated with a 0 byte
-    padded_name_len = calc_padded_name_len(h.name_len)
+    padded_name_len = calc_padded_name_len(name_len)
 
     # But not so the data
-    padded_data_len = calc_padded_data_len(h.data_len)
+    padded_data_len = calc_padded_data_len(data_len)
 
     local_class = _specific_entire_message_struct(padded_name_len,
                                                   padded_data_len)
 
-    ## ===================================
-    if debug:
-        print 'name_len %d -> %d, data_len %d -> %d'%(h.name_len, padded_name_len, h.data_len, padded_data_len)
-        x = _struct_from_bytes(local_class, data)
-        print '_specific_class:      %s'%x
-        print
-    ## ===================================
-
     return _struct_from_bytes(local_class, data)
 
+def _clone_message(msg, cls, to=None, from_=None, orig_from=None,
+                   final_to=None, in_reply_to=None, flags=None, id=None):
+    """Return a new instance of 'cls', a copy of Message 'msg'.
+
+    The optional arguments are header fields to change in the copy - any that
+    are None are left as they were. 'id', 'in_reply_to', 'orig_from' and
+    'final_to' may be given as the appropriate structure or as a tuple.
+
+    The bytes of the original message are copied once, and then just the
+    changed header fields are patched in place - there is no need to decode
+    (and re-encode) the name and data.
+
+        >>> msg = Message('$.Fred', '1234', from_=27, id=MessageId(0, 132))
+        >>> _clone_message(msg, Reply, to=27, in_reply_to=msg.id, id=(0,0))
+        Reply('$.Fred', data='1234', to=27L, from_=27L, in_reply_to=MessageId(0, 132))
+
+    The original is left unchanged:
+
+        >>> msg
+        Message('$.Fred', data='1234', from_=27L, id=MessageId(0, 132))
+    """
+    if msg.msg.is_pointy:
+        buf = bytearray(msg.to_bytes())
+    else:
+        buf = bytearray(msg.msg.as_buffer())
+    clone = _FlatMessageStruct(buf)
+    header = clone.header
+    if to          is not None: header.to          = to
+    if from_       is not None: header.from_       = from_
+    if orig_from   is not None: header.orig_from   = orig_from
+    if final_to    is not None: header.final_to    = final_to
+    if in_reply_to is not None: header.in_reply_to = in_reply_to
+    if flags       is not None: header.flags       = flags
+    if id          is not None: header.id          = id
+    message = cls.__new__(cls,'')
+    message.msg = clone
+    return message
+
 class Message(object):
     r"""A wrapper for a KBUS message
 
@@ -988,6 +1422,10 @@ class Message(object):
             >>> msg2
             Message('$.Fred', data='12345678', flags=0x00000001)
         """
+        if data is None:
+            # We can just copy the message, and amend its header
+            return _clone_message(msg, Message, to, from_, orig_from,
+                                  final_to, in_reply_to, flags, id)
         message = Message.__new__(Message,'')
         message._merge_args(msg.extract(), data, to, from_, orig_from,
                             final_to, in_reply_to, flags, id)
@@ -1406,26 +1844,21 @@ class Message(object):
 
         This returns the entirety of the message as a Python string.
 
-        In order to do this, it first coerces the mesage to an "entire"
-        message (so that we don't have any dangling "pointers" to the
-        name or data).
+        In order to do this, it encodes the mesage as an "entire" message
+        (so that we don't have any dangling "pointers" to the name or data).
 
-        See the 'total_length()' method for how to determine the "correct"
-        length of this string.
+        The string returned is exactly 'total_length()' bytes long.
         """
-        (id, in_reply_to, to, from_, orig_from, final_to, flags, name, data) = self.extract()
-        tmp = _entire_message_from_parts(id, in_reply_to, to, from_, orig_from,
-                                         final_to, flags, name, data)
-        b = _struct_to_bytes(tmp)
-        # We need to be careful about lengths.
-        # For instance, on a 64-bit machine, there will be 4 bytes of "unused"
-        # padding after the final end guard of an "entire" message, which we
-        # do not want to return. The solution is to return the correct,
-        # calculated, length. Of course, this does cost us a string copy...
-        name_len = len(name) if name else 0
-        data_len = len(data) if data else 0
-        actual_len = calc_entire_message_len(name_len, data_len)
-        return b[:actual_len]
+        msg = self.msg
+        return _encode_entire_message((msg.id.network_id, msg.id.serial_num),
+                                      (msg.in_reply_to.network_id,
+                                       msg.in_reply_to.serial_num),
+                                      msg.to, msg.from_,
+                                      (msg.orig_from.network_id,
+                                       msg.orig_from.local_id),
+                                      (msg.final_to.network_id,
+                                       msg.final_to.local_id),
+                                      msg.flags, self.name, self.data)
 
     def is_reply(self):
         """A convenience method - are we a Reply?
@@ -1461,7 +1894,7 @@ class Message(object):
         if self.is_reply():
             # Status messages have a specific sort of name
             if self.msg.name.startswith('$.KBUS.'):
-                return Status.from_bytes(self.to_bytes())
+                return _clone_message(self, Status)
             else:
                 return Reply.from_message(self)
         elif self.is_request():
@@ -1587,6 +2020,9 @@ class Announcement(Message):
             >>> msg2
             Announcement('$.Fred', data='12345678', flags=0x00000001)
         """
+        if data is None:
+            return _clone_message(msg, Announcement, to, from_, (0,0), (0,0),
+                                  (0,0), flags, id)
         message = Announcement.__new__(Announcement,'')
         message._merge_args(msg.extract(), data, to, from_, None, None, None,
                             flags, id)
@@ -1746,9 +2182,13 @@ class Request(Message):
             >>> msg2
             Request('$.Fred', data='12345678', flags=0x00000003)
         """
-        message = Request.__new__(Request,'')
-        message._merge_args(msg.extract(), data, to, from_, None,
-                            final_to, None, flags, id)
+        if data is None:
+            message = _clone_message(msg, Request, to, from_, None,
+                                     final_to, None, flags, id)
+        else:
+            message = Request.__new__(Request,'')
+            message._merge_args(msg.extract(), data, to, from_, None,
+                                final_to, None, flags, id)
         # But then make sure that the "wants a reply" flag is set
         super(Request, message).set_want_reply(True)
         return message
@@ -1904,9 +2344,13 @@ class Reply(Message):
             >>> msg2
             Reply('$.Fred', data='12345678', in_reply_to=MessageId(0, 5), flags=0x00000002)
         """
-        message = Reply.__new__(Reply,'')
-        message._merge_args(msg.extract(), data, to, from_, orig_from,
-                            None, in_reply_to, flags, id)
+        if data is None:
+            message = _clone_message(msg, Reply, to, from_, orig_from,
+                                     None, in_reply_to, flags, id)
+        else:
+            message = Reply.__new__(Reply,'')
+            message._merge_args(msg.extract(), data, to, from_, orig_from,
+                                None, in_reply_to, flags, id)
         if message.in_reply_to is None:
             raise ValueError("A Reply must specify in_reply_to")
         return message
@@ -2080,6 +2524,371 @@ class Status(Message):
             args.append('id=%s'%repr(id))
         return 'Status(%s)'%(', '.join(args))
 
+class MessageView(object):
+    r"""A read-only view of an "entire" message, as read from a Ksock.
+
+    Constructing a Message from bytes copies the whole message into a ctypes
+    datastructure, and then each access of the name or data copies it out
+    again. A MessageView instead just remembers a memoryview of the bytes it
+    was given, and decodes header fields from it as they are asked for.
+
+        >>> msg = Message('$.Fred', data='1234', to=9, flags=Message.WANT_A_REPLY)
+        >>> view = MessageView(msg.to_bytes())
+        >>> view
+        MessageView('$.Fred', data='1234', to=9, flags=0x00000001)
+        >>> view.to
+        9
+        >>> print view.id
+        None
+        >>> view.is_request()
+        True
+
+    The name and data are returned as memoryview slices of the original
+    bytes, so they are not copied unless the caller asks:
+
+        >>> view.name == '$.Fred'
+        True
+        >>> view.name.tobytes()
+        '$.Fred'
+        >>> view.data.tobytes()
+        '1234'
+
+    If the whole message is wanted, it can be had:
+
+        >>> view.to_message() == msg
+        True
+
+    The same checks are made on the bytes as for Message.from_bytes():
+
+        >>> MessageView('1234'+msg.to_bytes())
+        Traceback (most recent call last):
+        ...
+        ValueError: Cannot form message view from string "1234Kbus..1234subK" which does not start with message start guard
+    """
+
+    __slots__ = ('_buf', '_hdr')
+
+    def __init__(self, data):
+        buf = memoryview(data)
+        if len(buf) < MSG_HEADER_LEN:
+            raise ValueError('Cannot form message view from string'
+                             ' "%s" of length %d'%(hexdata(buf.tobytes()),
+                                                   len(buf)))
+        if _UINT32.unpack_from(buf)[0] != Message.START_GUARD:
+            raise ValueError('Cannot form message view from string "%s..%s"'
+                             ' which does not start with message start'
+                             ' guard'%(hexdata(buf[:8].tobytes()),
+                                       hexdata(buf[-8:].tobytes())))
+        self._buf = buf
+        self._hdr = None
+
+    @property
+    def _header(self):
+        """The header values, unpacked (all at once) when first wanted.
+        """
+        if self._hdr is None:
+            self._hdr = _decode_message_header(self._buf)
+        return self._hdr
+
+    def _id_pair(self, index, cls):
+        hdr = self._header
+        if hdr[index] == 0 and hdr[index+1] == 0:
+            return None
+        else:
+            return cls(hdr[index], hdr[index+1])
+
+    @property
+    def start_guard(self):
+        return self._header[_HDR_START_GUARD]
+
+    @property
+    def id(self):
+        return self._id_pair(_HDR_ID, MessageId)
+
+    @property
+    def in_reply_to(self):
+        return self._id_pair(_HDR_IN_REPLY_TO, MessageId)
+
+    @property
+    def to(self):
+        return self._header[_HDR_TO]
+
+    @property
+    def from_(self):
+        return self._header[_HDR_FROM]
+
+    @property
+    def orig_from(self):
+        return self._id_pair(_HDR_ORIG_FROM, OrigFrom)
+
+    @property
+    def final_to(self):
+        return self._id_pair(_HDR_FINAL_TO, OrigFrom)
+
+    @property
+    def extra(self):
+        return self._header[_HDR_EXTRA]
+
+    @property
+    def flags(self):
+        return self._header[_HDR_FLAGS]
+
+    @property
+    def name_len(self):
+        return self._header[_HDR_NAME_LEN]
+
+    @property
+    def data_len(self):
+        return self._header[_HDR_DATA_LEN]
+
+    @property
+    def end_guard(self):
+        return self._header[_HDR_END_GUARD]
+
+    @property
+    def name(self):
+        """The message name, as a memoryview slice (not a copy).
+        """
+        return self._buf[MSG_HEADER_LEN:MSG_HEADER_LEN+self.name_len]
+
+    @property
+    def data(self):
+        """The message data, as a memoryview slice (not a copy), or None.
+        """
+        data_len = self.data_len
+        if data_len == 0:
+            return None
+        offset = MSG_HEADER_LEN + calc_padded_name_len(self.name_len)
+        return self._buf[offset:offset+data_len]
+
+    def total_length(self):
+        """Return the total length of the "entire" message we are a view of.
+        """
+        return calc_entire_message_len(self.name_len, self.data_len)
+
+    def is_reply(self):
+        hdr = self._header
+        return hdr[_HDR_IN_REPLY_TO] != 0 or hdr[_HDR_IN_REPLY_TO+1] != 0
+
+    def is_request(self):
+        return bool(self.flags & Message.WANT_A_REPLY)
+
+    def is_stateful_request(self):
+        return bool(self.flags & Message.WANT_A_REPLY and self.to)
+
+    def wants_us_to_reply(self):
+        return bool(self.flags & Message.WANT_YOU_TO_REPLY)
+
+    def is_synthetic(self):
+        return bool(self.flags & Message.SYNTHETIC)
+
+    def is_urgent(self):
+        return bool(self.flags & Message.URGENT)
+
+    def to_bytes(self):
+        """Return (a copy of) the bytes of the message we are a view of.
+        """
+        return self._buf[:self.total_length()].tobytes()
+
+    def to_message(self):
+        """Return a Message built from (a copy of) our bytes.
+        """
+        return Message.from_bytes(self._buf[:self.total_length()])
+
+    def cast(self):
+        """Return a Message of the appropriate subclass - see Message.cast()
+        """
+        return self.to_message().cast()
+
+    def __repr__(self):
+        args = [repr(self.name.tobytes())]
+        data = self.data
+        if data is not None:
+            args.append('data=%s'%repr(hexdata(data.tobytes())))
+        for field in ('to', 'from_', 'orig_from', 'final_to', 'in_reply_to'):
+            value = getattr(self, field)
+            if value:
+                args.append('%s=%s'%(field, repr(value)))
+        flags = self.flags
+        if flags:
+            args.append('flags=0x%08x'%flags)
+        id = self.id
+        if id:
+            args.append('id=%s'%repr(id))
+        return 'MessageView(%s)'%(', '.join(args))
+
+class MessageTemplate(object):
+    """A template for sending many messages with the same name, 'to' and flags.
+
+    Constructing a Message checks and pads its name, and builds its header,
+    every time. When the same name is being sent over and over again, with
+    only the data changing, a MessageTemplate does that work just once:
+
+        >>> t = MessageTemplate('$.Telemetry', flags=Message.URGENT)
+        >>> t
+        MessageTemplate('$.Telemetry', flags=0x00000008)
+
+    and each message is then just the precomputed header and name, with
+    the data length and data filled in:
+
+        >>> t.to_bytes('1234') == Message('$.Telemetry', '1234',
+        ...                               flags=Message.URGENT).to_bytes()
+        True
+        >>> t.render('1234')
+        Message('$.Telemetry', data='1234', flags=0x00000008)
+        >>> t.render()
+        Message('$.Telemetry', flags=0x00000008)
+
+    Use Ksock.send_template() to send a message from a template without
+    building a Message at all.
+
+    The name is checked in the same way as for a Message:
+
+        >>> MessageTemplate('Fred')
+        Traceback (most recent call last):
+        ...
+        ValueError: Message name "Fred" does not start "$."
+    """
+
+    # The offset of the data length field in the message header
+    _DATA_LEN_OFFSET = _MessageHeaderStruct.data_len.offset
+
+    def __init__(self, name, to=None, flags=None):
+        if not name.startswith('$.'):
+            raise ValueError('Message name "%s" does not start "$."'%name)
+        if len(name) < 3:
+            raise ValueError("Message name is %d long, minimum is 3"
+                             " (e.g., '$.*')"%len(name))
+        self.name = name
+        self.to = to or 0
+        self.flags = flags or 0
+
+        # Everything up to the end of the name, with a data length of 0
+        zero = (0, 0)
+        prefix = _encode_entire_message(zero, zero, self.to, 0, zero, zero,
+                                        self.flags, name, None)
+        prefix = prefix[:-_UINT32.size]
+        self._before_data_len = prefix[:self._DATA_LEN_OFFSET]
+        self._after_data_len = prefix[self._DATA_LEN_OFFSET+_UINT32.size:]
+        self._end_guard = _UINT32.pack(Message.END_GUARD)
+
+    def __repr__(self):
+        args = [repr(self.name)]
+        if self.to:
+            args.append('to=%s'%repr(self.to))
+        if self.flags:
+            args.append('flags=0x%08x'%self.flags)
+        return 'MessageTemplate(%s)'%(', '.join(args))
+
+    def to_bytes(self, data=None):
+        """Return the bytes of an "entire" message with the given data.
+
+        'data' is a string or None. The result is suitable for writing
+        directly to a Ksock.
+        """
+        if data is None:
+            data = ''
+        data_len = len(data)
+        return ''.join((self._before_data_len, _UINT32.pack(data_len),
+                        self._after_data_len, data,
+                        '\0'*(calc_padded_data_len(data_len) - data_len),
+                        self._end_guard))
+
+    def render(self, data=None):
+        """Return a Message with the given data.
+        """
+        message = Message.__new__(Message,'')
+        message.msg = _FlatMessageStruct(bytearray(self.to_bytes(data)))
+        return message
+
+def encode_batch(messages):
+    """Encode a sequence of messages back-to-back into a single bytearray.
+
+    'messages' may contain Message (or subclass) and MessageView instances.
+
+    Returns a tuple (buf, offsets), where 'buf' is the bytearray and
+    'offsets' is an array of the offset of each message within it.
+
+        >>> buf, offsets = encode_batch([Message('$.Fred', '1234'),
+        ...                              Request('$.Jim'),
+        ...                              Message('$.Fred', 'abcdefg')])
+        >>> len(offsets)
+        3
+        >>> offsets[1] == Message('$.Fred', '1234').total_length()
+        True
+        >>> len(buf) == offsets[2] + Message('$.Fred', 'abcdefg').total_length()
+        True
+
+    Use iter_messages() to read the messages back out again.
+    """
+    lengths = [msg.total_length() for msg in messages]
+    buf = bytearray(sum(lengths))
+    offsets = array.array('I')
+    offset = 0
+    for msg, length in zip(messages, lengths):
+        offsets.append(offset)
+        if isinstance(msg, MessageView):
+            buf[offset:offset+length] = msg._buf[:length]
+        elif msg.msg.is_pointy:
+            m = msg.msg
+            _encode_entire_message_into(buf, offset,
+                                        (m.id.network_id, m.id.serial_num),
+                                        (m.in_reply_to.network_id,
+                                         m.in_reply_to.serial_num),
+                                        m.to, m.from_,
+                                        (m.orig_from.network_id,
+                                         m.orig_from.local_id),
+                                        (m.final_to.network_id,
+                                         m.final_to.local_id),
+                                        m.flags, msg.name, msg.data)
+        else:
+            # It's already in the right form, so just copy it
+            buf[offset:offset+length] = msg.msg.as_buffer()
+        offset += length
+    return buf, offsets
+
+def iter_messages(data, views=False):
+    """Iterate over messages held back-to-back in 'data'.
+
+    'data' is anything supporting the buffer interface - for instance, the
+    bytearray returned by encode_batch(), or a string read from a file.
+
+    If 'views' is true, yields a MessageView for each message (onto 'data'
+    itself, so nothing is copied), otherwise yields a Message.
+
+        >>> buf, offsets = encode_batch([Message('$.Fred', '1234'),
+        ...                              Request('$.Jim')])
+        >>> list(iter_messages(buf))
+        [Message('$.Fred', data='1234'), Message('$.Jim', flags=0x00000001)]
+        >>> [view.name.tobytes() for view in iter_messages(buf, views=True)]
+        ['$.Fred', '$.Jim']
+
+    Raises ValueError if the data ends part way through a message.
+
+        >>> list(iter_messages(buf[:-4])) # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: Message at offset ... needs ... bytes, but only ... remain
+    """
+    buf = memoryview(data)
+    end = len(buf)
+    offset = 0
+    while offset < end:
+        if end - offset < MSG_HEADER_LEN:
+            raise ValueError('Message at offset %d needs at least %d bytes,'
+                             ' but only %d remain'%(offset, MSG_HEADER_LEN,
+                                                    end - offset))
+        hdr = _decode_message_header(buf, offset)
+        length = calc_entire_message_len(hdr[_HDR_NAME_LEN], hdr[_HDR_DATA_LEN])
+        if offset + length > end:
+            raise ValueError('Message at offset %d needs %d bytes, but only'
+                             ' %d remain'%(offset, length, end - offset))
+        if views:
+            yield MessageView(buf[offset:offset+length])
+        else:
+            yield Message.from_bytes(buf[offset:offset+length])
+        offset += length
+
 def reply_to(original, data=None, flags=0):
     """Return a Reply to the given Message.
 
@@ -2128,8 +2937,6 @@ def reply_to(original, data=None, flags=0):
         raise ValueError("Cannot form a reply to a message that does not have"
                 " WANT_A_REPLY and WANT_YOU_TO_REPLY set: %s"%original)
 
-    (id, in_reply_to, to, from_, orig_from, final_to, original_flags,
-            name, data_tuple) = original.extract()
     # We reply to the original sender (to), indicating which message we're
     # responding to (in_reply_to).
     #
@@ -2137,7 +2944,11 @@ def reply_to(original, data=None, flags=0):
     #
     # We don't need to set any flags. We definitely *don't* want to copy
     # any flags from the original message.
-    return Reply(name, data=data, in_reply_to=id, to=from_, flags=flags)
+    #
+    # We only need a few fields from the original, so there's no point in
+    # extract()ing its data as well.
+    return Reply(original.name, data=data, in_reply_to=original.id,
+                 to=original.from_, flags=flags)
 
 def stateful_request(earlier_msg, name, data=None, from_=None,
                      flags=None, id=None):
@@ -2208,19 +3019,64 @@ class _ReplierBindEventHeader(ctypes.Structure):
                 ('binder',  ctypes.c_uint32),
                 ('name_len',ctypes.c_uint32)]
 
+# The same, as a precompiled struct
+_REPLIER_BIND_EVENT_HEADER = struct.Struct('=3I')
+
 def split_replier_bind_event_data(data):
     """Split the data from a '$.KBUS.ReplierBindEvent' message.
 
     Returns a tuple of the form (is_bind, binder, name)
+
+        >>> data = _REPLIER_BIND_EVENT_HEADER.pack(1, 27, 6) + '$.Fred\\0\\0'
+        >>> split_replier_bind_event_data(data)
+        (1, 27, '$.Fred')
     """
+    is_bind, binder, name_len = _REPLIER_BIND_EVENT_HEADER.unpack_from(data)
+    offset = _REPLIER_BIND_EVENT_HEADER.size
+    return (is_bind, binder, data[offset:offset+name_len])
 
-    hdr = _struct_from_bytes(_ReplierBindEventHeader, data)
+def _name_matches(pattern, name):
+    """Does message name 'name' match the binding 'pattern'?
+
+    As KBUS itself does it, a pattern ending in '.*' matches any name that
+    starts with the rest of the pattern, and a pattern ending '.%' any name
+    that starts with it and has just one more component. Otherwise, the
+    names must be identical.
+
+        >>> _name_matches('$.Fred', '$.Fred')
+        True
+        >>> _name_matches('$.Fred.*', '$.Fred.Jim.Bob')
+        True
+        >>> _name_matches('$.Fred.%', '$.Fred.Jim')
+        True
+        >>> _name_matches('$.Fred.%', '$.Fred.Jim.Bob')
+        False
+        >>> _name_matches('$.Fred.*', '$.Fred')
+        False
+    """
+    if pattern.endswith('.*'):
+        return name.startswith(pattern[:-1])
+    elif pattern.endswith('.%'):
+        return name.startswith(pattern[:-1]) and \
+                '.' not in name[len(pattern)-1:]
+    else:
+        return pattern == name
 
-    offset = ctypes.sizeof(_ReplierBindEventHeader)
+def _name_specificity(pattern):
+    """Return a key for sorting binding patterns, most specific first.
 
-    name = data[offset:offset+hdr.name_len]
+    An exact name beats a '%' wildcard, which beats a '*' wildcard, and a
+    longer wildcard beats a shorter one.
 
-    return (hdr.is_bind, hdr.binder, name)
+        >>> sorted(['$.*', '$.Fred.*', '$.Fred.%', '$.Fred.Jim'], key=_name_specificity)
+        ['$.Fred.Jim', '$.Fred.%', '$.Fred.*', '$.*']
+    """
+    if pattern.endswith('.*'):
+        return (2, -len(pattern))
+    elif pattern.endswith('.%'):
+        return (1, -len(pattern))
+    else:
+        return (0, -len(pattern))
 
 if __name__ == "__main__":
     import doctest
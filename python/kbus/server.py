@@ -0,0 +1,328 @@
+"""ReplierServer - serving KBUS Requests with a pool of worker threads.
+
+KBUS only allows one Replier for each message name, so a Replier that does
+its work in a single thread can only handle one Request at a time. A
+ReplierServer reads Requests in one thread, hands them to a pool of worker
+threads to be handled, and sends the Replies back from another.
+"""
+
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is the KBUS Lightweight Linux-kernel mediated
+# message system
+#
+# The Initial Developer of the Original Code is Kynesim, Cambridge UK.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Kynesim, Cambridge UK
+#
+# ***** END LICENSE BLOCK *****
+
+from __future__ import with_statement
+import errno
+import Queue
+import select
+import sys
+import threading
+import time
+import traceback
+
+from kbus import Ksock, Message, reply_to
+from kbus.messages import _name_matches, _name_specificity, _BoundedDict
+
+class ReplierServer(object):
+    """Serve Requests for a set of message names.
+
+    - which is the Ksock device number (as in ``/dev/kbus<which>``).
+    - handlers is a dictionary of { <message_name> : <handler> }. We bind
+      as Replier to each message name (which may be a wildcard).
+    - num_workers is how many worker threads to run the handlers in.
+    - max_unreplied is how many Requests we may have read and not yet
+      replied to (or given up on replying to). When there are that many,
+      we stop reading more until some have been replied to, so that
+      Requests are left queued in KBUS (where their senders can see them)
+      rather than in our own queues. It defaults to twice the number of
+      workers.
+
+    Each handler is called (in a worker thread) with the Request, and should
+    return either a Message to send as the Reply (normally constructed
+    with 'reply_to'), or the data for such a Reply (or None for a Reply
+    with no data).
+
+    If a handler raises an exception, 'handle_error' is called - see that
+    for what happens by default.
+
+    If reading Requests fails (for instance, with an IOError from KBUS), the
+    error is reported to stderr and remembered as 'error', and the server
+    stops reading, finishes the Requests it has already read, and closes
+    down its threads. 'serve_forever' then returns.
+
+    All Replies are sent from a single thread, in the order that the handlers
+    finish. If KBUS cannot deliver a Reply yet, because its requester's queue
+    is full, it is tried again every RETRY_INTERVAL seconds, for up to
+    REPLY_TIMEOUT seconds. If a Reply cannot be sent for any other reason
+    (for instance, because the requester has gone away), the error is
+    reported to stderr, and the Reply abandoned.
+
+    For instance::
+
+        def add_one(request):
+            return str(int(request.data) + 1)
+
+        with ReplierServer(0, {'$.AddOne':add_one}, num_workers=8):
+            ... do other things, whilst the server serves ...
+
+    or, to serve until interrupted::
+
+        server = ReplierServer(0, {'$.AddOne':add_one})
+        server.serve_forever()
+    """
+
+    # How often (in seconds) the dispatcher thread checks if it should stop
+    POLL_INTERVAL = 0.1
+
+    # How often (in seconds) to retry a Reply that KBUS said EBUSY to, and
+    # for how long before giving up on it
+    RETRY_INTERVAL = 0.01
+    REPLY_TIMEOUT = 5.0
+
+    # How many message names we remember the handler for
+    MAX_CACHED_NAMES = 1024
+
+    def __init__(self, which, handlers, num_workers=4, max_unreplied=None):
+        if num_workers < 1:
+            raise ValueError('A ReplierServer needs at least one worker,'
+                             ' not %d'%num_workers)
+        self.which = which
+        self.handlers = dict(handlers)
+        self.num_workers = num_workers
+        if max_unreplied is None:
+            max_unreplied = 2 * num_workers
+        self.max_unreplied = max_unreplied
+
+        # Exact names first, and then wildcards, most specific first
+        self._patterns = sorted(self.handlers, key=_name_specificity)
+        self._handler_cache = _BoundedDict(self.MAX_CACHED_NAMES)
+
+        self.ksock = None
+        self._requests = Queue.Queue()
+        self._replies = Queue.Queue()
+        self._replied = threading.Event()
+        # How many Requests we have read, and not yet replied to (or given
+        # up on). We count these ourselves, since KBUS's count of unreplied
+        # Requests never goes down for a Reply that it would not send.
+        self._outstanding = 0
+        self._outstanding_lock = threading.Lock()
+        self._stopping = False
+        self._threads = []
+        self.error = None
+
+    def __repr__(self):
+        return '<ReplierServer on device %d for %s, %d workers>'%(self.which,
+                ', '.join(sorted(self.handlers)), self.num_workers)
+
+    def start(self):
+        """Open our Ksock, bind our names, and start our threads.
+        """
+        if self.ksock is not None:
+            raise ValueError('ReplierServer is already started')
+        self.ksock = Ksock(self.which, 'rw')
+        try:
+            for name in self.handlers:
+                self.ksock.bind(name, True)
+        except:
+            self.ksock.close()
+            self.ksock = None
+            raise
+
+        self._stopping = False
+        self.error = None
+        self._outstanding = 0
+        self._threads = [threading.Thread(target=self._dispatch,
+                                          name='ReplierServer dispatcher')]
+        for ii in range(self.num_workers):
+            self._threads.append(threading.Thread(target=self._work,
+                                    name='ReplierServer worker %d'%ii))
+        self._sender = threading.Thread(target=self._send,
+                                        name='ReplierServer sender')
+        self._threads.append(self._sender)
+        # Start the dispatcher last, since it stops the others as it finishes
+        for thread in reversed(self._threads):
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop reading Requests, finish those already read, and close down.
+
+        Each Request that was read will have been replied to by the time
+        this returns.
+        """
+        if self.ksock is None:
+            return
+        self._stopping = True
+        # The dispatcher stops the other threads as it finishes
+        self._threads[0].join()
+        self._threads = []
+        self.ksock.close()
+        self.ksock = None
+
+    def serve_forever(self):
+        """Start, and then serve until interrupted (e.g., by ^C).
+        """
+        self.start()
+        try:
+            while self._sender.is_alive():
+                # Joining with a timeout lets KeyboardInterrupt through
+                self._sender.join(1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.stop()
+        return False
+
+    def handler_for(self, name):
+        """Return the handler for message name 'name'.
+
+        Raises KeyError if there isn't one.
+        """
+        try:
+            return self._handler_cache[name]
+        except KeyError:
+            pass
+        for pattern in self._patterns:
+            if _name_matches(pattern, name):
+                return self._handler_cache.remember(name,
+                                                    self.handlers[pattern])
+        raise KeyError(name)
+
+    def handle_error(self, request, exc_info):
+        """Called when handling 'request' raises an exception.
+
+        'exc_info' is as returned by sys.exc_info().
+
+        Returns the Reply to send. By default, prints the traceback to
+        stderr and returns a Reply with no data, so that the sender of the
+        Request is not left waiting. Override this to do something else.
+        """
+        traceback.print_exception(*exc_info)
+        return reply_to(request)
+
+    def _dispatch(self):
+        """Read Requests until told to stop (or reading fails).
+
+        Then stop the workers and the sender, once they have dealt with the
+        Requests already read.
+        """
+        try:
+            self._read_requests()
+        except Exception, e:
+            # Rather than leaving the workers and sender waiting forever
+            self.error = e
+            print >> sys.stderr, 'ReplierServer: error reading Requests,' \
+                                 ' stopping'
+            traceback.print_exc()
+        workers = self._threads[1:-1]
+        for worker in workers:
+            self._requests.put(None)
+        for worker in workers:
+            worker.join()
+        self._replies.put(None)
+        self._sender.join()
+
+    def _read_requests(self):
+        """Read Requests, and queue them for the workers.
+        """
+        ksock = self.ksock
+        while not self._stopping:
+            if self._outstanding >= self.max_unreplied:
+                # Let the workers (and sender) catch up
+                self._replied.wait(self.POLL_INTERVAL)
+                self._replied.clear()
+                continue
+            msg = ksock.read_next_msg()
+            if msg is None:
+                select.select([ksock], [], [], self.POLL_INTERVAL)
+            elif msg.wants_us_to_reply():
+                with self._outstanding_lock:
+                    self._outstanding += 1
+                self._requests.put(msg)
+
+    def _work(self):
+        """Handle Requests, and queue their Replies.
+        """
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            try:
+                result = self.handler_for(request.name)(request)
+                if not isinstance(result, Message):
+                    result = reply_to(request, data=result)
+            except Exception:
+                try:
+                    result = self.handle_error(request, sys.exc_info())
+                except Exception:
+                    traceback.print_exc()
+                    result = reply_to(request)
+            self._replies.put(result)
+
+    def _send(self):
+        """Send Replies, retrying those that KBUS cannot deliver yet.
+        """
+        retrying = []           # of (reply, give_up_at)
+        finishing = False
+        while retrying or not finishing:
+            try:
+                if retrying:
+                    reply = self._replies.get(timeout=self.RETRY_INTERVAL)
+                else:
+                    reply = self._replies.get()
+            except Queue.Empty:
+                reply = False
+            if reply is None:
+                finishing = True
+            elif reply:
+                retrying.append((reply, time.time() + self.REPLY_TIMEOUT))
+            retrying = [(reply, give_up_at) for reply, give_up_at in retrying
+                        if not self._send_reply(reply, give_up_at)]
+
+    def _send_reply(self, reply, give_up_at):
+        """Try to send 'reply'.
+
+        Returns False if it should be tried again later, True if it has been
+        sent (or given up on).
+        """
+        try:
+            self.ksock.send_msg(reply)
+        except IOError, e:
+            if e.errno == errno.EBUSY and time.time() < give_up_at:
+                # The requester's queue is full - it may yet read some
+                return False
+            # The sender of the Request may well have gone away
+            print >> sys.stderr, 'ReplierServer: error sending %s: %s'%(reply, e)
+        with self._outstanding_lock:
+            self._outstanding -= 1
+        self._replied.set()
+        return True
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab:
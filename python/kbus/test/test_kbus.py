@@ -61,18 +61,24 @@ import os
 import select
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import nose
 
 from itertools import permutations
 
-from kbus import Ksock, Message, MessageId, Announcement, \
-                 Request, Reply, Status, reply_to, OrigFrom
-from kbus import read_bindings
+from kbus import Ksock, Message, MessageId, Announcement, MessageView, \
+                 FrozenMessageId, MessageTemplate, Request, Reply, Status, \
+                 reply_to, OrigFrom, encode_batch, iter_messages
+from kbus import read_bindings, entire_message_struct_cache_info, BufferPool, \
+                 KsockPoller, AsyncKsock, SpinPolicy, \
+                 SendQueue, SendQueueFull, QueueTuner, ReplierDirectory
 from kbus.messages import _pointy_message_from_bytes
 from kbus.messages import _struct_to_bytes, _struct_from_bytes
 from kbus.messages import _MessageHeaderStruct, MSG_HEADER_LEN
 from kbus.messages import split_replier_bind_event_data
+from kbus.server import ReplierServer
 
 NUM_DEVICES = 3
 
@@ -3414,4 +3420,809 @@ class TestKernelModule:
                     thing.unbind('$.Fred.*')
                     thing.num_messages() == 0
 
+    def test_read_next_view(self):
+        """Test reading messages as MessageViews.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+
+                msg = Announcement('$.Fred', data='1234567')
+                msg_id = sender.send_msg(msg)
+
+                view = listener.read_next_view()
+                assert isinstance(view, MessageView)
+                assert view.name == '$.Fred'
+                assert view.data.tobytes() == '1234567'
+                assert view.id == msg_id
+                assert view.from_ == sender.ksock_id()
+                assert view.to_message() == Message('$.Fred', data='1234567',
+                                                    from_=sender.ksock_id(),
+                                                    id=msg_id)
+
+                msg = Announcement('$.Fred')
+                sender.send_msg(msg)
+                view = listener.read_next_view()
+                assert view.name == '$.Fred'
+                assert view.data is None
+
+                assert listener.read_next_view() is None
+
+    def test_send_entire_message(self):
+        """Test sending messages constructed from bytes (i.e., "entire").
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+
+                # Make sure we try data lengths that do, and do not, leave
+                # padding at the end of the "entire" message datastructure
+                for data in (None, '1', '12', '123', '1234', '12345678'):
+                    msg = Message.from_bytes(Message('$.Fred', data).to_bytes())
+                    sender.send_msg(msg)
+                    ann = listener.read_next_msg()
+                    assert msg.equivalent(ann)
+
+    def test_reading_many_sizes_of_message(self):
+        """Test that reading many sizes of message doesn't build many classes.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+
+                before = entire_message_struct_cache_info()
+                for ii in range(200):
+                    msg = Announcement('$.Fred', data='x'*ii)
+                    sender.send_msg(msg)
+                    ann = listener.read_next_msg()
+                    assert msg.equivalent(ann)
+                    # And what we read can be sent on again
+                    sender.send_msg(ann)
+                    assert msg.equivalent(listener.read_next_msg())
+                after = entire_message_struct_cache_info()
+                assert after['size'] <= after['max_size']
+                assert after['misses'] == before['misses']
+
+    def test_frozen_message_ids(self):
+        """Test using frozen message ids as dictionary keys.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as replier:
+                replier.bind('$.Fred', True)
+
+                pending = {}
+                for ii in range(10):
+                    msg_id = sender.send_msg(Message('$.Fred', flags=Message.WANT_A_REPLY))
+                    pending[msg_id.frozen()] = ii
+
+                for ii in range(10):
+                    req = replier.read_next_msg()
+                    assert pending[req.id.frozen()] == ii
+                    assert req.id.frozen() == FrozenMessageId(req.id.network_id,
+                                                       req.id.serial_num)
+                    assert req.id.frozen().thaw() == req.id
+                    replier.send_msg(reply_to(req))
+
+                for ii in range(10):
+                    rep = sender.read_next_msg()
+                    assert pending.pop(rep.in_reply_to.frozen()) == ii
+                assert pending == {}
+
+    def test_send_template(self):
+        """Test sending messages from a MessageTemplate.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                template = MessageTemplate('$.Fred', flags=Message.URGENT)
+
+                for data in (None, '1', '12', '123', '1234', '12345678'):
+                    msg_id = sender.send_template(template, data)
+                    ann = listener.read_next_msg()
+                    assert ann.id == msg_id
+                    assert ann.equivalent(Message('$.Fred', data,
+                                                  flags=Message.URGENT))
+
+                    msg_id = sender.send_msg(template.render(data))
+                    ann = listener.read_next_msg()
+                    assert ann.id == msg_id
+                    assert ann.equivalent(Message('$.Fred', data,
+                                                  flags=Message.URGENT))
+
+    def test_send_cloned_message(self):
+        """Test sending messages copied with from_message (and not changing data).
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                listener.bind('$.Jim')
+
+                sender.send_msg(Message('$.Fred', '1234', flags=Message.URGENT))
+                ann = listener.read_next_msg()
+
+                # Forward what we received, but not urgently this time
+                msg = Message.from_message(ann, flags=0, id=MessageId(0, 0))
+                assert msg.data == '1234'
+                assert ann.flags == Message.URGENT      # unchanged
+                msg_id = sender.send_msg(msg)
+                ann2 = listener.read_next_msg()
+                assert ann2.id == msg_id
+                assert ann2.equivalent(Message('$.Fred', '1234'))
+
+                # And as an Announcement
+                msg = Announcement.from_message(ann2, id=MessageId(0, 0))
+                sender.send_msg(msg)
+                assert listener.read_next_msg().equivalent(msg)
+
+    def test_recv_into(self):
+        """Test reading messages into a buffer of our own.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                buffer = bytearray(1000)
+
+                assert listener.recv_into(buffer) == 0
+
+                msg = Message('$.Fred', '12345678')
+                sender.send_msg(msg)
+                length = listener.recv_into(buffer)
+                assert length == msg.total_length()
+                assert Message.from_bytes(buffer[:length]).equivalent(msg)
+
+                # A buffer that is too short leaves the message to be read
+                sender.send_msg(msg)
+                nose.tools.assert_raises(ValueError, listener.recv_into,
+                                         bytearray(10))
+                assert listener.len_left() == length
+                data = listener.read_data(length)
+                assert Message.from_bytes(data).equivalent(msg)
+
+    def test_pooled_views(self):
+        """Test reading messages into buffers from a BufferPool.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                pool = BufferPool()
+
+                assert listener.read_next_pooled_view(pool) is None
+
+                for ii in range(100):
+                    msg = Message('$.Fred', 'x'*(ii%10))
+                    sender.send_msg(msg)
+                    view = listener.read_next_pooled_view(pool)
+                    assert view.to_message().equivalent(msg)
+                    view.release()
+
+                # All of those messages fit into the same size of buffer
+                info = pool.info()
+                assert info['allocated'] == 1
+                assert info['reused'] == 99
+
+    def test_recv_batch(self):
+        """Test reading pending messages in batches.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+
+                assert listener.recv_batch() == []
+
+                sent = []
+                for ii in range(10):
+                    msg = Message('$.Fred', 'x'*ii)
+                    sender.send_msg(msg)
+                    sent.append(msg)
+
+                batch = listener.recv_batch(max_count=3)
+                assert len(batch) == 3
+
+                # Any message is longer than its header, so this should
+                # give us just one message
+                batch += listener.recv_batch(max_bytes=MSG_HEADER_LEN)
+                assert len(batch) == 4
+
+                batch += listener.recv_batch()
+                assert len(batch) == 10
+                for msg, got in zip(sent, batch):
+                    assert msg.equivalent(got)
+
+                assert listener.num_messages() == 0
+                assert listener.recv_batch() == []
+
+    def test_messages_generator(self):
+        """Test the messages() generator.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+
+                for ii in range(5):
+                    sender.send_msg(Message('$.Fred', 'x'*ii))
+
+                got = list(listener.messages(timeout=0.1))
+                assert len(got) == 5
+                for ii, msg in enumerate(got):
+                    assert msg.data == ('x'*ii or None)
+
+                # And with nothing there, it should just time out
+                assert list(listener.messages(timeout=0.1)) == []
+
+                # Asking for batches of no messages would never get anywhere
+                nose.tools.assert_raises(ValueError, listener.messages,
+                                         max_count=0)
+
+    def test_one_syscall_per_message(self):
+        """Test that each message is written, and read, with one system call.
+        """
+        if system('strace -V') != 0:
+            raise nose.SkipTest('strace is not available')
+
+        script = '\n'.join([
+            'from kbus import Ksock, Message',
+            'sender = Ksock(0, "rw")',
+            'listener = Ksock(0, "rw")',
+            'listener.bind("$.Fred")',
+            'for ii in range(10):',
+            '    sender.send_msg(Message("$.Fred", "x"*(ii*1000)))',
+            '    listener.read_next_msg()',
+            ])
+        fd, trace_file = tempfile.mkstemp(prefix='kbus_syscalls_')
+        os.close(fd)
+        try:
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(sys.path)
+            retcode = subprocess.call(['strace', '-y', '-e', 'trace=read,write',
+                                       '-o', trace_file,
+                                       sys.executable, '-c', script], env=env)
+            assert retcode == 0
+
+            with open(trace_file) as f:
+                lines = [line for line in f if '</dev/kbus0>' in line]
+        finally:
+            os.remove(trace_file)
+
+        writes = [line for line in lines if line.startswith('write(')]
+        reads  = [line for line in lines if line.startswith('read(')]
+        assert len(writes) == 10
+        assert len(reads) == 10
+
+    def test_binding_many_names(self):
+        """Test binding more names than a Ksock remembers ioctl arguments for.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                names = ['$.Fred.%d'%ii for ii in range(300)]
+                for name in names:
+                    listener.bind(name)
+                    assert sender.find_replier(name) is None
+                for name in names:
+                    sender.send_msg(Message(name))
+                    assert listener.read_next_msg().name == name
+                for name in names:
+                    listener.unbind(name)
+                sender.send_msg(Message(names[0]))
+                assert listener.num_messages() == 0
+
+    def test_poller(self):
+        """Test waiting on several Ksocks with a KsockPoller.
+        """
+        with Ksock(0, 'rw') as sender:
+            with KsockPoller() as poller:
+                listeners = [Ksock(0, 'rw') for ii in range(5)]
+                try:
+                    for ii, listener in enumerate(listeners):
+                        listener.bind('$.Fred.%d'%ii)
+                        poller.register(listener)
+
+                    assert poller.poll(0) == []
+
+                    sender.send_msg(Message('$.Fred.1'))
+                    sender.send_msg(Message('$.Fred.3'))
+                    sender.send_msg(Message('$.Fred.3'))
+                    ready = dict(poller.poll(1.0))
+                    assert ready == {listeners[1]:1, listeners[3]:2}
+
+                    # Level triggered, so still ready if we don't read
+                    assert dict(poller.poll(1.0)) == ready
+
+                    listeners[1].read_next_msg()
+                    assert dict(poller.poll(1.0)) == {listeners[3]:2}
+
+                    poller.unregister(listeners[3])
+                    assert poller.poll(0) == []
+                finally:
+                    for listener in listeners:
+                        listener.close()
+
+    def test_poller_edge_triggered(self):
+        """Test an edge triggered KsockPoller.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                with KsockPoller(edge_triggered=True) as poller:
+                    listener.bind('$.Fred')
+                    poller.register(listener)
+
+                    sender.send_msg(Message('$.Fred'))
+                    sender.send_msg(Message('$.Fred'))
+                    assert poller.poll(1.0) == [(listener, 2)]
+
+                    # We haven't read anything, but nothing new has arrived
+                    assert poller.poll(0) == []
+
+                    sender.send_msg(Message('$.Fred'))
+                    assert poller.poll(1.0) == [(listener, 3)]
+
+    def test_async_ksock(self):
+        """Test receiving and sending via an AsyncKsock.
+        """
+        try:
+            import asyncio
+        except ImportError:
+            try:
+                import trollius as asyncio
+            except ImportError:
+                raise nose.SkipTest('Neither asyncio nor trollius is available')
+
+        loop = asyncio.new_event_loop()
+        try:
+            with Ksock(0, 'rw') as sender:
+                with Ksock(0, 'rw') as listener:
+                    listener.bind('$.Fred')
+                    asender = AsyncKsock(sender, loop)
+                    alistener = AsyncKsock(listener, loop)
+
+                    # Ask for a message before there is one
+                    future = alistener.recv()
+                    assert not future.done()
+                    msg_id = loop.run_until_complete(
+                            asender.send(Message('$.Fred', '1234')))
+                    msg = loop.run_until_complete(future)
+                    assert msg.id == msg_id
+                    assert msg.data == '1234'
+
+                    for ii in range(3):
+                        sender.send_msg(Message('$.Fred'))
+                    batch = loop.run_until_complete(alistener.recv_batch())
+                    assert len(batch) == 3
+
+                    alistener.close()
+                    asender.close()
+        finally:
+            loop.close()
+
+    def test_call(self):
+        """Test sending Requests and waiting for their Replies with call().
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as replier:
+                replier.bind('$.Fred', True)
+                sender.bind('$.Jim')
+
+                # Nothing replies, so we time out
+                assert sender.call(Request('$.Fred'), timeout=0.1) is None
+                req = replier.read_next_msg()
+
+                # Reply to that first Request (late), and send an unrelated
+                # message, so that both are waiting before the Replies to
+                # the Requests we're about to make
+                replier.send_msg(reply_to(req, data='late'))
+                replier.send_msg(Message('$.Jim', 'unrelated'))
+
+                nose.tools.assert_raises(ValueError, sender.call_many,
+                                         [Message('$.Fred')])
+
+                # We can't reply until the Requests are sent, so do this
+                # from another process
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        for ii in range(10):
+                            req = replier.wait_for_msg(1.0)
+                            replier.send_msg(reply_to(req, data=req.data))
+                    finally:
+                        os._exit(0)
+
+                requests = [Request('$.Fred', str(ii)) for ii in range(10)]
+                replies = sender.call_many(requests, timeout=5.0)
+                os.waitpid(pid, 0)
+                assert [r.data for r in replies] == [str(ii) for ii in range(10)]
+
+                # And the other messages are still there to be read
+                assert sender.num_held() == 2
+                assert sender.num_messages() == 0
+                assert sender.read_next_msg().data == 'late'
+                assert sender.read_next_msg().data == 'unrelated'
+                assert sender.read_next_msg() is None
+
+    def test_replier_server(self):
+        """Test serving Requests with a ReplierServer.
+        """
+        in_progress = [0]
+        most_in_progress = [0]
+        lock = threading.Lock()
+
+        def slow_echo(request):
+            with lock:
+                in_progress[0] += 1
+                most_in_progress[0] = max(most_in_progress[0], in_progress[0])
+            time.sleep(0.05)
+            with lock:
+                in_progress[0] -= 1
+            return request.data
+
+        def broken(request):
+            raise ValueError('Deliberately broken')
+
+        handlers = {'$.Echo':slow_echo, '$.Broken.*':broken}
+        with ReplierServer(0, handlers, num_workers=4) as server:
+            with Ksock(0, 'rw') as sender:
+                requests = [Request('$.Echo', str(ii)) for ii in range(20)]
+                replies = sender.call_many(requests, timeout=10.0)
+                assert [r.data for r in replies] == [str(ii) for ii in range(20)]
+
+                # The handlers should have been run in parallel
+                assert most_in_progress[0] > 1
+
+                # A handler that fails still gets a (blank) reply sent
+                reply = sender.call(Request('$.Broken.Thing'), timeout=10.0)
+                assert reply.is_reply()
+                assert reply.data is None
+
+    def test_replier_server_read_error(self):
+        """Test that a ReplierServer stops cleanly if reading Requests fails.
+        """
+        def failing_read():
+            raise IOError(errno.EIO, 'Deliberately broken')
+
+        server = ReplierServer(0, {'$.Echo':lambda request: request.data})
+        server.start()
+        try:
+            with Ksock(0, 'rw') as sender:
+                reply = sender.call(Request('$.Echo', 'one'), timeout=10.0)
+                assert reply.data == 'one'
+
+            server.ksock.read_next_msg = failing_read
+            # All of the server's threads should finish, without being told
+            server._sender.join(10.0)
+            assert not server._sender.is_alive()
+            assert isinstance(server.error, IOError)
+        finally:
+            server.stop()
+
+    def test_replier_server_requester_gone(self):
+        """Test a ReplierServer carries on when requesters go away.
+
+        Each Reply that cannot be sent still counts as dealt with, so the
+        server does not stop reading Requests once 'max_unreplied' Replies
+        have failed.
+        """
+        def slow_echo(request):
+            time.sleep(0.05)
+            return request.data
+
+        with ReplierServer(0, {'$.Echo':slow_echo}, num_workers=1,
+                           max_unreplied=2) as server:
+            for ii in range(5):
+                with Ksock(0, 'rw') as sender:
+                    sender.send_msg(Request('$.Echo', str(ii)))
+                # The requester has gone by the time the Reply is sent
+
+            with Ksock(0, 'rw') as sender:
+                reply = sender.call(Request('$.Echo', 'still here'),
+                                    timeout=10.0)
+                assert reply is not None
+                assert reply.data == 'still here'
+
+    def test_replier_server_handler_cache(self):
+        """Test that a ReplierServer only remembers so many handlers.
+        """
+        def echo(request):
+            return request.data
+
+        def fred(request):
+            return 'Fred'
+
+        server = ReplierServer(0, {'$.*':echo, '$.Fred':fred})
+        for ii in range(server.MAX_CACHED_NAMES * 3):
+            assert server.handler_for('$.Name%d'%ii) == echo
+            assert len(server._handler_cache) <= server.MAX_CACHED_NAMES
+        assert server.handler_for('$.Fred') == fred
+        nose.tools.assert_raises(KeyError, server.handler_for, '$')
+
+    def test_spin_for_msg(self):
+        """Test waiting for messages by spinning first.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                policy = SpinPolicy(spin_time=0.01, adaptive=False)
+
+                # A message that is already there is found by spinning
+                sender.send_msg(Message('$.Fred', '1'))
+                msg = listener.spin_for_msg(policy=policy)
+                assert msg.data == '1'
+
+                # With nothing there, we spin and then time out
+                assert listener.spin_for_msg(timeout=0.05, policy=policy) is None
+
+                report = policy.report()
+                assert report['spun'] == 1
+                assert report['blocked'] == 1
+                assert report['spin_time_wasted'] >= 0.01
+
+                # And the default policy works too
+                sender.send_msg(Message('$.Fred', '2'))
+                assert listener.spin_for_msg().data == '2'
+                assert listener.spin_policy.report()['spun'] == 1
+
+    def test_send_queue(self):
+        """Test queueing messages that KBUS cannot send yet.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as replier:
+                replier.bind('$.Fred', replier=True)
+                assert replier.set_max_messages(1) == 1
+                queue = SendQueue(sender, max_depth=2,
+                                  policies={'$.Fred':'drop_old'},
+                                  retry_interval=0.05)
+
+                # The first Request fits in the Replier's queue, and the
+                # rest have to wait (KBUS says EBUSY)
+                assert queue.send(Request('$.Fred', '1')) is not None
+                assert queue.send(Request('$.Fred', '2')) is None
+                assert queue.retry_at is not None
+                assert queue.send(Request('$.Fred', '3')) is None
+                assert queue.depth == 2
+                assert queue.flush() == []
+
+                # With no room, the oldest queued Request is dropped
+                assert queue.send(Request('$.Fred', '4')) is None
+                assert queue.depth == 2
+                assert queue.dropped == {'$.Fred':1}
+
+                # Once the Replier has read a Request, there is room again,
+                # but we don't try again until we're due to
+                assert replier.read_next_msg().data == '1'
+                assert queue.flush() == []
+                time.sleep(max(0.0, queue.retry_at - time.time()))
+                assert len(queue.flush()) == 1
+                assert queue.depth == 1
+                assert replier.read_next_msg().data == '3'
+                assert queue.wait(1.0)
+                assert replier.read_next_msg().data == '4'
+                assert queue.depth == 0
+                assert queue.queued_bytes == 0
+
+                # The default policy is to complain
+                strict = SendQueue(sender, max_depth=1)
+                assert strict.send(Request('$.Fred', '5')) is not None
+                assert strict.send(Request('$.Fred', '6')) is None
+                nose.tools.assert_raises(SendQueueFull, strict.send,
+                                         Request('$.Fred', '7'))
+                assert strict.discard() == 1
+
+    def test_send_queue_all_or_wait(self):
+        """Test queueing messages behind one that KBUS is still sending.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'r') as listener:
+                listener.bind('$.Fred')
+                assert listener.set_max_messages(1) == 1
+                queue = SendQueue(sender)
+
+                m = Message('$.Fred', flags=Message.ALL_OR_WAIT)
+                assert queue.send(m) is not None
+                # KBUS says EAGAIN, and keeps trying
+                assert queue.send(m) is None
+                assert queue.waiting_for_writable
+                assert queue.send(m) is None
+                assert queue.depth == 2
+                assert queue.flush() == []
+
+                # Reading a message lets KBUS finish sending, and then we
+                # can send the next (which then waits in its turn)
+                listener.read_next_msg()
+                assert len(queue.flush()) == 1
+                assert queue.waiting_for_writable
+                assert queue.depth == 1
+                listener.read_next_msg()
+                assert queue.wait(1.0)
+                assert not queue.waiting_for_writable
+
+    def test_tune_max_messages(self):
+        """Test adjusting max_messages automatically.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                assert listener.set_max_messages(10) == 10
+                decisions = []
+                tuner = listener.tune_max_messages(min_messages=5,
+                                                   max_messages=40,
+                                                   interval=0,
+                                                   sample_every=1,
+                                                   log=decisions.append)
+                assert listener.queue_tuner is tuner
+
+                # A nearly full queue makes it grow
+                for ii in range(9):
+                    sender.send_msg(Message('$.Fred', str(ii)))
+                assert listener.read_next_msg().data == '0'
+                assert listener.max_messages() == 20
+                assert len(decisions) == 1
+                assert tuner.decisions[-1][1:3] == (10, 20)
+
+                # And an empty one (eventually) makes it shrink
+                listener.stop_tuning_max_messages()
+                while listener.read_next_msg():
+                    pass
+                tuner = listener.tune_max_messages(min_messages=5,
+                                                   max_messages=40,
+                                                   interval=0,
+                                                   sample_every=1)
+                for ii in range(tuner.shrink_after - 1):
+                    assert tuner.sample() is None
+                assert tuner.sample() == 10
+                assert listener.max_messages() == 10
+
+                # It never goes beyond its bounds
+                listener.set_max_messages(40)
+                for ii in range(35):
+                    sender.send_msg(Message('$.Fred', str(ii)))
+                listener.read_next_msg()
+                assert listener.max_messages() == 40
+
+                listener.stop_tuning_max_messages()
+                assert listener.queue_tuner is None
+
+    def test_bind_many(self):
+        """Test binding and unbinding many names at once.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                names = ['$.Fred.%d'%ii for ii in range(300)]
+                assert listener.bind_many(names) == names
+                assert listener.bindings() == sorted((name, False) for name in names)
+                assert listener.is_bound('$.Fred.0')
+                assert not listener.is_bound('$.Fred.0', True)
+
+                # Binding the same names again does nothing
+                assert listener.bind_many(names + names[:1]) == []
+                sender.send_msg(Message(names[0]))
+                assert listener.read_next_msg().name == names[0]
+                assert listener.num_messages() == 0
+
+                assert listener.unbind_many(names[:100]) == names[:100]
+                assert listener.unbind_many(names[:100]) == []
+                sender.send_msg(Message(names[0]))
+                assert listener.num_messages() == 0
+                assert len(listener.bindings()) == 200
+
+                # Ordinary binds are remembered as well, including repeats
+                listener.bind('$.Jim')
+                listener.bind('$.Jim')
+                assert listener.bindings().count(('$.Jim', False)) == 2
+                listener.unbind('$.Jim')
+                assert listener.is_bound('$.Jim')
+                listener.unbind('$.Jim')
+                assert not listener.is_bound('$.Jim')
+
+    def test_bind_many_rolls_back(self):
+        """Test that failing to bind one name unbinds the others.
+        """
+        with Ksock(0, 'rw') as replier:
+            with Ksock(0, 'rw') as listener:
+                replier.bind('$.Fred.2', True)
+
+                names = ['$.Fred.%d'%ii for ii in range(5)]
+                check_IOError(errno.EADDRINUSE, listener.bind_many, names, True)
+                assert listener.bindings() == []
+                for name in names:
+                    if name != '$.Fred.2':
+                        assert replier.find_replier(name) is None
+
+                names.remove('$.Fred.2')
+                assert listener.bind_many(names, True) == names
+                assert len(listener.bindings()) == 4
+
+    def test_replier_directory(self):
+        """Test keeping track of Repliers with a ReplierDirectory.
+        """
+        with Ksock(0, 'rw') as watcher:
+            with Ksock(0, 'rw') as first:
+                with Ksock(0, 'rw') as second:
+                    first_id = first.ksock_id()
+                    second_id = second.ksock_id()
+
+                    # Bindings made before we start are found by seeding
+                    first.bind('$.Fred', True)
+                    first.bind('$.Jim.*', True)
+                    try:
+                        repliers = ReplierDirectory(watcher)
+                        assert not repliers.stale
+                        assert watcher.is_bound('$.KBUS.ReplierBindEvent')
+                        assert repliers.find_replier('$.Fred') == first_id
+                        assert repliers.find_replier('$.Jim.Bob') == first_id
+                        assert repliers.find_replier('$.Bob') is None
+
+                        # And later ones from the ReplierBindEvents
+                        second.bind('$.Jim.%', True)
+                        second.bind('$.Bob', True)
+                        first.unbind('$.Fred', True)
+                        while True:
+                            msg = watcher.read_next_msg()
+                            if msg is None:
+                                break
+                            assert repliers.handle_message(msg)
+
+                        # The more specific wildcard wins, as it does in KBUS
+                        assert repliers.find_replier('$.Jim.Bob') == second_id
+                        assert repliers.find_replier('$.Jim.Bob.X') == first_id
+                        assert repliers.find_replier('$.Bob') == second_id
+                        assert repliers.find_replier('$.Fred') is None
+                        for name in ('$.Jim.Bob', '$.Jim.Bob.X', '$.Bob'):
+                            assert repliers.find_replier(name) == \
+                                    self._who_gets_request(first, second, name)
+
+                        # An exact lookup agrees with KBUS's own find_replier
+                        for name in ('$.Jim.Bob', '$.Jim.%', '$.Jim.*', '$.Bob'):
+                            assert repliers.find_replier(name, exact=True) == \
+                                    watcher.find_replier(name)
+
+                        repliers.invalidate()
+                        assert repliers.stale
+                        repliers.refresh()
+                        assert not repliers.stale
+                        assert repliers.repliers() == {'$.Jim.*':first_id,
+                                                       '$.Jim.%':second_id,
+                                                       '$.Bob':second_id}
+                    finally:
+                        watcher.report_replier_binds(False)
+
+    def _who_gets_request(self, first, second, name):
+        """Send a Request to 'name', and say which of our Ksocks got it.
+        """
+        with Ksock(0, 'rw') as sender:
+            sender.send_msg(Request(name))
+        for ksock in (first, second):
+            msg = ksock.read_next_msg()
+            if msg is not None:
+                return ksock.ksock_id()
+        return None
+
+    def test_encode_batch_round_trip(self):
+        """Test sending messages from encode_batch, and reading them back.
+        """
+        with Ksock(0, 'rw') as sender:
+            with Ksock(0, 'rw') as listener:
+                listener.bind('$.Fred')
+                originals = [Message('$.Fred', '1234'),
+                             Message('$.Fred'),
+                             Message('$.Fred', 'abcdefg'*100),
+                             Message('$.Fred', data='x')]
+                buf, offsets = encode_batch(originals)
+                ends = list(offsets[1:]) + [len(buf)]
+                for start, end in zip(offsets, ends):
+                    sender.write_data(buf[start:end])
+                    sender.send()
+
+                received = []
+                for ii in range(len(originals)):
+                    received.append(listener.read_data(listener.next_msg()))
+                assert listener.next_msg() == 0
+
+                messages = list(iter_messages(''.join(received)))
+                assert len(messages) == len(originals)
+                for msg, orig in zip(messages, originals):
+                    assert msg.name == orig.name
+                    assert msg.data == orig.data
+                    assert msg.from_ == sender.ksock_id()
+
+                views = list(iter_messages(''.join(received), views=True))
+                assert [view.name.tobytes() for view in views] == \
+                       [orig.name for orig in originals]
+
 # vim: set tabstop=8 shiftwidth=4 softtabstop=4 expandtab:
@@ -476,6 +476,42 @@ class TestLimpets(object):
                     print 'Finally, got',str(m)
                     assert m.name == '$.KBUS.Replier.NotSameKsock'
 
+    def _read_burst(self, ksock, count):
+        """Read 'count' messages from 'ksock', and return their data.
+        """
+        data = []
+        for ii in range(count):
+            m = ksock.wait_for_msg(TIMEOUT)
+            assert m is not None
+            data.append(m.data)
+        return data
+
+    def test_bursts_both_ways(self):
+        """Test bursts of messages going both ways at once.
+
+        Each burst is larger than the number of messages a Limpet forwards
+        in one direction before it looks at the other (64 by default, in
+        each direction), but small enough to fit on a Limpet's KBUS queue.
+        """
+        count = 90
+        with Ksock(KBUS_SENDER, 'rw') as here:
+            with Ksock(KBUS_LISTENER, 'rw') as there:
+                here.set_max_messages(count * 2)
+                there.set_max_messages(count * 2)
+                here.bind('$.Burst.Back')
+                there.bind('$.Burst.Out')
+
+                for ii in range(count):
+                    here.send_msg(Message('$.Burst.Out', str(ii)))
+                    there.send_msg(Message('$.Burst.Back', str(ii)))
+
+                # Everything arrives, and in order
+                expected = [str(ii) for ii in range(count)]
+                assert self._read_burst(there, count) == expected
+                assert self._read_burst(here, count) == expected
+                assert here.next_msg() == 0
+                assert there.next_msg() == 0
+
 
 import traceback
 
@@ -0,0 +1,652 @@
+#! /usr/bin/env python
+"""Microbenchmarks for the Python KBUS bindings.
+
+Usage:  ./bench.py [<benchmark> ...]
+
+With no arguments, lists the available benchmarks. Use 'all' to run all of
+them.
+
+Each benchmark compares the (old) ctypes-based way of doing something with
+the newer way, and reports how many times per second each managed it. Unless
+stated otherwise, the benchmarks do not need KBUS itself to be loaded.
+
+Run from the ``python`` directory, with that directory on the PYTHONPATH
+(as for the tests).
+"""
+
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is the KBUS Lightweight Linux-kernel mediated
+# message system
+#
+# The Initial Developer of the Original Code is Kynesim, Cambridge UK.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Kynesim, Cambridge UK
+#
+# ***** END LICENSE BLOCK *****
+
+from __future__ import with_statement
+import array
+import ctypes
+import fcntl
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+
+from kbus import Ksock, read_bindings
+from kbus.ksock import BindStruct
+from kbus.limpet import serialise_message, serialise_message_header, \
+        unserialise_message_header, configure_socket, LimpetFrameReader, \
+        _message_from_network, _SERIALISED_MESSAGE_HEADER_LEN, \
+        convert_ReplierBindEvent_data_to_network, \
+        convert_ReplierBindEvent_data_from_network
+from kbus.messages import Message, MessageId, OrigFrom, MessageView, \
+        MessageTemplate, _ReplierBindEventHeader
+from kbus.messages import _MessageHeaderStruct, _struct_from_bytes, \
+        _struct_to_bytes, _entire_message_from_parts, _entire_message_from_bytes, \
+        _entire_message_struct_from_bytes, entire_message_struct_cache_info, \
+        _encode_entire_message, _decode_message_header, calc_entire_message_len, \
+        calc_padded_data_len, calc_padded_name_len, _padded_data_array, \
+        c_data_as_string
+
+def rate(fn, count, repeat=3):
+    """Return how many times per second 'fn' can be called (best of 'repeat').
+    """
+    timer = timeit.Timer(fn)
+    best = min(timer.repeat(repeat, count))
+    return count / best
+
+def report(what, old, new):
+    """Report an old and new rate, and the ratio between them.
+    """
+    print '%-36s %12.0f/s %12.0f/s %6.1fx'%(what, old, new, new/old)
+
+def header():
+    print '%-36s %14s %14s %7s'%('', 'old', 'new', '')
+
+def bench_codec(count=20000):
+    """Message header codec: ctypes structures versus struct.Struct
+    """
+    name = '$.Telemetry.Something'
+    data = 'x'*32
+    zero = (0, 0)
+    msg = Message(name, data)
+    msg_bytes = msg.to_bytes()
+    length = calc_entire_message_len(len(name), len(data))
+
+    def old_encode():
+        tmp = _entire_message_from_parts(MessageId(0, 0), MessageId(0, 0), 0, 0,
+                                         OrigFrom(0, 0), OrigFrom(0, 0), 0,
+                                         name, data)
+        return _struct_to_bytes(tmp)[:length]
+
+    def new_encode():
+        return _encode_entire_message(zero, zero, 0, 0, zero, zero, 0,
+                                      name, data)
+
+    def old_decode():
+        return _struct_from_bytes(_MessageHeaderStruct, msg_bytes)
+
+    def new_decode():
+        return _decode_message_header(msg_bytes)
+
+    def old_receive():
+        h = _entire_message_struct_from_bytes(msg_bytes)
+        return h.name, h.from_
+
+    def new_receive():
+        v = MessageView(msg_bytes)
+        return v.name, v.from_
+
+    header()
+    report('encode entire message', rate(old_encode, count),
+                                    rate(new_encode, count))
+    report('decode message header', rate(old_decode, count),
+                                    rate(new_decode, count))
+    report('receive, look at name and from_', rate(old_receive, count),
+                                               rate(new_receive, count))
+
+def _old_data_array(data):
+    """The old way of building a ctypes array from a string, byte by byte.
+    """
+    while len(data)%4:
+        data += '\0'
+    DataArray = ctypes.c_uint8 * len(data)
+    return DataArray( *[ord(x) for x in data] )
+
+def _old_data_as_string(data, data_len):
+    """The old way of turning a ctypes array into a string, byte by byte.
+    """
+    w = []
+    for ii in range(data_len):
+        w.append(chr(data[ii]))
+    return ''.join(w)
+
+def bench_payload(count=20):
+    """Large message payloads: per-byte loops versus bulk copies
+    """
+    # These are the sizes used in test_many_large_messages and
+    # test_quite_large_message, and then a rather larger one
+    PAGE_SIZE = 4096
+    sizes = [PAGE_SIZE/2 - 1, PAGE_SIZE/2, PAGE_SIZE/2 + 1,
+             PAGE_SIZE-1, PAGE_SIZE, PAGE_SIZE+1,
+             2*PAGE_SIZE-1, 2*PAGE_SIZE, 2*PAGE_SIZE+1,
+             64*1024 + 27, 1024*1024]
+
+    header()
+    for size in sizes:
+        data = 'x'*size
+
+        def old_send():
+            return _old_data_array(data)
+
+        def new_send():
+            return _padded_data_array(data, calc_padded_data_len(size))
+
+        array = new_send()
+
+        def old_receive():
+            return _old_data_as_string(array, size)
+
+        def new_receive():
+            return c_data_as_string(array, size)
+
+        report('build payload, %d bytes'%size, rate(old_send, count),
+                                               rate(new_send, count))
+        report('read payload, %d bytes'%size, rate(old_receive, count),
+                                              rate(new_receive, count))
+
+def bench_decode(count=2000):
+    """Decoding messages of many sizes: class-per-size versus bytearray
+    """
+    # Lots of different data lengths, as a long-running process with
+    # variable length payloads would see
+    messages = [Message('$.Fred', 'x'*n).to_bytes() for n in range(0, 4000, 4)]
+
+    def old_decode():
+        for data in messages:
+            _entire_message_struct_from_bytes(data)
+
+    def new_decode():
+        for data in messages:
+            _entire_message_from_bytes(data)
+
+    header()
+    report('decode %d sizes of message'%len(messages),
+           rate(old_decode, count/len(messages)+1)*len(messages),
+           rate(new_decode, count/len(messages)+1)*len(messages))
+    print 'Class cache: %s'%', '.join('%s %s'%(k, v) for k, v in
+                                       sorted(entire_message_struct_cache_info().items()))
+
+def bench_clone(count=20000):
+    """Copying a message with a changed header: re-encoding versus cloning
+    """
+    header()
+    for size in (0, 100, 4096):
+        msg = Message.from_bytes(Message('$.Fred', 'x'*size or None,
+                                         from_=27, id=MessageId(0, 132),
+                                         flags=Message.WANT_A_REPLY).to_bytes())
+
+        def old_copy():
+            return Message.from_sequence(msg.extract(), to=99)
+
+        def new_copy():
+            return Message.from_message(msg, to=99)
+
+        report('copy with new to, %d bytes data'%size, rate(old_copy, count),
+                                                        rate(new_copy, count))
+
+def have_kbus():
+    """Is KBUS loaded, so that we can benchmark actually using it?
+    """
+    return os.path.exists('/dev/kbus0')
+
+def bench_template(count=20000):
+    """Sending the same name repeatedly: Message versus MessageTemplate
+    """
+    name = '$.Telemetry.Something'
+    data = 'x'*32
+    template = MessageTemplate(name, flags=Message.URGENT)
+
+    def old_build():
+        return Message(name, data, flags=Message.URGENT).to_bytes()
+
+    def new_build():
+        return template.to_bytes(data)
+
+    header()
+    report('build message bytes', rate(old_build, count),
+                                  rate(new_build, count))
+
+    if not have_kbus():
+        print '(KBUS is not loaded, so not timing sending)'
+        return
+
+    with Ksock(0, 'rw') as sender:
+        with Ksock(0, 'rw') as listener:
+            listener.bind(name)
+
+            def old_send():
+                sender.send_msg(Message(name, data, flags=Message.URGENT))
+                listener.read_next_msg()
+
+            def new_send():
+                sender.send_template(template, data)
+                listener.read_next_msg()
+
+            report('send (and read) message', rate(old_send, count),
+                                                 rate(new_send, count))
+
+def bench_io(count=20000):
+    """Sending and reading messages: buffered versus raw Ksock files
+    """
+    if not have_kbus():
+        print '(KBUS is not loaded, so there is nothing to time)'
+        return
+
+    name = '$.Telemetry.Something'
+    header()
+    for size in (0, 100, 4096):
+        msg = Message(name, 'x'*size or None)
+
+        def send_and_read(buffered):
+            with Ksock(0, 'rw', buffered=buffered) as sender:
+                with Ksock(0, 'rw', buffered=buffered) as listener:
+                    listener.bind(name)
+                    def fn():
+                        sender.send_msg(msg)
+                        listener.read_next_msg()
+                    return rate(fn, count)
+
+        report('send and read, %d bytes data'%size, send_and_read(True),
+                                                    send_and_read(False))
+
+def bench_ioctl(count=100000):
+    """Ksock ioctls: new arguments per call versus reused arguments
+    """
+    name = '$.Telemetry.Something'
+
+    def old_args():
+        return array.array('I', [0]), BindStruct(False, len(name), name)
+
+    cached = {(name, False): BindStruct(False, len(name), name)}
+    reused = array.array('I', [0])
+    def new_args():
+        return reused, cached[(name, False)]
+
+    header()
+    report('prepare ioctl arguments', rate(old_args, count),
+                                      rate(new_args, count))
+
+    if not have_kbus():
+        print '(KBUS is not loaded, so not timing the ioctls themselves)'
+        return
+
+    with Ksock(0, 'rw') as ksock:
+        def old_num_messages():
+            id = array.array('I', [0])
+            fcntl.ioctl(ksock.fd, Ksock.IOC_NUMMSGS, id, True)
+            return id[0]
+
+        def old_bind():
+            arg = BindStruct(False, len(name), name)
+            fcntl.ioctl(ksock.fd, Ksock.IOC_BIND, arg)
+            arg = BindStruct(False, len(name), name)
+            fcntl.ioctl(ksock.fd, Ksock.IOC_UNBIND, arg)
+
+        def new_bind():
+            ksock.bind(name)
+            ksock.unbind(name)
+
+        report('num_messages()', rate(old_num_messages, count),
+                                 rate(ksock.num_messages, count))
+        report('bind() and unbind()', rate(old_bind, count/10),
+                                      rate(new_bind, count/10))
+
+def bench_bindings(count=20, num_names=1000):
+    """Binding many names: one at a time versus bind_many, and finding them
+    """
+    if not have_kbus():
+        print '(KBUS is not loaded, so not timing binding)'
+        return
+
+    names = ['$.Telemetry.%d'%ii for ii in range(num_names)]
+    with Ksock(0, 'rw') as ksock:
+        def old_bind():
+            for name in names:
+                ksock.bind(name)
+            for name in names:
+                ksock.unbind(name)
+
+        def new_bind():
+            ksock.bind_many(names)
+            ksock.unbind_many(names)
+
+        header()
+        report('bind and unbind %d names'%num_names, rate(old_bind, count),
+                                                    rate(new_bind, count))
+
+        ksock.bind_many(names)
+        report('list %d bindings'%num_names,
+               rate(lambda: read_bindings({}), count),
+               rate(ksock.bindings, count))
+
+def _ping_pong(count, spin):
+    """Time 'count' round trips between two Ksocks, in two processes.
+
+    Returns the mean round trip time, and (if 'spin') our SpinPolicy.
+    """
+    with Ksock(0, 'rw') as pinger:
+        pinger.bind('$.Pong')
+        with Ksock(0, 'rw') as ponger:
+            ponger.bind('$.Ping')
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for ii in xrange(count):
+                        if spin:
+                            ponger.spin_for_msg()
+                        else:
+                            ponger.wait_for_msg()
+                        ponger.send_msg(Message('$.Pong'))
+                finally:
+                    os._exit(0)
+
+            ping = Message('$.Ping')
+            start = time.time()
+            for ii in xrange(count):
+                pinger.send_msg(ping)
+                if spin:
+                    pinger.spin_for_msg()
+                else:
+                    pinger.wait_for_msg()
+            elapsed = time.time() - start
+            os.waitpid(pid, 0)
+            return elapsed / count, pinger.spin_policy
+
+def bench_pingpong(count=10000):
+    """Ping-pong latency: blocking in select versus spinning first
+    """
+    if not have_kbus():
+        print '(KBUS is not loaded, so there is nothing to time)'
+        return
+
+    blocking, policy = _ping_pong(count, False)
+    spinning, policy = _ping_pong(count, True)
+    print '%-36s %12.1fus %12.1fus'%('mean round trip', blocking * 1e6,
+                                      spinning * 1e6)
+    report = policy.report()
+    print 'Our spinning: %(spun)d spun, %(blocked)d blocked,' \
+          ' %(spin_time_total).3fs spinning (%(spin_time_wasted).3fs wasted),' \
+          ' about %(latency_saved).3fs latency saved'%report
+
+def _old_write_message(sock, msg):
+    """Write a message to another Limpet as we used to, a field at a time.
+    """
+    sock.sendall(_old_serialise_message_header(msg))
+    sock.sendall(msg.name)
+    padded_name_len = calc_padded_name_len(msg.msg.name_len)
+    if len(msg.name) != padded_name_len:
+        sock.sendall('\0'*(padded_name_len - len(msg.name)))
+    if msg.msg.data_len:
+        sock.sendall(msg.data)
+        padded_data_len = calc_padded_data_len(msg.msg.data_len)
+        if len(msg.data) != padded_data_len:
+            sock.sendall('\0'*(padded_data_len - len(msg.data)))
+    sock.sendall(struct.pack('!L', Message.END_GUARD))
+
+def _new_write_message(sock, msg):
+    sock.sendall(serialise_message(msg))
+
+def _socket_pair(family):
+    """Return a connected pair of stream sockets of the given family.
+    """
+    if family == socket.AF_UNIX:
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    writer.connect(listener.getsockname())
+    reader, address = listener.accept()
+    listener.close()
+    return writer, reader
+
+def _drain(sock):
+    while sock.recv(65536):
+        pass
+
+def _limpet_throughput(family, write, nodelay, count):
+    """Return how many messages per second 'write' manages over 'family'.
+    """
+    writer, reader = _socket_pair(family)
+    configure_socket(writer, nodelay)
+    drainer = threading.Thread(target=_drain, args=(reader,))
+    drainer.start()
+    msg = Message('$.Telemetry.Something', 'x'*13)
+    try:
+        return rate(lambda: write(writer, msg), count)
+    finally:
+        writer.close()
+        drainer.join()
+        reader.close()
+
+def _echo_acks(sock, frame_len):
+    """Read frames of 'frame_len' bytes, acknowledging each with one byte.
+    """
+    while True:
+        if not sock.recv(frame_len, socket.MSG_WAITALL):
+            return
+        sock.sendall('A')
+
+def _limpet_round_trip(write, nodelay, count):
+    """Return the mean time to send a message over TCP and get an answer.
+    """
+    writer, reader = _socket_pair(socket.AF_INET)
+    configure_socket(writer, nodelay)
+    configure_socket(reader, nodelay)
+    msg = Message('$.Telemetry.Something', 'x'*13)
+    echoer = threading.Thread(target=_echo_acks,
+                              args=(reader, len(serialise_message(msg))))
+    echoer.start()
+    try:
+        start = time.time()
+        for ii in xrange(count):
+            write(writer, msg)
+            writer.recv(1)
+        return (time.time() - start) / count
+    finally:
+        writer.close()
+        echoer.join()
+        reader.close()
+
+_OldSerialisedHeader = ctypes.c_uint32 * _SERIALISED_MESSAGE_HEADER_LEN
+
+def _old_serialise_message_header(msg):
+    """Serialise a message header for the network as we used to.
+    """
+    array = _OldSerialisedHeader()
+    array[0]  = msg.msg.start_guard
+    array[1]  = msg.msg.id.network_id
+    array[2]  = msg.msg.id.serial_num
+    array[3]  = msg.msg.in_reply_to.network_id
+    array[4]  = msg.msg.in_reply_to.serial_num
+    array[5]  = msg.msg.to
+    array[6]  = msg.msg.from_
+    array[7]  = msg.msg.orig_from.network_id
+    array[8]  = msg.msg.orig_from.local_id
+    array[9]  = msg.msg.final_to.network_id
+    array[10] = msg.msg.final_to.local_id
+    array[11] = msg.msg.extra
+    array[12] = msg.msg.flags
+    array[13] = msg.msg.name_len
+    array[14] = msg.msg.data_len
+    array[15] = msg.msg.end_guard
+    for ii, item in enumerate(array):
+        array[ii] = socket.htonl(item)
+    return array
+
+def _old_unserialise_message_header(data):
+    """Unserialise a message header from the network as we used to.
+    """
+    array = _struct_from_bytes(_OldSerialisedHeader, data)
+    for ii, item in enumerate(array):
+        array[ii] = socket.ntohl(array[ii])
+    return array[13], array[14], array
+
+def _old_replier_bind_event_to_network(data):
+    hdr = _struct_from_bytes(_ReplierBindEventHeader, data)
+    hdr.is_bind  = socket.htonl(hdr.is_bind)
+    hdr.binder   = socket.htonl(hdr.binder)
+    hdr.name_len = socket.htonl(hdr.name_len)
+    rest = data[ctypes.sizeof(_ReplierBindEventHeader):]
+    return _struct_to_bytes(hdr)+rest
+
+def _old_replier_bind_event_from_network(data, data_len):
+    hdr = _struct_from_bytes(_ReplierBindEventHeader, data[:data_len])
+    hdr.is_bind  = socket.ntohl(hdr.is_bind)
+    hdr.binder   = socket.ntohl(hdr.binder)
+    hdr.name_len = socket.ntohl(hdr.name_len)
+    rest = data[ctypes.sizeof(_ReplierBindEventHeader):data_len]
+    return _struct_to_bytes(hdr)+rest
+
+def bench_limpetcodec(count=50000):
+    """Limpet headers: ctypes arrays and htonl versus struct.Struct('!16L')
+    """
+    msg = Message('$.Telemetry.Something', 'x'*13, to=3)
+    header_data = serialise_message_header(msg)
+    event_data = _struct_to_bytes(_ReplierBindEventHeader(1, 27, 6)) + \
+                 '$.Fred\0\0'
+    network_event_data = convert_ReplierBindEvent_data_to_network(event_data)
+
+    header()
+    report('serialise_message_header',
+           rate(lambda: _old_serialise_message_header(msg), count),
+           rate(lambda: serialise_message_header(msg), count))
+    report('unserialise_message_header',
+           rate(lambda: _old_unserialise_message_header(header_data), count),
+           rate(lambda: unserialise_message_header(header_data), count))
+    report('ReplierBindEvent to network',
+           rate(lambda: _old_replier_bind_event_to_network(event_data), count),
+           rate(lambda: convert_ReplierBindEvent_data_to_network(event_data),
+                count))
+    report('ReplierBindEvent from network',
+           rate(lambda: _old_replier_bind_event_from_network(
+                                network_event_data, len(event_data)), count),
+           rate(lambda: convert_ReplierBindEvent_data_from_network(
+                                network_event_data, len(event_data)), count))
+
+def _old_read_message(sock):
+    """Read a message from another Limpet as we used to, a field at a time.
+    """
+    header = sock.recv(_SERIALISED_MESSAGE_HEADER_LEN*4, socket.MSG_WAITALL)
+    name_len, data_len, array = _old_unserialise_message_header(header)
+    name = sock.recv(calc_padded_name_len(name_len), socket.MSG_WAITALL)
+    if data_len:
+        data = sock.recv(calc_padded_data_len(data_len), socket.MSG_WAITALL)
+    else:
+        data = None
+    end = sock.recv(4, socket.MSG_WAITALL)
+    return _message_from_network(array, name[:name_len],
+                                 data[:data_len] if data else None)
+
+def _limpet_read_rate(family, new, count):
+    """Return how many messages per second we can read over 'family'.
+    """
+    writer, reader = _socket_pair(family)
+    frames = serialise_message(Message('$.Telemetry.Something', 'x'*13)) * count
+    sender = threading.Thread(target=writer.sendall, args=(frames,))
+    sender.start()
+    try:
+        start = time.time()
+        if new:
+            frame_reader = LimpetFrameReader(reader)
+            done = 0
+            while done < count:
+                done += len(frame_reader.read_available())
+        else:
+            for ii in xrange(count):
+                _old_read_message(reader)
+        return count / (time.time() - start)
+    finally:
+        sender.join()
+        writer.close()
+        reader.close()
+
+def bench_limpet(count=20000, round_trips=200):
+    """Limpet network I/O: a call per field versus per message (or buffer)
+    """
+    header()
+    for family, name in ((socket.AF_UNIX, 'AF_UNIX'),
+                         (socket.AF_INET, 'TCP loopback')):
+        report('messages written, %s'%name,
+               _limpet_throughput(family, _old_write_message, None, count),
+               _limpet_throughput(family, _new_write_message, True, count))
+        report('messages read, %s'%name,
+               _limpet_read_rate(family, False, count),
+               _limpet_read_rate(family, True, count))
+
+    # Writing a message in several pieces, with Nagle's algorithm, can leave
+    # the end of it waiting for the other end to acknowledge the start
+    old = _limpet_round_trip(_old_write_message, False, round_trips)
+    new = _limpet_round_trip(_new_write_message, True, round_trips)
+    print '%-36s %12.1fus %12.1fus'%('TCP round trip', old * 1e6, new * 1e6)
+
+BENCHMARKS = [
+        ('codec', bench_codec),
+        ('payload', bench_payload),
+        ('decode', bench_decode),
+        ('template', bench_template),
+        ('clone', bench_clone),
+        ('io', bench_io),
+        ('ioctl', bench_ioctl),
+        ('bindings', bench_bindings),
+        ('pingpong', bench_pingpong),
+        ('limpet', bench_limpet),
+        ('limpetcodec', bench_limpetcodec),
+        ]
+
+def main(args):
+    if not args:
+        print __doc__
+        print 'Benchmarks are:'
+        for name, fn in BENCHMARKS:
+            print '  %-10s %s'%(name, fn.__doc__.strip())
+        return
+
+    if args == ['all']:
+        args = [name for name, fn in BENCHMARKS]
+
+    benchmarks = dict(BENCHMARKS)
+    for name in args:
+        try:
+            fn = benchmarks[name]
+        except KeyError:
+            print 'Unknown benchmark %s'%name
+            return
+        print
+        print fn.__doc__.strip()
+        fn()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
+
+# vim: set tabstop=8 softtabstop=4 shiftwidth=4 expandtab: